@@ -0,0 +1,45 @@
+"""
+Per-assertion latency of the utility API client
+
+Compares requests made with the module level requests.get, a new
+connection per assertion as before, against the pooled keep-alive session
+
+usage: python -m benchmarks.bench_utility [iterations]
+"""
+import sys
+import time
+
+import requests
+from httpclienttest.httpserver import HttpTestServer, new_session
+
+
+def time_assertions(server, iterations):
+    """
+    Return the mean latency in seconds of fetching the last route call
+    """
+    server._get_last_request('/test', 'GET')
+    start = time.time()
+    for _ in range(iterations):
+        server._get_last_request('/test', 'GET')
+    return (time.time() - start) / iterations
+
+
+def main(iterations=500):
+    server, _, _, _ = HttpTestServer(routes={'/test': {'GET': None}}).start()
+    try:
+        requests.get(server.base + '/test')
+
+        server.session = requests
+        before = time_assertions(server, iterations)
+
+        server.session = new_session()
+        after = time_assertions(server, iterations)
+    finally:
+        server.terminate()
+
+    print 'new connection: %.3f ms per assertion' % (before * 1000)
+    print 'keep-alive:     %.3f ms per assertion' % (after * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,506 @@
+"""
+Benchmark suite of the library hot paths with regression tracking
+
+Measures server startup, route changes on a running server, assertion
+latency, request recording throughput, routing with large route maps,
+call history fetches, route spec loading and cassette replay. Results
+are written as JSON, given a baseline from an earlier run any benchmark
+with a median slower than the baseline by more than the threshold is
+reported and the run exits with status 1
+
+usage: python -m benchmarks.suite [-o results.json] [-b baseline.json]
+                                  [-t 0.25] [-q] [-l label] [name ...]
+
+names select benchmarks by prefix, e.g. startup or history.sync
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+import requests
+from httpclienttest import HttpTests, Cassette, CassetteWriter, \
+    RouteFixture, add_routes, load_spec
+from httpclienttest.cassettes import request_key
+from httpclienttest.history import CallHistory, CallRecord
+from httpclienttest.httpserver import HttpTestServer, \
+    ThreadedHttpTestServer, UTIL_PREFIX, new_session, decode_response
+
+timer = time.time
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """
+    Register a benchmark, called with quick and returning a dict of
+    {name: samples} where samples are seconds per operation
+    """
+    BENCHMARKS.append(func)
+    return func
+
+
+def measure(func, repeat, number=1):
+    """
+    Return the seconds per call of func for repeat runs of number calls
+    """
+    gc.collect()
+    samples = []
+    for _ in range(repeat):
+        start = timer()
+        for _ in xrange(number):
+            func()
+        samples.append((timer() - start) / number)
+    return samples
+
+
+def summarise(samples):
+    """
+    Return the statistics kept for a benchmark
+    """
+    samples = sorted(samples)
+    median = samples[len(samples) // 2]
+    return {'unit': 's',
+            'runs': len(samples),
+            'median': median,
+            'min': samples[0],
+            'max': samples[-1],
+            'ops_per_sec': 1 / median if median else None}
+
+
+############################## Benchmarks ##############################
+@benchmark
+def startup(quick):
+    """
+    Time for HttpTestServer.start to return a listening server
+    """
+    results = {}
+    for engine, server_cls in (('process', HttpTestServer),
+                               ('thread', ThreadedHttpTestServer)):
+        samples = []
+        for _ in range(3 if quick else 10):
+            server = server_cls(routes={'/test': {'GET': None}})
+            start = timer()
+            server.start()
+            samples.append(timer() - start)
+            server.terminate()
+        results['startup.%s' % engine] = samples
+    return results
+
+
+@benchmark
+def routes(quick):
+    """
+    Latency of adding and deleting a route on a running server through
+    maintain_run_state, with a number of routes already in place
+    """
+    results = {}
+    for count in (10, 1000):
+        ht = HttpTests(shared=False)
+        try:
+            ht.add_routes(dict(('/route/%d' % i, {'GET': None})
+                               for i in range(count)))
+            added, deleted = [], []
+            for i in range(20 if quick else 100):
+                start = timer()
+                ht.add_route('/bench/%d' % i)
+                added.append(timer() - start)
+                start = timer()
+                ht.delete_route('/bench/%d' % i, 'GET')
+                deleted.append(timer() - start)
+        finally:
+            ht.close()
+        results['routes.add.%d' % count] = added
+        results['routes.delete.%d' % count] = deleted
+    return results
+
+
+@benchmark
+def assertions(quick):
+    """
+    Latency of each assert method against the process engine
+    """
+    ht = HttpTests(shared=False)
+    try:
+        ht.add_route('/test/<param>', 'POST')
+        requests.post(ht.base + '/test/1?key=val', data='body',
+                      headers={'X-Bench': 'yes'})
+        digest = ht.get_last_route('/test/<param>', 'POST')['body_sha256']
+
+        calls = {
+            'assertRouteCalled': ('/test/<param>', 'POST'),
+            'assertCountRouteCalled': ('/test/<param>', 1, 'POST'),
+            'assertCountRouteCalledWith': ('/test/<param>', 1, 'POST',
+                                           {'X-Bench': 'yes'},
+                                           {'key': 'val'}),
+            'assertLastRouteCallArguments': ('/test/<param>',
+                                             {'param': '1'}, 'POST'),
+            'assertLastRouteCallQueryString': ('/test/<param>',
+                                               {'key': 'val'}, 'POST'),
+            'assertLastRouteCallBodyDigest': ('/test/<param>', digest),
+            'assertLastRouteCallBodySize': ('/test/<param>', 4)}
+
+        results = {}
+        for name, args in sorted(calls.items()):
+            method = getattr(ht, name)
+            method(*args)
+            results['assert.%s' % name] = measure(
+                lambda: method(*args), 5, 20 if quick else 100)
+
+        def batch():
+            with ht.batch_asserts():
+                for name, args in calls.items():
+                    getattr(ht, name)(*args)
+
+        results['assert.batch.%d' % len(calls)] = measure(
+            batch, 5, 20 if quick else 100)
+    finally:
+        ht.close()
+    return results
+
+
+def _post_environ(body):
+    return {'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/record',
+            'QUERY_STRING': 'key=val',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '8080',
+            'HTTP_HOST': 'localhost:8080',
+            'HTTP_ACCEPT': '*/*',
+            'HTTP_USER_AGENT': 'bench',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body)}
+
+
+@benchmark
+def record(quick):
+    """
+    Requests recorded per second by build_func at various body sizes,
+    dispatched through the WSGI app without a socket
+    """
+    server = ThreadedHttpTestServer(routes={'/record': {'POST': 'ok'}},
+                                    max_calls=100)
+    server._build_app()
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    results = {}
+    for size in (0, 1024, 65536, 1048576):
+        body = '{"data": "%s"}' % ('x' * max(size - 12, 0))
+        number = max(10, (200 if quick else 2000) * 1024 // max(size, 1024))
+
+        def dispatch():
+            ''.join(server._dispatch(_post_environ(body), start_response))
+
+        results['record.%d' % size] = measure(dispatch, 5, number)
+    return results
+
+
+def _get_environ(path):
+    environ = _post_environ('')
+    environ.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                    'QUERY_STRING': '', 'CONTENT_LENGTH': '0'})
+    return environ
+
+
+@benchmark
+def router(quick):
+    """
+    Server startup, route lookup and request dispatch as the route map of
+    templated routes grows
+    """
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    results = {}
+    for count in (1000, 10000) if quick else (1000, 10000, 50000):
+        routes = {}
+        for i in range(count // 2):
+            routes['/api/v1/res%d/<id>' % i] = {'GET': 'ok'}
+            routes['/api/v1/res%d/<id>/items/<item:int>' % i] = {
+                'GET': None, 'DELETE': None}
+
+        samples = []
+        for _ in range(3):
+            server = ThreadedHttpTestServer(routes=routes, max_calls=100)
+            start = timer()
+            server.start(timeout=60)
+            samples.append(timer() - start)
+            server.terminate()
+        results['router.startup.%d' % count] = samples
+
+        server = ThreadedHttpTestServer(routes=routes, max_calls=100)
+        match = server._build_app().router.match
+        path = '/api/v1/res%d/7/items/3' % (count // 2 - 1)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+        results['router.match.%d' % count] = measure(
+            lambda: match(environ), 5, 10000)
+
+        def dispatch():
+            ''.join(server._dispatch(_get_environ(path), start_response))
+
+        results['router.dispatch.%d' % count] = measure(dispatch, 5,
+                                                        1000 if quick
+                                                        else 10000)
+    return results
+
+
+def _seed_history(count):
+    history = CallHistory()
+    for i in range(count):
+        request = {'args': {}, 'method': 'GET',
+                   'headers': {'Accept': '*/*', 'Host': 'localhost'},
+                   'query_params': {'page': str(i)},
+                   'urlparts': ['http', 'localhost', '/test', 'page=%d' % i,
+                                ''],
+                   'query_string': 'page=%d' % i,
+                   'body': None, 'time': float(i)}
+        history.add(CallRecord('/test', 'GET', request, 100, float(i)))
+    return history
+
+
+@benchmark
+def history(quick):
+    """
+    Cost of fetching call history from the process engine as it grows, a
+    full dump and a first sync of the local copy over each transport, and
+    an incremental sync
+    """
+    results = {}
+    for count in (100, 1000) if quick else (100, 1000, 10000):
+        server, utils, _, _ = HttpTestServer(
+            routes={'/test': {'GET': None}},
+            history=_seed_history(count)).start()
+        try:
+            repeat = 3 if count >= 10000 else 10
+            for transport in ('json', 'pickle'):
+                server.session = new_session(transport)
+                results['history.full.%s.%d' % (transport, count)] = measure(
+                    lambda: decode_response(server.session.get(
+                        server.base + UTIL_PREFIX + '/getcalls')), repeat)
+
+                def first_sync():
+                    server.history = CallHistory()
+                    server.sync_history()
+
+                results['history.sync.%s.%d' % (transport, count)] = \
+                    measure(first_sync, repeat)
+
+            def incremental():
+                requests.get(server.base + '/test')
+                server.sync_history()
+
+            results['history.incremental.%d' % count] = measure(incremental,
+                                                                repeat)
+        finally:
+            server.terminate()
+    return results
+
+
+@benchmark
+def fixtures(quick):
+    """
+    Per test cost of a map of 10 routes added and removed around each test
+    by the add_routes decorator, against a RouteFixture clearing their
+    history
+    """
+    route_map = dict(('/route/%d' % i, {'GET': None}) for i in range(10))
+    ht = HttpTests(shared=False)
+
+    class Case(object):
+        pass
+
+    case = Case()
+    case.ht = ht
+    number = 20 if quick else 100
+    try:
+        decorated = add_routes(route_map)(lambda self: None)
+        results = {'fixtures.decorator.10': measure(lambda: decorated(case),
+                                                    5, number)}
+        fixture = RouteFixture(route_map, ht)
+        fixture.install()
+        results['fixtures.reset.10'] = measure(fixture.reset, 5, number)
+        fixture.remove()
+    finally:
+        ht.close()
+    return results
+
+
+@benchmark
+def wait(quick):
+    """
+    Delay from a call arriving at the server to wait_for_calls returning
+    """
+    results = {}
+    for engine in ('process', 'thread'):
+        ht = HttpTests(shared=False, engine=engine)
+        try:
+            url, _ = ht.add_route('/test')
+            samples = []
+            for count in range(1, (20 if quick else 100) + 1):
+                client = threading.Timer(0.002, requests.get, (url,))
+                client.start()
+                ht.wait_for_calls('/test', count=count)
+                woken = timer()
+                client.join()
+                samples.append(woken - ht.get_last_route('/test', 'GET')
+                               ['time'])
+        finally:
+            ht.close()
+        results['wait.wakeup.%s' % engine] = samples
+    return results
+
+
+@benchmark
+def cassette(quick):
+    """
+    Time to open a cassette and to look up a recorded response as the
+    cassette grows, bodies are 64KB
+    """
+    results = {}
+    directory = tempfile.mkdtemp()
+    body = 'x' * 65536
+    try:
+        for count in (1000, 10000) if quick else (1000, 10000, 50000):
+            path = os.path.join(directory, '%d.cassette' % count)
+            writer = CassetteWriter(path)
+            keys = [request_key('GET', '/item', 'id=%d' % i)
+                    for i in range(count)]
+            for i, key in enumerate(keys):
+                writer.add(key, 'GET', '/item', 'id=%d' % i, 200,
+                           [('Content-Type', 'text/plain')], body)
+            writer.close()
+
+            results['cassette.open.%d' % count] = measure(
+                lambda: Cassette(path).close(), 5)
+            tape = Cassette(path)
+            lookups = iter(keys * 100)
+            results['cassette.lookup.%d' % count] = measure(
+                lambda: tape.lookup(next(lookups)), 5, 1000)
+            tape.close()
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+@benchmark
+def specs(quick):
+    """
+    Time to load an OpenAPI spec into a route map, parsed and from the
+    cache
+    """
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        for count in (1000, 10000):
+            paths = {}
+            for i in range(count):
+                paths['/res%d/{id}' % i] = {
+                    'get': {'responses': {'200': {'content': {
+                        'application/json': {'example': {
+                            'id': i, 'name': 'resource %d' % i,
+                            'tags': ['a', 'b', 'c']}}}}}},
+                    'delete': {'responses': {'204': {
+                        'description': 'deleted'}}}}
+            path = os.path.join(directory, '%d.json' % count)
+            with open(path, 'w') as out:
+                json.dump({'openapi': '3.0.0', 'paths': paths}, out)
+            cache = os.path.join(directory, 'cache')
+
+            results['specs.parse.%d' % count] = measure(
+                lambda: load_spec(path, False), 5)
+            load_spec(path, cache)
+            results['specs.cached.%d' % count] = measure(
+                lambda: load_spec(path, cache), 5)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+############################## Runner ##############################
+def run(names=None, quick=False):
+    """
+    Run the benchmarks matching names and return their summaries
+    """
+    results = {}
+    for func in BENCHMARKS:
+        if names and not any(func.__name__.startswith(n.split('.')[0])
+                             for n in names):
+            continue
+        for name, samples in func(quick).items():
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            results[name] = summarise(samples)
+            print >> sys.stderr, '%-45s %12.3f ms' % (
+                name, results[name]['median'] * 1000)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return (name, ratio) of benchmarks slower than the baseline by more
+    than threshold
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base or not base['median']:
+            continue
+        ratio = result['median'] / base['median']
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('-o', '--output', default='-',
+                        help='results file, - for standard output')
+    parser.add_argument('-b', '--baseline', help='results to compare to')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help='allowed slow down, 0.25 for 25%%')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='fewer iterations and sizes')
+    parser.add_argument('-l', '--label', help='e.g. the release measured')
+    args = parser.parse_args(argv)
+
+    output = {'meta': {'label': args.label,
+                       'time': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'quick': args.quick},
+              'results': run(args.names, args.quick)}
+
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(output, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as base:
+            baseline = json.load(base)['results']
+        regressions = compare(output['results'], baseline, args.threshold)
+        for name, ratio in regressions:
+            print >> sys.stderr, 'REGRESSION %s: %.2fx baseline' % (name,
+                                                                   ratio)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
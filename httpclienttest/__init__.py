@@ -3,46 +3,163 @@
 To simplify unit testing of HTTP clients
 """
 
+import os
 import unittest
 import atexit
 from random import randint
 
 
+from contextlib import contextmanager
 from functools import wraps
 from socket import error
 
 
-from httpserver import HttpTestServer, LIST, LAST, CLEAR, GETROUTE, CLEARROUTE
+from httpserver import HttpTestServer, ThreadedHttpTestServer, ENGINES, \
+    TestServerControlError, new_session, LIST, LAST, CLEAR, GETROUTE, \
+    CLEARROUTE, COUNTS, QUERY, STATS
+from history import CallHistory
+from stats import RouteTiming
+from batch import AssertionBatch, batchable
+from pool import HttpTestServerPool
+from responses import StreamingResponse, StaticResponse
+from specs import load_spec, spec_routes, SpecError
+from profiles import RouteProfile, Fault, Normal, LogNormal, Percentiles
+from clock import RealClock, VirtualClock
+from cassettes import Cassette, CassetteWriter, CassetteError
+
+
+# Callback of a (route, method) pair not in the route map
+_MISSING = object()
 
 
 def maintain_run_state(clean):
     """
-    Decorator to start and stop the server when routes are modified
+    Decorator to apply route modifications to the server
+
+    Changes are sent to the running server, it is only restarted when they
+    can not be applied in place. Within a route transaction they are left
+    for the transaction to apply
     """
     def main_decorator(callback):
         def wrapper_func(self, *a, **kwargs):
-            self.stop_server(clean)
-            res = callback(self, *a, **kwargs)
-            self.run_server()
+            if self._transaction is not None:
+                self._transaction.clean = self._transaction.clean or clean
+                return callback(self, *a, **kwargs)
+
+            changes = self._changes = RouteChanges(self.route_map)
+            try:
+                res = callback(self, *a, **kwargs)
+            finally:
+                self._changes = None
+            if not self.running:
+                self.run_server()
+                return res
+
+            changes.clean = clean
+            self._update_server(changes)
             return res
         return wrapper_func
     return main_decorator
 
 
+class RouteChanges(object):
+
+    """
+    Route changes not yet applied to the server, from a single change or
+    grouped by HttpTests.route_transaction. Holds the callback each changed
+    (route, method) pair had before, whether call history is cleared and
+    the pairs whose history is cleared
+
+    Changes are recorded as they are made so applying them costs the size
+    of the change, not of the route map
+    """
+
+    def __init__(self, route_map):
+        self.route_map = route_map
+        self.previous = {}
+        self.clean = False
+        self.cleared = []
+
+    def record(self, path, method, old):
+        """
+        Note a change to a pair whose callback was old, _MISSING if absent
+        """
+        self.previous.setdefault((path, method), old)
+
+    def delta(self, route_map):
+        """
+        Return the routes added or changed and the (route, method) pairs
+        removed in route_map since the changes began
+        """
+        added = {}
+        removed = []
+        for (path, method), old in self.previous.items():
+            func = route_map.get(path, {}).get(method, _MISSING)
+            if func is _MISSING:
+                if old is not _MISSING:
+                    removed.append((path, method))
+            elif func is not old:
+                added.setdefault(path, {})[method] = func
+        return added, removed
+
+    def rollback(self):
+        """
+        Return the route map the changes began from, restored
+        """
+        route_map = self.route_map
+        for (path, method), old in self.previous.items():
+            if old is _MISSING:
+                methods = route_map.get(path, {})
+                methods.pop(method, None)
+                if not methods:
+                    route_map.pop(path, None)
+            else:
+                route_map.setdefault(path, {})[method] = old
+        return route_map
+
+
+HISTORY_OPTIONS = ('max_calls', 'max_bytes', 'retention', 'indexed',
+                   'counted')
+
+
+# HttpTests instances with a running server by id, stopped at exit. They
+# are only held while their server runs so closed instances are freed
+_RUNNING = {}
+
+
+def _stop_servers():
+    for ht in _RUNNING.values():
+        ht.stop_server(False)
+
+atexit.register(_stop_servers)
+
+
 class Singleton(type):
+
+    """
+    Return one shared instance per class and process
+
+    Keying on the process gives forked test workers their own instance.
+    Pass shared=False to create an independent instance
+    """
     _instances = {}
 
     def __call__(cls, *a, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*a, **kwargs)
-        return cls._instances[cls]
+        if not kwargs.pop('shared', True):
+            return super(Singleton, cls).__call__(*a, **kwargs)
+
+        key = (cls, os.getpid())
+        if key not in cls._instances:
+            cls._instances[key] = super(Singleton, cls).__call__(*a, **kwargs)
+        return cls._instances[key]
 
 
 class HttpTests(unittest.TestCase):
 
     """
     Wrapper to provide functionality for modifying and running the test server
-    Not this is a singleton object
+    Note HttpTests() returns a shared instance for the process, use
+    HttpTests(shared=False) for a server of its own on a separate port
     """
     __metaclass__ = Singleton
 
@@ -51,17 +168,64 @@ class HttpTests(unittest.TestCase):
         Route map should be of format
         {route: {'method': http_method, 'func': function}}
         If function is None then a default function is called
+
+        engine selects how the server is run, 'process' runs it in a sub
+        process, 'thread' on a thread of this process sharing call history
+
+        server selects the WSGI server, 'threaded' by default, 'wsgiref' for
+        a single threaded server or 'gevent'
+
+        pool is an optional HttpTestServerPool servers are taken from, its
+        engine, server and spool_bytes are used in place of those given
+
+        spool_bytes is the size above which request bodies are spooled to
+        disk, history then only holds their size and SHA-256 digest
+
+        clock is an optional VirtualClock, injected delays and recorded
+        timestamps then follow it and it is moved on with advance_clock
+
+        transport is the encoding of utility API responses, 'json' by
+        default. 'pickle' keeps Python types and is faster on large
+        histories, but unpickles whatever answers on the server port so is
+        only for machines without other users
+
+        cassette is the path of a cassette answering requests which match no
+        route, with upstream set to a base URL those requests are passed on
+        to upstream and recorded to the cassette instead. Not used with pool
+
+        max_calls, max_bytes and retention limit the call history kept by
+        the server, indexed and counted set how it is indexed, see
+        CallHistory
+
+        Call history is kept across server restarts in history, with the
+        process engine it is a copy updated with the calls made since the
+        last utility request
         """
         #unittest.TestCase.__init__(self, *args, **kwargs)
+        self.engine = kwargs.get('engine', 'process')
+        if self.engine not in ENGINES:
+            raise ValueError('unknown server engine %s' % self.engine)
+        self.server = kwargs.get('server', 'threaded')
+        self.pool = kwargs.get('pool')
+        self.spool_bytes = kwargs.get('spool_bytes')
+        self.clock = kwargs.get('clock')
+        self.cassette = kwargs.get('cassette')
+        self.upstream = kwargs.get('upstream')
+        self.session = new_session(kwargs.get('transport', 'json'))
+        self.history_options = dict((name, kwargs[name])
+                                    for name in HISTORY_OPTIONS
+                                    if name in kwargs)
+
         self.calls = []
         self.url_map = {}
         self.proc = None
 
-        self.call_list = {}
-        self.last_call = None
+        self.history = CallHistory(**self.history_options)
         self.running = False
-
-        atexit.register(self.stop_server, False)
+        self._batch = None
+        self._transaction = None
+        self._changes = None
+        self.route_map = {}
 
         self.reset_route_map({})
 
@@ -70,47 +234,233 @@ class HttpTests(unittest.TestCase):
         Terminate server sub process, modify run state as required
         """
         if self.proc:
-            # Get the current state of the call list for reloading
+            # Bring the call history up to date for reloading
             if not clean:
-                call_func = getattr(self, LIST)
-                self.call_list = call_func()
-
-                last_func = getattr(self, LAST)
-                self.last_call = last_func()
-
-            self.proc.terminate()
+                self.history = self.proc.sync_history()
+                counts_func = getattr(self, COUNTS)
+                self.history.load_counts(counts_func())
+            else:
+                self.history.clear()
+
+            if self.pool:
+                self.pool.release(self.proc)
+            else:
+                self.proc.terminate()
             self.proc = None
             self.running = False
+            _RUNNING.pop(id(self), None)
             return True
         else:
             return False
 
-    def run_server(self):
-        server = HttpTestServer(routes=self.route_map,
-                                calls=self.call_list,
-                                last_call=self.last_call)
+    def close(self):
+        """
+        Stop the server, discard its call history and close the connections
+        of the utility session
+        """
+        stopped = self.stop_server(True)
+        self.session.close()
+        return stopped
 
-        self.proc, utils, self.host, self.port = server.start()
+    def run_server(self):
+        if self.pool:
+            started = self.pool.acquire(routes=self.route_map,
+                                        history=self.history,
+                                        clock=self.clock)
+            started[0].session = self.session
+        else:
+            server_cls = ENGINES[self.engine]
+            server = server_cls(routes=self.route_map,
+                                session=self.session,
+                                server=self.server,
+                                history=self.history,
+                                spool_bytes=self.spool_bytes,
+                                clock=self.clock,
+                                cassette=self.cassette,
+                                upstream=self.upstream,
+                                **self.history_options)
+            started = server.start()
+
+        self.proc, utils, self.host, self.port = started
         self.base = 'http://%s:%s' % (self.host, self.port)
 
         for name, details in utils.items():
             setattr(self, name, details['call_func'])
 
         self.running = True
+        _RUNNING[id(self)] = self
 
     def clear_route_history(self, path, method):
         """
         Clear history for a given route
         """
+        if self._transaction is not None:
+            self._transaction.cleared.append((path, method))
+            return True
         clear_func = getattr(self, CLEARROUTE)
         return clear_func(path, method)
 
+    def _update_server(self, changes):
+        """
+        Apply RouteChanges to the server, restarting it if they can not be
+        applied in place
+        """
+        cleared = changes.cleared
+        if not self.running:
+            for path, method in cleared:
+                self.history.clear(path, method)
+            self.run_server()
+            return
+
+        added, removed = changes.delta(self.route_map)
+        try:
+            self.proc.update_routes(added, removed, changes.clean, cleared)
+        except TestServerControlError:
+            self.stop_server(changes.clean)
+            for path, method in cleared:
+                self.history.clear(path, method)
+            self.run_server()
+
+    def _set_route(self, path, method, callback):
+        """
+        Set the callback of a route, recording the change
+        """
+        methods = self.route_map.setdefault(path, {})
+        self._changes.record(path, method, methods.get(method, _MISSING))
+        methods[method] = callback
+
+    def _replace_routes(self, route_map):
+        """
+        Replace the route map with a copy of route_map, recording every
+        route of either map. Changes are recorded against the map held, so
+        it must not be one the caller goes on to modify
+        """
+        route_map = dict((path, dict(methods))
+                         for path, methods in route_map.items())
+        old_map = self.route_map
+        for path, methods in old_map.items():
+            for method, func in methods.items():
+                self._changes.record(path, method, func)
+        for path, methods in route_map.items():
+            old_methods = old_map.get(path, {})
+            for method in methods:
+                self._changes.record(path, method,
+                                     old_methods.get(method, _MISSING))
+        self.route_map = route_map
+
+    @contextmanager
+    def route_transaction(self):
+        """
+        Group the route changes and route history clears made in the block
+        into a single server update applied on leaving it. If the block
+        raises the route map is restored and nothing is applied::
+
+            with self.ht.route_transaction():
+                self.ht.add_route('/a')
+                self.ht.delete_route('/b', 'GET')
+
+        Nested blocks join the outer transaction
+        """
+        if self._transaction is not None:
+            yield
+            return
+        transaction = RouteChanges(self.route_map)
+        self._transaction = self._changes = transaction
+        try:
+            yield
+        except:
+            self.route_map = transaction.rollback()
+            raise
+        finally:
+            self._transaction = self._changes = None
+        self._update_server(transaction)
+
+    def advance_clock(self, seconds):
+        """
+        Move the virtual clock on by seconds, responses delayed until then
+        are released. Returns the new virtual time
+        """
+        if self.clock is None:
+            raise ValueError('HttpTests has no virtual clock')
+        if not self.running:
+            self.clock.advance(seconds)
+            return self.clock.time()
+        return self.proc.advance_clock(seconds)
+
+    def wait_for_calls(self, path, method='GET', count=1, timeout=5):
+        """
+        Wait until count calls to a route have been recorded, e.g. made by a
+        background client, and return the number of calls. Returns as soon
+        as the call is recorded, or with fewer calls after timeout seconds
+        """
+        if not self.running:
+            return self.history.count(path, method)
+        return self.proc.wait_for_calls(path, method, count, timeout)
+
+    def query_calls(self, path=None, method=None, headers=None, params=None,
+                    since=None, until=None):
+        """
+        Return calls in history matching all of the given filters
+
+        headers and params are dicts of header and query string values to
+        match, since and until are timestamps limiting the arrival time
+        """
+        query_func = getattr(self, QUERY)
+        return query_func(path, method, headers, params, since, until)
+
+    def count_calls(self, path=None, method=None, headers=None, params=None,
+                    since=None, until=None):
+        """
+        Return the number of calls matching all of the given filters, see
+        query_calls
+        """
+        query_func = getattr(self, QUERY)
+        return query_func(path, method, headers, params, since, until,
+                          count=True)
+
+    def route_stats(self, path, method='GET'):
+        """
+        Return the RouteTiming of the requests to a route on the running
+        server or None if it has not been called. Timing is cleared with the
+        call history of the route and not kept across server restarts
+        """
+        if not self.running:
+            return None
+        stats_func = getattr(self, STATS)
+        timing = stats_func().get(path, {}).get(method)
+        if timing is None:
+            return None
+        return RouteTiming.from_dict(timing)
+
+    @contextmanager
+    def batch_asserts(self):
+        """
+        Queue the assertions made in the block and check them together on
+        leaving it, the lookups they need are made in one request to the
+        server. The first failing assertion raises with its usual message::
+
+            with self.ht.batch_asserts():
+                self.assertRouteCalled('/test')
+                self.assertCountRouteCalled('/other', 3)
+
+        Nested blocks join the outer batch
+        """
+        if self._batch is not None:
+            yield
+            return
+        batch = self._batch = AssertionBatch(self)
+        try:
+            yield
+        finally:
+            self._batch = None
+        batch.resolve()
+
     @maintain_run_state(True)
     def clear_routes(self):
         """
         Clear the route map
         """
-        self.route_map = {}
+        self._replace_routes({})
         return True
 
     @maintain_run_state(True)
@@ -118,7 +468,7 @@ class HttpTests(unittest.TestCase):
         """
         Reset the route map with a new map
         """
-        self.route_map = route_map
+        self._replace_routes(route_map)
         return True
 
     @maintain_run_state(False)
@@ -129,22 +479,22 @@ class HttpTests(unittest.TestCase):
         We don't want to call add_route each time as this will bounce the
         server a lot
         """
-        for path in route_map.keys():
-            route = self.route_map.get(path, {})
-            for method in route_map[path].keys():
-                route[method] = route_map[path][method]
-            self.route_map[path] = route
+        for path, methods in route_map.items():
+            for method, callback in methods.items():
+                self._set_route(path, method, callback)
 
         return True
 
     @maintain_run_state(False)
-    def add_route(self, path, method='GET', callback=None):
+    def add_route(self, path, method='GET', callback=None, profile=None):
         """
-        Add a route to the test server
+        Add a route to the test server, profile is an optional RouteProfile
+        of the latency and faults of the route. For add_routes wrap the
+        callbacks with RouteProfile.wrap
         """
-        route = self.route_map.get(path, {})
-        route[method] = callback
-        self.route_map[path] = route
+        if profile is not None:
+            callback = profile.wrap(callback)
+        self._set_route(path, method, callback)
 
         return self.base + path, method
 
@@ -153,9 +503,10 @@ class HttpTests(unittest.TestCase):
         """
         Delete a route from the test server
         """
-        if path in self.route_map.keys():
-            if method in self.route_map[path].keys():
+        if path in self.route_map:
+            if method in self.route_map[path]:
                 func = self.route_map[path].pop(method)
+                self._changes.record(path, method, func)
                 if len(self.route_map[path]) == 0:
                     self.route_map.pop(path)
 
@@ -163,6 +514,7 @@ class HttpTests(unittest.TestCase):
         return False, None
 
     ############# Assertions provided to decorated functions #########
+    @batchable
     def assertRouteCalled(self, path, method='GET', err_msg=None):
         """
         Assert that the specified route is called
@@ -174,6 +526,7 @@ class HttpTests(unittest.TestCase):
         result = req_func(path, method)
         self.assertIsNotNone(result, msg)
 
+    @batchable
     def assertCountRouteCalled(self, path, count, method='GET', err_msg=None):
         """
         Assert that the specified route is called a number of times
@@ -181,13 +534,26 @@ class HttpTests(unittest.TestCase):
         msg = 'route %s - %s was not called' % (path, method)
         if err_msg:
             msg = err_msg
-        list_func = getattr(self, LIST)
-        result = list_func()
-        method_dict = result.get(path, {})
-        hit_list = method_dict.get(method, [])
+        result = self.count_calls(path, method)
+
+        self.assertTrue((result == count), msg)
+
+    @batchable
+    def assertCountRouteCalledWith(self, path, count, method='GET',
+                                   headers=None, params=None, err_msg=None):
+        """
+        Assert that the specified route is called a number of times with
+        the given header and query string values
+        """
+        msg = 'route %s - %s was not called %d times with headers %s ' \
+              'params %s' % (path, method, count, headers, params)
+        if err_msg:
+            msg = err_msg
+        result = self.count_calls(path, method, headers, params)
 
-        self.assertTrue((len(hit_list) == count), msg)
+        self.assertTrue((result == count), msg)
 
+    @batchable
     def assertLastRouteCallArguments(self, path, arg_dict,
                                      method='GET',
                                      err_msg=None):
@@ -201,6 +567,7 @@ class HttpTests(unittest.TestCase):
         res = req_func(path, method)
         self.assertDictEqual(res['args'], arg_dict, msg)
 
+    @batchable
     def assertLastRouteCallQueryString(self, path, param_dict,
                                        method='GET',
                                        err_msg=None):
@@ -214,12 +581,100 @@ class HttpTests(unittest.TestCase):
         res = req_func(path, method)
         self.assertDictEqual(res['query_params'], param_dict, msg)
 
+    @batchable
+    def assertLastRouteCallBodyDigest(self, path, digest, method='POST',
+                                      err_msg=None):
+        """
+        Assert that the body of the last call to the route has the given
+        SHA-256 hex digest, the body itself is not compared
+        """
+        msg = 'route %s - %s body digest was not %s' % (path, method, digest)
+        if err_msg:
+            msg = err_msg
+        req_func = getattr(self, GETROUTE)
+        res = req_func(path, method)
+        self.assertIsNotNone(res, msg)
+        self.assertTrue((res['body_sha256'] == digest), msg)
+
+    @batchable
+    def assertLastRouteCallBodySize(self, path, size, method='POST',
+                                    err_msg=None):
+        """
+        Assert that the body of the last call to the route has the given
+        size in bytes
+        """
+        msg = 'route %s - %s body size was not %d' % (path, method, size)
+        if err_msg:
+            msg = err_msg
+        req_func = getattr(self, GETROUTE)
+        res = req_func(path, method)
+        self.assertIsNotNone(res, msg)
+        self.assertTrue((res['body_size'] == size), msg)
+
+    def assertRouteCalledWithin(self, path, timeout, count=1, method='GET',
+                                err_msg=None):
+        """
+        Assert that the specified route is called count times within
+        timeout seconds
+        """
+        msg = 'route %s - %s was not called %d times within %ss' % (
+            path, method, count, timeout)
+        if err_msg:
+            msg = err_msg
+        result = self.wait_for_calls(path, method, count, timeout)
+
+        self.assertTrue((result >= count), msg)
+
+    @batchable
+    def assertRouteLatencyBelow(self, path, seconds, percentile=99,
+                                method='GET', timing='total', err_msg=None):
+        """
+        Assert that percentile percent of the requests to the route were
+        handled within seconds as measured by the server. timing 'total' is
+        the whole request including sending the response, 'callback' the
+        time spent in the route callback
+        """
+        stats = self.route_stats(path, method)
+        msg = 'route %s - %s was not called' % (path, method)
+        self.assertIsNotNone(stats, err_msg or msg)
+        latency = stats.latency(percentile, timing)
+        msg = 'route %s - %s p%s %s time %.6fs is not below %.6fs' % (
+            path, method, percentile, timing, latency, seconds)
+        if err_msg:
+            msg = err_msg
+        self.assertTrue((latency < seconds), msg)
+
+    @batchable
+    def assertRouteRateAbove(self, path, rps, method='GET', err_msg=None):
+        """
+        Assert that the route was called more than rps times per second
+        between its first and last request as seen by the server
+        """
+        stats = self.route_stats(path, method)
+        rate = stats and stats.rate()
+        msg = 'route %s - %s request rate %s is not above %s per second' % (
+            path, method, rate, rps)
+        if err_msg:
+            msg = err_msg
+        self.assertTrue((rate is not None and rate > rps), msg)
+
+
+def _get_http_tests(self_obj):
+    """
+    Return the HttpTests instance of a test case, the shared instance is
+    used unless the test case has set up its own
+    """
+    ht = getattr(self_obj, 'ht', None)
+    if isinstance(ht, HttpTests):
+        return ht
+    return HttpTests()
+
 
 def _add_asserts(self_obj):
     """
     Add all assertions from the HttpTests instance to the test case object
     """
-    ht = HttpTests()
+    ht = self_obj.ht
     htattrs = dir(ht)
     asserts = filter(lambda x: x.startswith('assert'), htattrs)
     for asrt in asserts:
@@ -228,24 +683,52 @@ def _add_asserts(self_obj):
 
 
 ############################## Test Decorators ################################
+def _route_decorator(func, setup):
+    """
+    Wrap a test to run setup, which changes routes and returns a function
+    undoing its changes, before the test and to undo the changes after it
+
+    Stacked route decorators share one wrapper, their setups are applied in
+    one route transaction and their teardowns in another
+    """
+    if getattr(func, '_route_wrapper', None) is func:
+        func._route_setups.insert(0, setup)
+        return func
+
+    @wraps(func)
+    def func_wrapper(self):
+        self.ht = _get_http_tests(self)
+        with self.ht.route_transaction():
+            teardowns = [step(self.ht) for step in func_wrapper._route_setups]
+        _add_asserts(self)
+
+        try:
+            res = func(self)
+        finally:
+            with self.ht.route_transaction():
+                for teardown in reversed(teardowns):
+                    teardown()
+        return res
+
+    func_wrapper._route_wrapper = func_wrapper
+    func_wrapper._route_setups = [setup]
+    return func_wrapper
+
+
 def add_route(path, method='GET', function=None):
     """
     decorator to add routes at test execution
     """
-    def main_decorator(func):
-        @wraps(func)
-        def func_wrapper(self):
-            self.ht = HttpTests()
-            self.ht.add_route(path, method, function)
-            _add_asserts(self)
+    def setup(ht):
+        ht.add_route(path, method, function)
 
-            try:
-                res = func(self)
-            finally:
-                self.ht.delete_route(path, method)
-                self.ht.clear_route_history(path, method)
-            return res
-        return func_wrapper
+        def teardown():
+            ht.delete_route(path, method)
+            ht.clear_route_history(path, method)
+        return teardown
+
+    def main_decorator(func):
+        return _route_decorator(func, setup)
     return main_decorator
 
 
@@ -253,21 +736,16 @@ def delete_route(path, method='GET'):
     """
     decorator to delete routes at test execution
     """
-    def main_decorator(func):
-        @wraps(func)
-        def func_wrapper(self):
-            self.ht = HttpTests()
-            exists, del_func = self.ht.delete_route(path, method)
-            _add_asserts(self)
+    def setup(ht):
+        exists, del_func = ht.delete_route(path, method)
 
-            try:
-                res = func(self)
-            finally:
-                if exists:
-                    self.ht.add_route(path, method, del_func)
+        def teardown():
+            if exists:
+                ht.add_route(path, method, del_func)
+        return teardown
 
-            return res
-        return func_wrapper
+    def main_decorator(func):
+        return _route_decorator(func, setup)
     return main_decorator
 
 
@@ -275,23 +753,115 @@ def add_routes(route_map):
     """
     decorator to add routes from a route map
     """
+    def setup(ht):
+        ht.add_routes(route_map)
+
+        def teardown():
+            for path in route_map.keys():
+                for method in route_map[path].keys():
+                    ht.delete_route(path, method)
+        return teardown
+
     def main_decorator(func):
-        @wraps(func)
-        def func_wrapper(self):
+        return _route_decorator(func, setup)
+    return main_decorator
+
+
+class RouteFixture(object):
+
+    """
+    Routes installed once for a test class or module rather than around
+    every test, only their call history is cleared before each test
+
+    Decorate a test class to install the routes for the class::
+
+        @RouteFixture({'/test': {'GET': None}})
+        class MyTests(unittest.TestCase):
+            ...
+
+    For a module install them from setUpModule, classes decorated with the
+    same fixture then share the routes::
+
+        ROUTES = RouteFixture({'/test': {'GET': None}})
+        setUpModule, tearDownModule = ROUTES.install, ROUTES.remove
+
+    ht is the HttpTests the routes are added to, the ht of the decorated
+    class or the shared instance by default
+    """
+
+    def __init__(self, route_map, ht=None):
+        self.route_map = route_map
+        self.given = ht
+        self.ht = ht
+        self.installs = 0
+
+    def install(self):
+        """
+        Add the routes, nested installs are counted and share them
+        """
+        self.installs += 1
+        if self.installs > 1:
+            return
+        if self.ht is None:
             self.ht = HttpTests()
-            self.ht.add_routes(route_map)
-            _add_asserts(self)
+        self.ht.add_routes(self.route_map)
+
+    def remove(self):
+        """
+        Delete the routes and their call history once the last install is
+        removed
+        """
+        self.installs -= 1
+        if self.installs:
+            return
+        with self.ht.route_transaction():
+            for path, methods in self.route_map.items():
+                for method in methods.keys():
+                    self.ht.delete_route(path, method)
+                    self.ht.clear_route_history(path, method)
+        self.ht = self.given
+
+    def reset(self):
+        """
+        Clear the call history of the routes in one server update
+        """
+        with self.ht.route_transaction():
+            for path, methods in self.route_map.items():
+                for method in methods.keys():
+                    self.ht.clear_route_history(path, method)
+
+    def __call__(self, cls):
+        fixture = self
+        setup_class = cls.setUpClass
+        teardown_class = cls.tearDownClass
+        setup = cls.setUp
+
+        def setUpClass(klass):
+            if not fixture.installs and fixture.ht is None:
+                fixture.ht = _get_http_tests(klass)
+            fixture.install()
+            try:
+                setup_class.__func__(klass)
+            except:
+                fixture.remove()
+                raise
 
+        def tearDownClass(klass):
             try:
-                res = func(self)
+                teardown_class.__func__(klass)
             finally:
-                for path in route_map.keys():
-                    for method in route_map[path].keys():
-                        self.ht.delete_route(path, method)
+                fixture.remove()
 
-            return res
-        return func_wrapper
-    return main_decorator
+        def setUp(self_obj):
+            self_obj.ht = fixture.ht
+            _add_asserts(self_obj)
+            fixture.reset()
+            setup(self_obj)
+
+        cls.setUpClass = classmethod(setUpClass)
+        cls.tearDownClass = classmethod(tearDownClass)
+        cls.setUp = setUp
+        return cls
 
 
 def start_http():
@@ -301,7 +871,7 @@ def start_http():
     def main_decorator(func):
         @wraps(func)
         def func_wrapper(self):
-            self.ht = HttpTests()
+            self.ht = _get_http_tests(self)
             _add_asserts(self)
 
             return func(self)
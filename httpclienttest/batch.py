@@ -0,0 +1,110 @@
+from functools import wraps
+
+from httpserver import GETROUTE, QUERY, STATS, BATCH
+
+
+class _Pending(Exception):
+
+    "Raised in place of a utility result not fetched yet"
+
+
+def batchable(assertion):
+    """
+    Decorator queueing an assertion while a batch is open rather than
+    running it
+    """
+    @wraps(assertion)
+    def wrapper(self, *a, **kwargs):
+        if self._batch is not None:
+            self._batch.queue.append((assertion, a, kwargs))
+            return
+        return assertion(self, *a, **kwargs)
+    return wrapper
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    return value
+
+
+class AssertionBatch(object):
+
+    """
+    Assertions queued by HttpTests.batch_asserts, resolved together
+
+    Queued assertions are run with the utility functions they use answered
+    from batch results. A first run collects the lookups they make, these
+    are sent to the server in one request, then the assertions are run
+    again against the results. The first failing assertion raises just as
+    it would have unbatched
+    """
+
+    def __init__(self, ht):
+        self.ht = ht
+        self.queue = []
+        self.results = {}
+        self.pending = []
+        self.ops = []
+
+    def _lookup(self, key, op):
+        if key in self.results:
+            return self.results[key]
+        if key not in self.pending:
+            self.pending.append(key)
+            self.ops.append(op)
+        raise _Pending()
+
+    def last_route(self, path, method):
+        return self._lookup(('last_route', path, method),
+                            ['last_route', path, method])
+
+    def query(self, path=None, method=None, headers=None, params=None,
+              since=None, until=None, count=False):
+        key = ('query', path, method, _freeze(headers), _freeze(params),
+               since, until, count)
+        return self._lookup(key, ['query', {'path': path,
+                                            'method': method,
+                                            'headers': headers,
+                                            'params': params,
+                                            'since': since,
+                                            'until': until,
+                                            'count': count}])
+
+    def stats(self):
+        return self._lookup(('stats',), ['stats'])
+
+    def _run(self, collect):
+        """
+        Run the queued assertions, when collecting failures are ignored and
+        the lookups not yet resolved are gathered
+        """
+        for assertion, a, kwargs in self.queue:
+            try:
+                assertion(self.ht, *a, **kwargs)
+            except (_Pending, AssertionError):
+                if not collect:
+                    raise
+
+    def resolve(self):
+        """
+        Fetch what the queued assertions need and run them
+        """
+        ht = self.ht
+        funcs = dict((name, getattr(ht, name))
+                     for name in (GETROUTE, QUERY, STATS))
+        setattr(ht, GETROUTE, self.last_route)
+        setattr(ht, QUERY, self.query)
+        setattr(ht, STATS, self.stats)
+        try:
+            while True:
+                self.pending, self.ops = [], []
+                self._run(collect=True)
+                if not self.pending:
+                    break
+                results = getattr(ht, BATCH)(self.ops)
+                self.results.update(zip(self.pending, results))
+            self._run(collect=False)
+        finally:
+            for name, func in funcs.items():
+                setattr(ht, name, func)
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from urllib import urlencode
+from urlparse import parse_qsl
+
+from history import JSON_TYPES
+
+# A cassette is the magic, then records of a (meta, body) length pair, the
+# JSON meta of the exchange and the response body, then a JSON index of
+# {key: [record offsets]} and a trailer giving the offset of the index
+MAGIC = 'HTCASS1\n'
+INDEX_MAGIC = 'HTINDEX\n'
+RECORD = struct.Struct('>II')
+TRAILER = struct.Struct('>Q8s')
+
+# Headers describing the connection or transfer of the recorded response
+# rather than the response itself, they are not recorded
+HOP_HEADERS = frozenset(('connection', 'keep-alive', 'transfer-encoding',
+                         'content-encoding', 'content-length', 'te',
+                         'trailer', 'upgrade', 'proxy-authenticate',
+                         'proxy-authorization'))
+
+
+class CassetteError(Exception):
+
+    "Cassette file could not be read"
+
+
+def request_key(method, path, query_string='', body='', content_type=''):
+    """
+    Return the key a request is recorded under, the method, path and the
+    SHA-256 of the sorted query string and body. JSON bodies are compared by
+    value rather than by their formatting
+    """
+    query = urlencode(sorted(parse_qsl(query_string or '',
+                                       keep_blank_values=True)))
+    body = body or ''
+    if body and (content_type or '').lower().split(';')[0] in JSON_TYPES:
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True,
+                              separators=(',', ':'))
+        except ValueError:
+            pass
+    digest = hashlib.sha256(query)
+    digest.update('\n')
+    digest.update(body)
+    return '%s %s %s' % (method.upper(), path, digest.hexdigest())
+
+
+def response_headers(headers):
+    """
+    Return the (name, value) pairs of headers worth recording
+    """
+    return [(name, value) for name, value in headers
+            if name.lower() not in HOP_HEADERS]
+
+
+class Cassette(object):
+
+    """
+    Recorded exchanges read from a cassette file
+
+    The file is memory mapped and only its index is parsed when opened,
+    response bodies are read from the map when looked up. A request
+    recorded more than once is answered with its responses in recorded
+    order, the last one is repeated
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error) as e:
+            self.file.close()
+            raise CassetteError('%s is not a cassette: %s' % (path, e))
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise CassetteError('%s is not a cassette' % path)
+
+        self.end, self.index = self._read_index()
+        self.replayed = {}
+        self.lock = threading.Lock()
+
+    def _read_index(self):
+        """
+        Return the end of the records and the index, a cassette whose
+        recording was cut short has no index and its records are scanned
+        """
+        size = len(self.map)
+        if size >= len(MAGIC) + TRAILER.size:
+            offset, magic = TRAILER.unpack_from(self.map, size - TRAILER.size)
+            if magic == INDEX_MAGIC and len(MAGIC) <= offset < size:
+                index = json.loads(self.map[offset:size - TRAILER.size])
+                return offset, index
+        return self._scan()
+
+    def _scan(self):
+        index = {}
+        offset = len(MAGIC)
+        size = len(self.map)
+        while offset + RECORD.size <= size:
+            meta_size, body_size = RECORD.unpack_from(self.map, offset)
+            end = offset + RECORD.size + meta_size + body_size
+            if end > size:
+                break
+            meta = json.loads(self.map[offset + RECORD.size:
+                                       offset + RECORD.size + meta_size])
+            index.setdefault(meta['key'], []).append(offset)
+            offset = end
+        return offset, index
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self.index.values())
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def read(self, offset):
+        """
+        Return the meta and body of the record at offset
+        """
+        meta_size, body_size = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        meta = json.loads(self.map[start:start + meta_size])
+        return meta, self.map[start + meta_size:
+                              start + meta_size + body_size]
+
+    def lookup(self, key):
+        """
+        Return the (status, headers, body) recorded for a request key or
+        None if it was not recorded
+        """
+        offsets = self.index.get(key)
+        if not offsets:
+            return None
+        with self.lock:
+            count = self.replayed.get(key, 0)
+            self.replayed[key] = count + 1
+        meta, body = self.read(offsets[min(count, len(offsets) - 1)])
+        headers = [(name.encode('latin-1'), value.encode('latin-1'))
+                   for name, value in meta['headers']]
+        return meta['status'], headers, body
+
+    def rewind(self):
+        """
+        Answer each request from its first recorded response again
+        """
+        with self.lock:
+            self.replayed = {}
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class CassetteWriter(object):
+
+    """
+    Records exchanges to a cassette file, recording into an existing
+    cassette adds to it. The index is written on close, a cassette left
+    without one is still read by scanning its records
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        end = len(MAGIC)
+        if os.path.exists(path) and os.path.getsize(path):
+            cassette = Cassette(path)
+            end, self.index = cassette.end, cassette.index
+            cassette.close()
+            self.file = open(path, 'r+b')
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(MAGIC)
+        self.offset = end
+        self.lock = threading.Lock()
+
+    def add(self, key, method, path, query_string, status, headers, body):
+        """
+        Append an exchange, headers are (name, value) pairs of the response
+        """
+        meta = json.dumps({'key': key,
+                           'method': method,
+                           'path': path,
+                           'query': query_string,
+                           'status': status,
+                           'headers': response_headers(headers)})
+        with self.lock:
+            self.file.write(RECORD.pack(len(meta), len(body)))
+            self.file.write(meta)
+            self.file.write(body)
+            self.file.flush()
+            self.index.setdefault(key, []).append(self.offset)
+            self.offset += RECORD.size + len(meta) + len(body)
+
+    def close(self):
+        """
+        Write the index and close the file
+        """
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(json.dumps(self.index))
+            self.file.write(TRAILER.pack(self.offset, INDEX_MAGIC))
+            self.file.close()
@@ -0,0 +1,76 @@
+import threading
+import time
+
+
+class RealClock(object):
+
+    """
+    Wall clock, sleep is the sleep function of the server so waiting does
+    not block other requests
+    """
+    virtual = False
+
+    def __init__(self, sleep=time.sleep):
+        self._sleep = sleep
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._sleep(seconds)
+
+    def sleep_until(self, deadline):
+        self.sleep(deadline - self.time())
+
+
+class VirtualClock(object):
+
+    """
+    Clock only moving when advanced, threads sleeping on it are released
+    once virtual time passes their deadline
+
+    Pass to HttpTests as clock for injected delays and recorded timestamps
+    to follow it, then move it on with HttpTests.advance_clock. Starts at
+    the current time unless start is given
+    """
+    virtual = True
+
+    def __init__(self, start=None):
+        if start is None:
+            start = time.time()
+        self.now = start
+        self.condition = threading.Condition()
+
+    def __getstate__(self):
+        return {'now': self.now}
+
+    def __setstate__(self, state):
+        self.now = state['now']
+        self.condition = threading.Condition()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleep_until(self.now + seconds)
+
+    def sleep_until(self, deadline):
+        with self.condition:
+            while self.now < deadline:
+                self.condition.wait()
+
+    def advance(self, seconds):
+        """
+        Move virtual time on by seconds
+        """
+        self.advance_to(self.now + seconds)
+
+    def advance_to(self, when):
+        """
+        Move virtual time on to when, it never goes back
+        """
+        with self.condition:
+            if when > self.now:
+                self.now = when
+                self.condition.notify_all()
@@ -0,0 +1,495 @@
+import base64
+import hashlib
+import json
+from collections import deque
+
+import bottle
+
+JSON_TYPES = ('application/json', 'application/json-rpc')
+
+
+class CapturedRequest(object):
+
+    """
+    Raw request captured by the test server, the CGI variables of the WSGI
+    environ, the route arguments and the body bytes. It is decoded into the
+    utility API format when first asked for
+
+    body is None for bodies spooled to disk, only their size and SHA-256
+    digest are kept
+    """
+    __slots__ = ('environ', 'args', 'body', 'body_size', 'digest')
+
+    def __init__(self, environ, args, body, body_size=None, digest=None):
+        self.environ = environ
+        self.args = args
+        self.body = body
+        self.body_size = body_size
+        if body_size is None:
+            self.body_size = len(body)
+        self.digest = digest
+
+    def _request(self):
+        # Bottle caches parsed values in the environ, keep ours clean
+        return bottle.BaseRequest(dict(self.environ))
+
+    def headers_and_params(self):
+        """
+        Return the headers and query params without decoding the body
+        """
+        request = self._request()
+        return dict(request.headers), dict(request.query)
+
+    def decode_body(self, content_type):
+        """
+        Return the body and its encoding, JSON bodies are parsed, others
+        are returned as text or base64 encoded if not UTF-8. Spooled bodies
+        are not kept and returned as None with encoding 'spooled'
+        """
+        if self.body is None:
+            return None, 'spooled'
+        if not self.body:
+            return None, None
+        if content_type.lower().split(';')[0] in JSON_TYPES:
+            try:
+                return json.loads(self.body), None
+            except ValueError:
+                pass
+        try:
+            return self.body.decode('utf-8'), None
+        except UnicodeDecodeError:
+            return base64.b64encode(self.body), 'base64'
+
+    def decode(self):
+        """
+        Return the request in the format returned by the utility API
+        """
+        request = self._request()
+        body, encoding = self.decode_body(request.content_type)
+        digest = self.digest
+        if digest is None:
+            digest = hashlib.sha256(self.body).hexdigest()
+        return {'args': self.args,
+                'method': request.method,
+                'headers': dict(request.headers),
+                'query_params': dict(request.query),
+                'urlparts': request.urlparts,
+                'query_string': request.query_string,
+                'body': body,
+                'body_encoding': encoding,
+                'body_size': self.body_size,
+                'body_sha256': digest}
+
+
+class CallRecord(object):
+
+    """
+    A request recorded by the test server, seq is its position in the
+    history of the server
+
+    Either data in the utility API format or the CapturedRequest it is
+    decoded from on first access is given
+    """
+    __slots__ = ('rule', 'method', 'time', 'size', 'dropped', 'indexed',
+                 'seq', 'request', '_data')
+
+    def __init__(self, rule, method, data, size=0, time=None, seq=None,
+                 request=None):
+        self.rule = rule
+        self.method = method
+        self._data = data
+        self.request = request
+        self.size = size
+        self.time = time
+        self.seq = seq
+        self.dropped = False
+        self.indexed = False
+
+    @property
+    def data(self):
+        # Records are decoded by concurrent utility requests without a lock.
+        # request is read before _data, _data is published whole before
+        # request is dropped, so a reader always finds one of them
+        request = self.request
+        data = self._data
+        if data is None:
+            data = request.decode()
+            data['time'] = self.time
+            data['seq'] = self.seq
+            self._data = data
+            self.request = None
+        return data
+
+    def index_keys(self):
+        """
+        Return the (kind, name, value) keys the record is indexed under,
+        header names are lower case
+        """
+        request = self.request
+        if request is not None:
+            headers, params = request.headers_and_params()
+        else:
+            headers = self._data.get('headers', {})
+            params = self._data.get('query_params', {})
+
+        keys = [('header', name.lower(), value)
+                for name, value in headers.items()]
+        keys.extend(('param', name, value) for name, value in params.items())
+        return keys
+
+    def as_dict(self):
+        """
+        Return the request in the format returned by the utility API
+        """
+        return self.data
+
+
+class CallHistory(object):
+
+    """
+    Call history of a test server, kept per route and method
+
+    Retention can be limited to the last max_calls records of each route and
+    method, overridden per route with retention in the format
+    {route: count} or {route: {method: count}}, and to a global budget of
+    max_bytes of request data after which the oldest records are evicted.
+    Call counts include evicted records.
+
+    Records are numbered in arrival order, the numbering carries on across
+    clears so calls recorded after a sequence number can be fetched with
+    since_seq.
+
+    Records are indexed by header and query parameter value so queries on
+    them don't scan the history. Indexing is deferred until the next query
+    or until the record is evicted, keeping recording cheap. Set indexed to
+    False to skip indexing, e.g. when every request carries unique values.
+    Indexes only hold retained records, counts filtered on a header or
+    query parameter named in counted also include evicted calls, at the
+    cost of a counter per value seen.
+
+    Not thread safe, callers hold the server lock
+    """
+
+    def __init__(self, max_calls=None, max_bytes=None, retention=None,
+                 indexed=True, counted=()):
+        self.max_calls = max_calls
+        self.max_bytes = max_bytes
+        self.retention = retention or {}
+        self.indexed = indexed
+        self.counted = tuple(counted or ())
+        self._counted = set([('header', name.lower()) for name in
+                             self.counted] +
+                            [('param', name) for name in self.counted])
+        self.seq = 0
+        self.clear()
+
+    def clear(self, rule=None, method=None):
+        """
+        Clear history for a route and method, or all history if not given
+        """
+        if rule is None:
+            self.calls = {}
+            self.counts = {}
+            # {(route, method): {(kind, name, value): records}}
+            self.indexes = {}
+            # Calls per value of the counted names, evicted ones included
+            self.index_counts = {}
+            self.last_call = None
+            self.bytes = 0
+            self.retained = 0
+            # Arrival order, may hold dropped records
+            self.order = deque()
+            # Records not indexed yet in arrival order
+            self.unindexed = deque()
+            return
+
+        key = (rule, method)
+        self.counts.pop(key, None)
+        self.indexes.pop(key, None)
+        self.index_counts.pop(key, None)
+        for record in self.unindexed:
+            if (record.rule, record.method) == key:
+                record.indexed = True
+        for record in self.calls.pop(key, ()):
+            self._drop(record)
+
+    def limit(self, rule, method):
+        """
+        Return the number of records kept for a route and method
+        """
+        limit = self.retention.get(rule, self.max_calls)
+        if isinstance(limit, dict):
+            limit = limit.get(method, self.max_calls)
+        return limit
+
+    def _drop(self, record):
+        record.dropped = True
+        self.bytes -= record.size
+        self.retained -= 1
+
+        if not record.indexed:
+            # Only counted, the record is not kept in the indexes
+            record.indexed = True
+            if self.indexed and self._counted:
+                self._index((record.rule, record.method), record)
+            return
+
+        # Records of a route are dropped oldest first so the record is at
+        # the front of each of its index entries
+        indexes = self.indexes.get((record.rule, record.method))
+        if indexes:
+            for index_key in record.index_keys():
+                records = indexes.get(index_key)
+                if records and records[0] is record:
+                    records.popleft()
+                    if not records:
+                        indexes.pop(index_key)
+
+    def _index(self, key, record):
+        """
+        Add a record to the indexes of its route
+        """
+        record.indexed = True
+        indexes = self.indexes.setdefault(key, {})
+        for index_key in record.index_keys():
+            if index_key[:2] in self._counted:
+                index_counts = self.index_counts.setdefault(key, {})
+                index_counts[index_key] = index_counts.get(index_key, 0) + 1
+            if not record.dropped:
+                records = indexes.get(index_key)
+                if records is None:
+                    records = indexes[index_key] = deque()
+                records.append(record)
+
+    def _catch_up(self):
+        """
+        Index the records added since the last query
+        """
+        while self.unindexed:
+            record = self.unindexed.popleft()
+            if not record.indexed:
+                self._index((record.rule, record.method), record)
+
+    def add(self, record):
+        """
+        Record a call, evicting old records beyond the retention limits
+        """
+        if record.seq is None:
+            self.seq += 1
+            record.seq = self.seq
+            if record._data is not None:
+                record._data['seq'] = self.seq
+        else:
+            self.seq = max(self.seq, record.seq)
+
+        key = (record.rule, record.method)
+        calls = self.calls.get(key)
+        if calls is None:
+            calls = deque(maxlen=self.limit(*key))
+            self.calls[key] = calls
+
+        if calls.maxlen is not None and len(calls) == calls.maxlen:
+            if calls.maxlen == 0:
+                record.dropped = True
+            else:
+                self._drop(calls[0])
+
+        calls.append(record)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.last_call = record
+        if record.dropped:
+            if self.indexed and self._counted:
+                self._index(key, record)
+            return
+
+        self.bytes += record.size
+        self.retained += 1
+        self.order.append(record)
+        if self.indexed:
+            self.unindexed.append(record)
+
+        if self.max_bytes is not None:
+            self._evict()
+        if len(self.order) > 2 * self.retained + 1024:
+            self.order = deque(r for r in self.order if not r.dropped)
+        if len(self.unindexed) > 2 * self.retained + 1024:
+            self.unindexed = deque(r for r in self.unindexed
+                                   if not r.indexed)
+
+    def _evict(self):
+        """
+        Drop the oldest records until history is within the byte budget
+        """
+        while self.bytes > self.max_bytes and self.order:
+            record = self.order.popleft()
+            if not record.dropped:
+                self.calls[record.rule, record.method].popleft()
+                self._drop(record)
+
+    def count(self, rule, method):
+        """
+        Return the number of calls made to a route and method
+        """
+        return self.counts.get((rule, method), 0)
+
+    def last(self, rule, method):
+        """
+        Return the latest call retained for a route and method or None
+        """
+        calls = self.calls.get((rule, method))
+        if calls:
+            return calls[-1]
+        return None
+
+    def since_seq(self, seq):
+        """
+        Return retained records numbered after seq in arrival order
+        """
+        result = []
+        for record in reversed(self.order):
+            if record.seq <= seq:
+                break
+            if not record.dropped:
+                result.append(record)
+        result.reverse()
+        return result
+
+    def _keys(self, rule, method):
+        """
+        Return the (route, method) keys matching, None matches any
+        """
+        if rule is not None and method is not None:
+            if (rule, method) in self.counts:
+                return [(rule, method)]
+            return []
+        return [key for key in self.counts.keys()
+                if (rule is None or key[0] == rule) and
+                (method is None or key[1] == method)]
+
+    def _filters(self, headers, params):
+        """
+        Return (kind, name, value) keys for header and parameter filters
+        """
+        filters = [('header', name.lower(), value)
+                   for name, value in (headers or {}).items()]
+        filters.extend(('param', name, value)
+                       for name, value in (params or {}).items())
+        return filters
+
+    def _candidates(self, key, filters):
+        """
+        Return the smallest set of retained records of a route which can
+        match all filters, in arrival order
+        """
+        candidates = self.calls.get(key, ())
+        if filters and self.indexed:
+            indexes = self.indexes.get(key, {})
+            candidates = min([indexes.get(f, ()) for f in filters], key=len)
+            if len(filters) == 1:
+                return candidates
+
+        if filters:
+            filters = set(filters)
+            candidates = [r for r in candidates
+                          if filters.issubset(r.index_keys())]
+        return candidates
+
+    def query(self, rule=None, method=None, headers=None, params=None,
+              since=None, until=None):
+        """
+        Return retained records matching all filters in arrival order
+
+        headers and params are dicts of values to match, since and until
+        limit the arrival time. None matches any route or method
+        """
+        filters = self._filters(headers, params)
+        if filters and self.indexed:
+            self._catch_up()
+        result = []
+        for key in self._keys(rule, method):
+            candidates = self._candidates(key, filters)
+            # Records are stored as they finish reading their body, a slow
+            # upload is stored after calls which arrived later, so every
+            # candidate is checked against the window
+            if since is not None or until is not None:
+                candidates = [r for r in candidates
+                              if (since is None or r.time >= since) and
+                              (until is None or r.time <= until)]
+            result.extend(candidates)
+
+        if len(result) > 1 and (rule is None or method is None):
+            result.sort(key=lambda r: r.time)
+        return result
+
+    def query_count(self, rule=None, method=None, headers=None, params=None,
+                    since=None, until=None):
+        """
+        Return the number of calls matching all filters
+
+        Counts include evicted calls when filtering on nothing or on one of
+        the counted headers or parameters without a time window, otherwise
+        retained calls are counted
+        """
+        filters = self._filters(headers, params)
+        exact = not filters or (len(filters) == 1 and self.indexed and
+                                filters[0][:2] in self._counted)
+        if since is None and until is None and exact:
+            if filters:
+                self._catch_up()
+            total = 0
+            for key in self._keys(rule, method):
+                if filters:
+                    total += self.index_counts.get(key, {}).get(filters[0], 0)
+                else:
+                    total += self.counts[key]
+            return total
+
+        return len(self.query(rule, method, headers, params, since, until))
+
+    def as_dict(self):
+        """
+        Return retained calls in the format {route: {method: [request]}}
+        """
+        result = {}
+        for (rule, method), calls in self.calls.items():
+            result.setdefault(rule, {})[method] = [r.as_dict() for r in calls]
+        return result
+
+    def counts_dict(self):
+        """
+        Return call counts in the format {route: {method: count}}
+        """
+        result = {}
+        for (rule, method), count in self.counts.items():
+            result.setdefault(rule, {})[method] = count
+        return result
+
+    def load(self, calls, last_call=None, counts=None):
+        """
+        Seed history from the format returned by as_dict and counts_dict,
+        records keep their sequence numbers
+        """
+        self.clear()
+        records = [CallRecord(rule, method, request,
+                              time=request.get('time'),
+                              seq=request.get('seq'))
+                   for rule, methods in calls.items()
+                   for method, requests in methods.items()
+                   for request in requests]
+        records.sort(key=lambda r: (r.seq is None, r.seq, r.time))
+        for record in records:
+            self.add(record)
+
+        self.load_counts(counts or {})
+
+        if last_call is not None:
+            self.last_call = CallRecord(None, None, last_call)
+
+    def load_counts(self, counts):
+        """
+        Set call counts from the format returned by counts_dict, index
+        counts of evicted calls are not carried over
+        """
+        for rule, methods in counts.items():
+            for method, count in methods.items():
+                self.counts[rule, method] = count
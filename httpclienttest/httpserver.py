@@ -1,22 +1,131 @@
+import gc
+import hashlib
 import multiprocessing
+import signal
+import sys
+import tempfile
+import threading
 import time
-from random import randint
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
 import json
 import bottle
 import requests
 
+from history import CallHistory, CallRecord, CapturedRequest
+from wsgi import SERVERS, CLOCK, ARRIVAL, TIMING
+from clock import RealClock
+from router import RadixRouter, AppConfigRoute
+from stats import RouteStats, TimedResponse
+from cassettes import Cassette, CassetteWriter, request_key, HOP_HEADERS, \
+    response_headers
+
 
 class TestServerUtilityApiError(Exception):
 
     "Server utility API was not set up correctly"
 
+
+class TestServerControlError(Exception):
+
+    "Change could not be applied to the running server"
+
 LIST = 'get_call_list'
 LAST = 'get_last_call'
 GETROUTE = 'get_last_route'
 CLEAR = 'clear_calls'
 CLEARROUTE = 'clear_calls_route'
+COUNTS = 'get_call_counts'
+QUERY = 'query_calls'
+NEW = 'get_new_calls'
+STATS = 'get_route_stats'
+BATCH = 'run_batch'
+
+# Utility routes are served under this prefix, clear of the mocked API
+UTIL_PREFIX = '/_httpclienttest'
+
+# Size of the reads when spooling a request body
+SPOOL_CHUNK = 65536
+
+# Media type of the binary utility API encoding, pickled Python objects.
+# Unpickling runs code of whatever answers on the server port, which any
+# local user can bind once the server has stopped, so it is only asked for
+# when chosen
+PICKLE_TYPE = 'application/x-python-pickle'
+TRANSPORTS = {'pickle': '%s, application/json;q=0.5' % PICKLE_TYPE,
+              'json': 'application/json'}
+
+
+def new_session(transport='json'):
+    """
+    Return a session for utility API requests, a request on a connection
+    closed by a server restart is retried on a new one
+
+    transport is the encoding asked for, 'json' by default. 'pickle' keeps
+    Python types such as the urlparts namedtuple and is faster to encode
+    and decode, but trusts anything listening on the server port, only use
+    it on a machine without other users
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError('unknown transport %s' % transport)
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(max_retries=1))
+    session.headers['Accept'] = TRANSPORTS[transport]
+    return session
+
+
+def encode_pickle(result):
+    """
+    Return a utility result pickled without the memo, results are trees so
+    there are no shared references to track and this is several times
+    faster on large histories
+    """
+    out = StringIO()
+    pickler = pickle.Pickler(out, pickle.HIGHEST_PROTOCOL)
+    pickler.fast = 1
+    pickler.dump(result)
+    return out.getvalue()
+
+
+@contextmanager
+def paused_gc():
+    """
+    Pause the cyclic garbage collector for a block building many objects
+
+    Nothing built can be garbage before the block ends, so collections
+    triggered by allocating it only walk it, over and over
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def decode_response(resp):
+    """
+    Return the decoded body of a utility API response in either encoding,
+    raises ValueError if it is empty JSON
+    """
+    if not resp.headers.get('Content-Type', '').startswith(PICKLE_TYPE):
+        return json.loads(resp.content)
+
+    with paused_gc():
+        return pickle.loads(resp.content)
 
 
 class HttpTestServer(multiprocessing.Process):
@@ -26,45 +135,130 @@ class HttpTestServer(multiprocessing.Process):
     to query state
     """
 
-    def __init__(self, host='localhost', port=12345,
+    def __init__(self, host='localhost', port=0,
                  routes=None,
                  calls=None,
-                 last_call=None):
+                 last_call=None,
+                 session=None,
+                 server='threaded',
+                 counts=None,
+                 max_calls=None,
+                 max_bytes=None,
+                 retention=None,
+                 indexed=True,
+                 counted=(),
+                 history=None,
+                 spool_bytes=None,
+                 clock=None,
+                 cassette=None,
+                 upstream=None):
+        """
+        server selects the WSGI server, one of 'threaded', 'wsgiref' (single
+        threaded) or 'gevent'
+
+        max_calls, max_bytes and retention limit the call history kept,
+        indexed and counted set how it is indexed, see CallHistory
+
+        history is a CallHistory to start from in place of calls, last_call
+        and counts. The server process records into a copy, the copy held
+        here is brought up to date incrementally by the utility functions
+
+        Request bodies larger than spool_bytes are streamed to a temporary
+        file for the route callback rather than kept in memory, history only
+        holds their size and SHA-256 digest
+
+        clock is the clock of injected delays and recorded timestamps, e.g.
+        a VirtualClock, the wall clock by default
+
+        cassette is the path of a cassette file answering requests which
+        match no route. Given upstream, a base URL such as
+        'http://api.example.com', those requests are instead passed on to
+        upstream and the exchanges recorded to the cassette
+        """
         multiprocessing.Process.__init__(self)
 
         self.host = host
         self.port = port
         self.base = 'http://%s:%s' % (host, port)
 
-        self.route_map = routes
+        self.route_map = {}
 
-        if routes is None:
-            self.route_map = {}
+        if routes is not None:
+            for path, methods in routes.items():
+                self.route_map[path] = dict(methods)
 
-        self.calls = calls
+        self.spool_bytes = spool_bytes
+        self.cassette = cassette
+        self.upstream = upstream
+        self._cassette = None
+        self.history_options = {'max_calls': max_calls,
+                                'max_bytes': max_bytes,
+                                'retention': retention,
+                                'indexed': indexed,
+                                'counted': counted}
+        self.history = history
+        if history is None:
+            self.history = CallHistory(**self.history_options)
+            self.history.load(calls or {}, last_call, counts)
 
-        if calls is None:
-            self.calls = {}
+        # Timing of the requests served by the running server, it is not
+        # kept across restarts
+        self.stats = RouteStats()
 
-        self.app = bottle.default_app()
+        self.app = self._new_app()
+        # Routes of the live app by (rule, method)
+        self._routes = {}
 
-        self.last_call = last_call
+        # Guards route and call history state shared with the control thread
+        self.lock = threading.RLock()
+        # Notified as each call is recorded
+        self.recorded = threading.Condition(self.lock)
 
-        self.util_routes = {LIST: {'path': '/getcalls',
+        self._open_control()
+
+        if server not in SERVERS:
+            raise ValueError('unknown server %s' % server)
+        self.adapter = SERVERS[server](host=host, port=port,
+                                       ready=self._server_ready)
+        self.clock = clock or RealClock(self.adapter.sleep)
+
+        # Keep-alive connections for the utility API requests
+        self.session = session
+        if session is None:
+            self.session = new_session()
+
+        self.util_routes = {LIST: {'path': UTIL_PREFIX + '/getcalls',
                                    'util_func': self._getcalls,
                                    'call_func': self._get_call_list},
-                            LAST: {'path': '/getlast',
+                            LAST: {'path': UTIL_PREFIX + '/getlast',
                                    'util_func': self._getlast,
                                    'call_func': self._get_last_call},
-                            GETROUTE: {'path': '/getreq',
+                            GETROUTE: {'path': UTIL_PREFIX + '/getreq',
                                        'util_func': self._getreq,
                                        'call_func': self._get_last_request},
-                            CLEAR: {'path': '/clearlist',
+                            CLEAR: {'path': UTIL_PREFIX + '/clearlist',
                                     'util_func': self._clearlist,
                                     'call_func': self._clear_calls},
-                            CLEARROUTE: {'path': '/clearroute',
+                            CLEARROUTE: {'path': UTIL_PREFIX + '/clearroute',
                                          'util_func': self._clearroute,
-                                         'call_func': self._clear_route}}
+                                         'call_func': self._clear_route},
+                            COUNTS: {'path': UTIL_PREFIX + '/getcounts',
+                                     'util_func': self._getcounts,
+                                     'call_func': self._get_call_counts},
+                            QUERY: {'path': UTIL_PREFIX + '/query',
+                                    'util_func': self._query,
+                                    'call_func': self._query_calls},
+                            NEW: {'path': UTIL_PREFIX + '/getnew',
+                                  'util_func': self._getnew,
+                                  'call_func': self._get_new_calls},
+                            STATS: {'path': UTIL_PREFIX + '/stats',
+                                    'util_func': self._getstats,
+                                    'call_func': self._get_route_stats},
+                            BATCH: {'path': UTIL_PREFIX + '/batch',
+                                    'method': 'POST',
+                                    'util_func': self._batch,
+                                    'call_func': self._post_batch}}
+        self._place_util_routes()
 
         ################ util route handlers ################
     def _getlast(self):
@@ -74,7 +268,11 @@ class HttpTestServer(multiprocessing.Process):
         example URI::
         http://localhost:12345/getlast
         """
-        return self.last_call
+        with self.lock:
+            last_call = self.history.last_call
+        if last_call is not None:
+            return last_call.as_dict()
+        return None
 
     def _getcalls(self):
         """
@@ -83,7 +281,94 @@ class HttpTestServer(multiprocessing.Process):
         example URI::
         http://localhost:1234/getcals
         """
-        return self.calls
+        with self.lock:
+            return self.history.as_dict()
+
+    def _getnew(self):
+        """
+        Mapped to a Bottle route to get the calls recorded after a sequence
+        number, as [route, method, size, request] entries in arrival order
+
+        example URI::
+        http://localhost:12345/getnew?after=42
+        """
+        try:
+            after = int(bottle.request.query.get('after', 0))
+        except ValueError:
+            msg = "Invalid request, after must be a sequence number"
+            return bottle.HTTPResponse(body=msg, status=400)
+
+        with self.lock:
+            records = self.history.since_seq(after)
+            return {'calls': [[r.rule, r.method, r.size, r.as_dict()]
+                              for r in records]}
+
+    def _getcounts(self):
+        """
+        Mapped to a Bottle route to get the number of calls made to each
+        route, including calls no longer kept in history
+
+        example URI::
+        http://localhost:12345/getcounts
+        """
+        with self.lock:
+            return self.history.counts_dict()
+
+    def _getstats(self):
+        """
+        Mapped to a Bottle route to get the request timing of each route, as
+        histograms of callback and total handling time in microseconds
+
+        example URI::
+        http://localhost:12345/stats
+        """
+        with self.lock:
+            return self.stats.as_dict()
+
+    def _batch(self):
+        """
+        Mapped to a Bottle route to run a list of lookups in one request,
+        the body is a JSON list of ops, see _run_batch
+
+        example URI::
+        http://localhost:12345/batch
+        """
+        ops = bottle.request.json
+        if not isinstance(ops, list):
+            msg = "Invalid request, requires a JSON list of ops"
+            return bottle.HTTPResponse(body=msg, status=400)
+        try:
+            return {'results': self._run_batch(ops)}
+        except (KeyError, TypeError, ValueError) as e:
+            return bottle.HTTPResponse(body='Invalid op: %s' % e, status=400)
+
+    def _run_batch(self, ops):
+        """
+        Return the result of each op, one of
+            ['last_route', path, method] - the last call to a route
+            ['query', {path, method, headers, params, since, until, count}]
+                - matching calls or their number, see _query_calls
+            ['stats'] - the request timing of each route
+        """
+        results = []
+        for op in ops:
+            if op[0] == 'last_route':
+                results.append(self._last_request('/' + op[1].lstrip('/'),
+                                                  op[2]))
+            elif op[0] == 'query':
+                kwargs = dict(op[1])
+                count = kwargs.pop('count', False)
+                path = kwargs.pop('path', None)
+                if path is not None:
+                    kwargs['rule'] = '/' + path.lstrip('/')
+                result = self._run_query(count, kwargs)
+                results.append(result['count'] if count else result['calls'])
+            elif op[0] == 'stats':
+                with self.lock:
+                    results.append(self.stats.as_dict())
+            else:
+                raise ValueError(op[0])
+        return results
 
     def _clearroute(self):
         """
@@ -101,8 +386,7 @@ class HttpTestServer(multiprocessing.Process):
             return bottle.HTTPResponse(body=msg, status=400)
         path = '/%s' % path
 
-        if path in self.calls.keys() and method in self.calls[path].keys():
-            self.calls[path].pop(method)
+        self._clear_route_calls(path, method)
         return
 
     def _clearlist(self):
@@ -112,7 +396,9 @@ class HttpTestServer(multiprocessing.Process):
         example URI::
         http://localhost:12345/clearlist
         """
-        self.calls = {}
+        with self.lock:
+            self.history.clear()
+            self.stats.clear()
 
         return True
 
@@ -133,37 +419,187 @@ class HttpTestServer(multiprocessing.Process):
 
         path = '/%s' % path
 
-        if path in self.calls.keys() and method in self.calls[path].keys():
-            return self.calls[path][method][-1]
+        return self._last_request(path, method)
+
+    def _query(self):
+        """
+        Mapped to a Bottle route to query call history, all params are
+        optional. Headers and query params to match are given with header.
+        and param. prefixes, count=1 returns only the number of calls
+
+        example URI::
+        http://localhost:12345/query?path=blah&method=GET&header.Accept=*/*
+        """
+        params = bottle.request.query
+        kwargs = {'method': params.get('method'),
+                  'headers': {},
+                  'params': {}}
+        if 'path' in params:
+            kwargs['rule'] = '/%s' % params['path']
+
+        try:
+            for name in ('since', 'until'):
+                if name in params:
+                    kwargs[name] = float(params[name])
+        except ValueError:
+            msg = "Invalid request, since and until must be timestamps"
+            return bottle.HTTPResponse(body=msg, status=400)
+
+        for name, value in params.allitems():
+            if name.startswith('header.'):
+                kwargs['headers'][name[7:]] = value
+            elif name.startswith('param.'):
+                kwargs['params'][name[6:]] = value
 
+        return self._run_query(params.get('count') == '1', kwargs)
+
+    def _run_query(self, count, kwargs):
+        """
+        Return the number of matching calls or the matching calls
+        """
+        with self.lock:
+            if count:
+                return {'count': self.history.query_count(**kwargs)}
+            records = self.history.query(**kwargs)
+        return {'calls': [r.as_dict() for r in records]}
+
+    def _last_request(self, path, method):
+        """
+        Return the latest call to a route or None if not called
+        """
+        with self.lock:
+            record = self.history.last(path, method)
+        if record is not None:
+            return record.as_dict()
         return None
 
+    def _clear_route_calls(self, path, method):
+        """
+        Remove the call history of a route
+        """
+        with self.lock:
+            self.history.clear(path, method)
+            self.stats.clear(path, method)
+
     ############## util functions returned to caller ###########
     def _get_call_list(self):
         """
-        Generate a request to get all calls from server
+        Return all calls made to the server, only calls made since the
+        last request are fetched
+        """
+        with self.lock:
+            return self.sync_history().as_dict()
+
+    def _get_new_calls(self, after=0):
+        """
+        Generate a request to get the calls recorded after a sequence number
         """
-        resp = requests.get(self.base + self.util_routes[LIST]['path'])
+        resp = self.session.get(self.base + self.util_routes[NEW]['path'],
+                                params={'after': after})
 
         if resp.status_code != 200:
-            raise TestServerUtilityApiError('get history API not configured')
+            raise TestServerUtilityApiError('new calls API not configured')
 
-        try:
-            return json.loads(resp.content)
-        except ValueError:
-            return None
+        return decode_response(resp)['calls']
+
+    def sync_history(self):
+        """
+        Bring the local copy of call history up to date with the server and
+        return it
+        """
+        with self.lock:
+            for rule, method, size, request in \
+                    self._get_new_calls(self.history.seq):
+                self.history.add(CallRecord(rule, method, request, size,
+                                            request['time'], request['seq']))
+        return self.history
+
+    def _get_call_counts(self):
+        """
+        Generate a request to get the number of calls made to each route
+        """
+        resp = self.session.get(self.base + self.util_routes[COUNTS]['path'])
+
+        if resp.status_code != 200:
+            raise TestServerUtilityApiError('call count API not configured')
+
+        return decode_response(resp)
+
+    def _get_route_stats(self):
+        """
+        Generate a request to get the request timing of each route
+        """
+        resp = self.session.get(self.base + self.util_routes[STATS]['path'])
+
+        if resp.status_code != 200:
+            raise TestServerUtilityApiError('route stats API not configured')
+
+        return decode_response(resp)
+
+    def _post_batch(self, ops):
+        """
+        Generate a request running a list of lookups, see _run_batch
+        """
+        resp = self.session.post(self.base + self.util_routes[BATCH]['path'],
+                                 json=ops)
+
+        if resp.status_code != 200:
+            raise TestServerUtilityApiError('batch API not configured')
+
+        return decode_response(resp)['results']
+
+    def _query_params(self, path, method, headers, params, since, until,
+                      count):
+        """
+        Return the query string params for a call history query
+        """
+        query = {}
+        if path is not None:
+            query['path'] = path.lstrip('/')
+        if method is not None:
+            query['method'] = method
+        for name, value in (headers or {}).items():
+            query['header.%s' % name] = value
+        for name, value in (params or {}).items():
+            query['param.%s' % name] = value
+        if since is not None:
+            query['since'] = repr(since)
+        if until is not None:
+            query['until'] = repr(until)
+        if count:
+            query['count'] = '1'
+        return query
+
+    def _query_calls(self, path=None, method=None, headers=None, params=None,
+                     since=None, until=None, count=False):
+        """
+        Generate a request to query call history, returns the number of
+        matching calls if count is set or the matching calls
+        """
+        query = self._query_params(path, method, headers, params,
+                                   since, until, count)
+        resp = self.session.get(self.base + self.util_routes[QUERY]['path'],
+                                params=query)
+
+        if resp.status_code != 200:
+            raise TestServerUtilityApiError('query API not configured')
+
+        result = decode_response(resp)
+        if count:
+            return result['count']
+        return result['calls']
 
     def _get_last_call(self):
         """
         Generate a request to get last call made to server
         """
-        resp = requests.get(self.base + self.util_routes[LAST]['path'])
+        resp = self.session.get(self.base + self.util_routes[LAST]['path'])
 
         if resp.status_code != 200:
             raise TestServerUtilityApiError('last call API not configured')
 
         try:
-            return json.loads(resp.content)
+            return decode_response(resp)
         except ValueError:
             return None
 
@@ -177,12 +613,12 @@ class HttpTestServer(multiprocessing.Process):
         query_string = '?path=%s&method=%s' % (path, method)
         url = self.base + self.util_routes[GETROUTE]['path'] + query_string
 
-        resp = requests.get(url)
+        resp = self.session.get(url)
 
         if resp.status_code != 200:
             raise TestServerUtilityApiError('last route API not configured')
         try:
-            return json.loads(resp.content)
+            return decode_response(resp)
         except ValueError:
             return None
 
@@ -198,33 +634,74 @@ class HttpTestServer(multiprocessing.Process):
         url = self.base + self.util_routes[CLEARROUTE]['path'] \
                         + query_string
 
-        resp = requests.get(url)
+        resp = self.session.get(url)
         if resp.status_code != 200:
             raise TestServerUtilityApiError('clear route API not configured')
 
+        with self.lock:
+            self.history.clear('/' + path, method)
         return True
 
     def _clear_calls(self):
         """
         Generate request to clear call history
         """
-        requests.get(self.base + self.util_routes[CLEAR]['path'])
+        self.session.get(self.base + self.util_routes[CLEAR]['path'])
+        with self.lock:
+            self.history.clear()
         return True
 
+    def _place_util_routes(self):
+        """
+        Move the utility paths taken by routes, each is prefixed with the
+        first free number, /_httpclienttest/query becomes
+        /0_httpclienttest/query. Done before the server starts so both
+        processes agree on the paths
+        """
+        for detail in self.util_routes.values():
+            args = detail.get('args', ())
+
+            path = detail['path']
+            prefix = 0
+            while detail['path'] % args in self.route_map:
+                detail['path'] = '/%d%s' % (prefix, path[1:])
+                prefix += 1
+
+    def _check_util_routes(self, routes):
+        """
+        Raise TestServerControlError if routes take a utility path, the
+        running server can not move its utility routes
+        """
+        for detail in self.util_routes.values():
+            path = detail['path'] % detail.get('args', ())
+            if path in routes:
+                raise TestServerControlError(
+                    'route %s is taken by the utility API' % path)
+
     def _add_util_routes(self):
         """
-        Add utility routes to test server, randomise name if routes taken
+        Add utility routes to test server
         """
         for detail in self.util_routes.values():
             args = detail.get('args', ())
+            self._install_route(detail['path'] % args,
+                                detail.get('method', 'GET'),
+                                self._negotiate(detail['util_func']))
 
-            while detail['path'] % args in self.route_map.keys():
-                detail['path'] = '/%d%s' % (randint(0, 9), detail['path'][1:])
+    def _negotiate(self, util_func):
+        """
+        Return util_func encoding its result for the client, pickled if
+        the client accepts PICKLE_TYPE, otherwise left to Bottle as JSON
+        """
+        def encoded_func(*a, **kwargs):
+            result = util_func(*a, **kwargs)
+            if isinstance(result, bottle.BaseResponse) or \
+                    PICKLE_TYPE not in bottle.request.get_header('Accept', ''):
+                return result
+            bottle.response.content_type = PICKLE_TYPE
+            return encode_pickle(result)
 
-            new_route = bottle.Route(self.app, detail['path'] % args,
-                                     'GET',
-                                     detail['util_func'])
-            self.app.add_route(new_route)
+        return encoded_func
 
     def build_func(self, callback=None):
         """
@@ -232,63 +709,635 @@ class HttpTestServer(multiprocessing.Process):
         the callback itself if not callable
         """
         def default_func(*a, **kwargs):
+            # Capture the raw request, decoding is left until it is queried
             route = bottle.request.route
-            request = {'args': kwargs,
-                       'method': bottle.request.method,
-                       'headers': dict(bottle.request.headers),
-                       'query_params': dict(bottle.request.query),
-                       'urlparts': bottle.request.urlparts,
-                       'query_string': bottle.request.query_string,
-                       'body': bottle.request.json}
-
-            path_dict = self.calls.get(route.rule, {})
-            method_list = path_dict.get(route.method, [])
-            method_list.append(request)
-            self.last_call = method_list[-1]
-            path_dict[route.method] = method_list
-            self.calls[route.rule] = path_dict
+            environ = bottle.request.environ
+            captured = {'wsgi.url_scheme': environ.get('wsgi.url_scheme')}
+            size = 0
+            for key, value in environ.iteritems():
+                if key[0].isupper():
+                    captured[key] = value
+                    if key.startswith('HTTP_'):
+                        size += len(key) + len(value)
+
+            body, body_size, digest = self._read_body()
+            size += len(body or '') + len(environ.get('QUERY_STRING', ''))
+
+            record = CallRecord(route.rule, route.method, None, size,
+                                environ[ARRIVAL],
+                                request=CapturedRequest(captured, kwargs,
+                                                        body, body_size,
+                                                        digest))
 
+            with self.lock:
+                self.history.add(record)
+                self.recorded.notify_all()
+
+            environ[TIMING] = (0, body_size)
             if callback:
                 if hasattr(callback, '__call__'):
-                    return callback(*a, **kwargs)
+                    start = self.clock.time()
+                    try:
+                        return callback(*a, **kwargs)
+                    finally:
+                        environ[TIMING] = (self.clock.time() - start,
+                                           body_size)
                 return callback
             return
 
         return default_func
 
+    def _read_body(self):
+        """
+        Return the body of the current request, its size and digest
+
+        Bodies larger than spool_bytes, or chunked bodies which turn out to
+        be, are streamed through a temporary file which replaces the request
+        body for the callback. None is returned for the body with the size
+        and SHA-256 digest, otherwise the digest is left to be computed when
+        the record is decoded
+        """
+        request = bottle.request
+        if request.content_length <= 0 and not request.chunked:
+            return '', 0, None
+        if self.spool_bytes is None or \
+                0 <= request.content_length <= self.spool_bytes:
+            body = request.body.read()
+            return body, len(body), None
+
+        environ = request.environ
+        read = environ['wsgi.input'].read
+        if request.chunked:
+            parts = request._iter_chunked(read, SPOOL_CHUNK)
+        else:
+            parts = request._iter_body(read, SPOOL_CHUNK)
+
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part)
+            spool.write(part)
+        body_size = spool.tell()
+        spool.seek(0)
+        environ['wsgi.input'] = environ['bottle.request.body'] = spool
+
+        if body_size <= self.spool_bytes:
+            body = spool.read()
+            spool.seek(0)
+            return body, body_size, None
+        return None, body_size, digest.hexdigest()
+
+    ############## live route control ###########
+    def _new_app(self):
+        """
+        Return an empty Bottle app routing with a RadixRouter
+        """
+        app = bottle.Bottle()
+        # Bottle refuses to rebind attributes set in its constructor
+        app.__dict__['router'] = RadixRouter()
+        return app
+
+    def _build_app(self):
+        """
+        Return a new Bottle app serving the route map and utility routes
+        """
+        self.app = self._new_app()
+        self._routes = {}
+
+        with paused_gc():
+            for path in self.route_map.keys():
+                for method, func in self.route_map[path].items():
+                    self._install_route(path, method, self.build_func(func))
+
+        self._add_util_routes()
+        if self.cassette:
+            self.app.error_handler[404] = self._replay
+            self.app.error_handler[405] = self._replay
+        return self.app
+
+    ############## cassettes ###########
+    def _open_cassette(self):
+        """
+        Open the cassette for replay, or for recording if upstream is set
+        """
+        if not self.cassette:
+            return
+        if self.upstream:
+            self._cassette = CassetteWriter(self.cassette)
+            self._upstream_session = requests.Session()
+        else:
+            self._cassette = Cassette(self.cassette)
+
+    def _close_cassette(self):
+        if self._cassette is not None:
+            self._cassette.close()
+            self._cassette = None
+
+    def _replay(self, error):
+        """
+        Error handler of requests matching no route, answers them from the
+        cassette or records them from upstream. Errors raised by route
+        callbacks are left as they are
+        """
+        request = bottle.request
+        environ = request.environ
+        if self._cassette is None or TIMING in environ:
+            return self.app.default_error_handler(error)
+
+        body = request.body.read()
+        query_string = environ.get('QUERY_STRING', '')
+        key = request_key(request.method, request.path, query_string, body,
+                          request.content_type)
+        if self.upstream:
+            return self._record(key, query_string, body)
+
+        recorded = self._cassette.lookup(key)
+        if recorded is None:
+            return self.app.default_error_handler(error)
+        status, headers, body = recorded
+        return bottle.HTTPResponse(body, status, headers)
+
+    def _record(self, key, query_string, body):
+        """
+        Pass the current request on to upstream and record the exchange
+        """
+        request = bottle.request
+        url = self.upstream.rstrip('/') + request.path
+        if query_string:
+            url += '?' + query_string
+        headers = dict((name, value)
+                       for name, value in request.headers.items()
+                       if name.lower() not in HOP_HEADERS and
+                       name.lower() != 'host')
+        try:
+            resp = self._upstream_session.request(request.method, url,
+                                                  data=body, headers=headers,
+                                                  allow_redirects=False)
+        except requests.RequestException as e:
+            return bottle.HTTPResponse(status=502,
+                                       body='upstream failed: %s' % e)
+
+        headers = response_headers(resp.headers.items())
+        self._cassette.add(key, request.method, request.path, query_string,
+                           resp.status_code, headers, resp.content)
+        return bottle.HTTPResponse(resp.content, resp.status_code, headers)
+
+    def _install_route(self, rule, method, callback):
+        """
+        Route rule and method to callback in the live app, replacing any
+        route for them
+
+        Routes are added to the router directly and kept by (rule, method),
+        Bottle's list of routes would have to be searched to replace one
+        """
+        route = AppConfigRoute(self.app, rule, method, callback)
+        self._routes[rule, method] = route
+        self.app.router.add(rule, method, route)
+
+    def _add_route(self, path, method, func):
+        """
+        Add a route to the live app, replacing any route for path and method
+        """
+        self._install_route(path, method, self.build_func(func))
+
+    def _remove_route(self, path, method):
+        """
+        Remove a route from the live app
+        """
+        if self._routes.pop((path, method), None) is not None:
+            self.app.router.remove(path, method)
+
+    def _dispatch(self, environ, start_response):
+        """
+        WSGI entry point, passes requests to the current app
+        """
+        environ[CLOCK] = self.clock
+        environ[ARRIVAL] = self.clock.time()
+        result = self.app(environ, start_response)
+        if TIMING not in environ:
+            return result
+        if isinstance(result, list):
+            self._record_timing(environ, sum(len(part) for part in result))
+            return result
+        return TimedResponse(result,
+                             lambda sent: self._record_timing(environ, sent))
+
+    def _record_timing(self, environ, sent):
+        """
+        Add a request to the timing of its route once the response is sent
+        """
+        route = environ['bottle.route']
+        callback, received = environ[TIMING]
+        arrival = environ[ARRIVAL]
+        with self.lock:
+            self.stats.add(route.rule, route.method, arrival, callback,
+                           self.clock.time() - arrival, received, sent)
+
+    def _apply_update(self, added, removed, clean, cleared=()):
+        """
+        Apply a route map change and clear call history, called within the
+        server process
+        """
+        with self.lock:
+            for path, method in removed:
+                methods = self.route_map.get(path, {})
+                methods.pop(method, None)
+                if not methods:
+                    self.route_map.pop(path, None)
+                self._remove_route(path, method)
+
+            for path, methods in added.items():
+                for method, func in methods.items():
+                    self.route_map.setdefault(path, {})[method] = func
+                    self._add_route(path, method, func)
+
+            if clean:
+                self.history.clear()
+                self.stats.clear()
+            for path, method in cleared:
+                self.history.clear(path, method)
+                self.stats.clear(path, method)
+        return True
+
+    def _apply_reset(self, routes, history, clock):
+        """
+        Replace the route map, call history and clock, called within the
+        server process
+        """
+        with self.lock:
+            removed = [(path, method)
+                       for path, methods in self.route_map.items()
+                       for method in methods.keys()]
+            self._apply_update(routes or {}, removed, False)
+            self.history = history
+            self.stats.clear()
+            self.clock = clock or RealClock(self.adapter.sleep)
+        return True
+
+    def _apply_advance(self, seconds):
+        """
+        Advance the virtual clock, called within the server process
+        """
+        if not self.clock.virtual:
+            raise ValueError('server clock is not virtual')
+        self.clock.advance(seconds)
+        return self.clock.time()
+
+    def _apply_wait(self, path, method, count, timeout):
+        """
+        Wait until count calls to a route have been recorded or timeout
+        seconds pass, return the number of calls. Called within the server
+        process
+        """
+        deadline = time.time() + timeout
+        # Condition.wait with a timeout polls, a timer wakes the waiter at
+        # the deadline instead so recorded calls wake it at once
+        timer = threading.Timer(timeout, self._wake)
+        timer.daemon = True
+        timer.start()
+        try:
+            with self.recorded:
+                while self.history.count(path, method) < count and \
+                        time.time() < deadline:
+                    self.recorded.wait()
+                return self.history.count(path, method)
+        finally:
+            timer.cancel()
+
+    def _wake(self):
+        with self.recorded:
+            self.recorded.notify_all()
+
+    def _control_loop(self):
+        """
+        Serve control requests from the parent until the pipe is closed
+        """
+        while True:
+            try:
+                data = self._child_control.recv_bytes()
+            except (EOFError, IOError):
+                return
+            op, args = pickle.loads(data)
+            try:
+                result = ('ok', getattr(self, '_apply_%s' % op)(*args))
+            except Exception as e:
+                result = ('error', repr(e))
+            self._child_control.send(result)
+
+    def _send_control(self, op, *args):
+        """
+        Send a control request to the server process and wait for the reply
+        """
+        try:
+            data = pickle.dumps((op, args), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError) as e:
+            raise TestServerControlError('unable to send %s: %s' % (op, e))
+
+        with self._control_lock:
+            try:
+                self._control.send_bytes(data)
+                status, result = self._control.recv()
+            except (EOFError, IOError) as e:
+                raise TestServerControlError('control channel closed: %s' % e)
+
+        if status != 'ok':
+            raise TestServerControlError(result)
+        return result
+
+    def update_routes(self, added, removed, clean=False, cleared=()):
+        """
+        Modify the routes of the running server in place
+
+        added should be of format {route: {method: function}}, removed a list
+        of (route, method) pairs. If clean is set call history is cleared,
+        otherwise the history of the (route, method) pairs in cleared.
+        Raises TestServerControlError if the change cannot be sent, e.g. the
+        callbacks can not be pickled or a route takes a utility path
+        """
+        self._check_util_routes(added)
+        result = self._send_control('update', added, removed, clean,
+                                    list(cleared))
+        with self.lock:
+            if clean:
+                self.history.clear()
+            for path, method in cleared:
+                self.history.clear(path, method)
+        return result
+
+    def reset(self, routes=None, history=None, clock=None):
+        """
+        Replace the route map, call history and clock of the running server,
+        the server starts from a copy of history or an empty history and a
+        copy of clock or the wall clock. Raises TestServerControlError as
+        update_routes does
+        """
+        self._check_util_routes(routes or {})
+        if history is None:
+            history = CallHistory(**self.history_options)
+        result = self._send_control('reset', routes, history, clock)
+        with self.lock:
+            self.history = history
+            self.clock = clock or RealClock(self.adapter.sleep)
+        return result
+
+    def advance_clock(self, seconds):
+        """
+        Advance the virtual clock of the server by seconds, delayed
+        responses due by then are released
+        """
+        now = self._send_control('advance', seconds)
+        self.clock.advance_to(now)
+        return now
+
+    def wait_for_calls(self, path, method='GET', count=1, timeout=5):
+        """
+        Wait until the server has recorded count calls to a route, or until
+        timeout seconds have passed, and return the number of calls. Returns
+        as soon as the call is recorded without polling, other route
+        changes are held until then
+        """
+        return self._send_control('wait', path, method, count, timeout)
+
+    def _serve(self):
+        """
+        Build the routes and serve requests until shut down
+        """
+        self._build_app()
+        try:
+            self._open_cassette()
+            bottle.run(app=self._dispatch, server=self.adapter, quiet=True)
+        except Exception as e:
+            if self.adapter.listening:
+                raise
+            self._server_failed(e)
+        finally:
+            self._close_cassette()
+
+    def _open_control(self):
+        """
+        Open the control channel used to modify the routes of the running
+        server
+        """
+        self._control, self._child_control = multiprocessing.Pipe()
+        self._control_lock = threading.Lock()
+
+    def _server_ready(self, port):
+        """
+        Report the bound port to the parent process
+        """
+        self._child_control.send(('ready', port))
+
+    def _server_failed(self, error):
+        """
+        Report a failure to start to the parent process
+        """
+        self._child_control.send(('error', str(error)))
+
+    def terminate(self):
+        """
+        Stop the server process and close the control pipe
+        """
+        multiprocessing.Process.terminate(self)
+        self._control.close()
+
+    def _set_port(self, port):
+        self.port = port
+        self.base = 'http://%s:%s' % (self.host, port)
+
     def run(self):
         """
         Build the routes then run the service
         """
-        for path in self.route_map.keys():
-            for method, func in self.route_map[path].items():
-                new_route = bottle.Route(self.app,
-                                         path,
-                                         method,
-                                         self.build_func(func))
-                self.app.add_route(new_route)
+        control = threading.Thread(target=self._control_loop)
+        control.daemon = True
+        control.start()
 
-        self._add_util_routes()
-        bottle.run(app=self.app, host=self.host, port=self.port, quiet=True)
+        # Unwind on terminate so a cassette being recorded gets its index
+        if self.upstream:
+            signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
 
-    def start(self):
+        self._serve()
+
+    def start(self, timeout=3):
         """
-        Start the server
+        Start the server, returns once it is listening
         """
         multiprocessing.Process.start(self)
-        timeout = 3
-        e_time = time.time() + timeout
-        conn = None
-        test_url = 'http://%s:%s%s' % (self.host,
-                                       self.port,
-                                       self.util_routes[LIST]['path'])
-
-        while not conn:
-            try:
-                conn = requests.get(test_url)
-            except ConnectionError:
-                time.sleep(0.5)
-                if time.time() >= e_time:
-                    raise ConnectionError('unable to connect to test server')
+        # Only the child uses its end, closing it here means a child which
+        # dies is seen as EOF rather than waiting for the timeout
+        self._child_control.close()
+
+        if not self._control.poll(timeout):
+            raise ConnectionError('unable to connect to test server')
+        try:
+            status, result = self._control.recv()
+        except EOFError:
+            raise ConnectionError('test server exited on start')
+        if status != 'ready':
+            raise ConnectionError('unable to start test server: %s' % result)
+
+        self._set_port(result)
+        return self, self.util_routes, self.host, self.port
+
+
+class ThreadedHttpTestServer(HttpTestServer):
+
+    """
+    Test server run on a background thread of the calling process
+
+    Route changes are applied directly and the utility functions read the
+    call history through the server lock rather than over HTTP
+    """
+
+    def __init__(self, *a, **kwargs):
+        HttpTestServer.__init__(self, *a, **kwargs)
+        self.thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+        self.util_routes[LIST]['call_func'] = self._local_call_list
+        self.util_routes[LAST]['call_func'] = self._local_last_call
+        self.util_routes[GETROUTE]['call_func'] = self._local_last_request
+        self.util_routes[CLEAR]['call_func'] = self._local_clear_calls
+        self.util_routes[CLEARROUTE]['call_func'] = self._local_clear_route
+        self.util_routes[COUNTS]['call_func'] = self._local_call_counts
+        self.util_routes[QUERY]['call_func'] = self._local_query_calls
+        self.util_routes[NEW]['call_func'] = self._local_new_calls
+        self.util_routes[STATS]['call_func'] = self._local_route_stats
+        self.util_routes[BATCH]['call_func'] = self._run_batch
+
+    ############## util functions returned to caller ###########
+    def _local_call_list(self):
+        """
+        Return a copy of all calls made to the server
+        """
+        with self.lock:
+            return self.history.as_dict()
+
+    def _local_new_calls(self, after=0):
+        """
+        Return the calls recorded after a sequence number, see
+        HttpTestServer._getnew
+        """
+        with self.lock:
+            return [[r.rule, r.method, r.size, r.as_dict()]
+                    for r in self.history.since_seq(after)]
+
+    def sync_history(self):
+        """
+        Return call history, the server records into it directly
+        """
+        return self.history
+
+    def _local_call_counts(self):
+        """
+        Return the number of calls made to each route
+        """
+        with self.lock:
+            return self.history.counts_dict()
+
+    def _local_route_stats(self):
+        """
+        Return the request timing of each route
+        """
+        with self.lock:
+            return self.stats.as_dict()
+
+    def _local_query_calls(self, path=None, method=None, headers=None,
+                           params=None, since=None, until=None, count=False):
+        """
+        Query call history, see HttpTestServer._query_calls
+        """
+        if path is not None:
+            path = '/' + path.lstrip('/')
+        result = self._run_query(count, {'rule': path,
+                                         'method': method,
+                                         'headers': headers,
+                                         'params': params,
+                                         'since': since,
+                                         'until': until})
+        if count:
+            return result['count']
+        return result['calls']
+
+    def _local_last_call(self):
+        """
+        Return the last call made to the server
+        """
+        with self.lock:
+            last_call = self.history.last_call
+        if last_call is not None:
+            return last_call.as_dict()
+        return None
+
+    def _local_last_request(self, path, method):
+        """
+        Return the last call for a specific route
+        """
+        return self._last_request('/' + path.lstrip('/'), method)
+
+    def _local_clear_route(self, path, method):
+        """
+        Clear call history for a route
+        """
+        self._clear_route_calls('/' + path.lstrip('/'), method)
+        return True
 
+    def _local_clear_calls(self):
+        """
+        Clear call history
+        """
+        with self.lock:
+            self.history.clear()
+            self.stats.clear()
+        return True
+
+    def _open_control(self):
+        """
+        Control requests are applied directly, there is no channel to open
+        """
+
+    def _send_control(self, op, *args):
+        """
+        Apply a control request directly
+        """
+        return getattr(self, '_apply_%s' % op)(*args)
+
+    def _server_ready(self, port):
+        self._set_port(port)
+        self._ready.set()
+
+    def _server_failed(self, error):
+        self._error = error
+        self._ready.set()
+
+    def start(self, timeout=3):
+        """
+        Start the server thread, returns once it is listening
+        """
+        self._ready.clear()
+        self._error = None
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        if not self._ready.wait(timeout):
+            raise ConnectionError('unable to connect to test server')
+        if self._error:
+            raise ConnectionError('unable to start test server: %s'
+                                  % self._error)
         return self, self.util_routes, self.host, self.port
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def terminate(self):
+        """
+        Stop the server thread
+        """
+        self.adapter.shutdown()
+        self.thread.join()
+
+
+ENGINES = {'process': HttpTestServer,
+           'thread': ThreadedHttpTestServer}
@@ -0,0 +1,118 @@
+import threading
+
+from httpserver import ENGINES, TestServerControlError
+
+
+class HttpTestServerPool(object):
+
+    """
+    Pool of started test servers kept idle so a server can be handed out
+    without waiting for a new one to start
+
+    Servers are given their route map and call history over the control
+    channel. When the routes can not be sent, e.g. a callback can not be
+    pickled, a new server is started and counted as a miss
+    """
+
+    def __init__(self, size=2, engine='process', server='threaded',
+                 spool_bytes=None, **history_options):
+        """
+        history_options are passed to the servers to limit call history,
+        see CallHistory. spool_bytes is the size above which request bodies
+        are spooled to disk
+        """
+        self.size = size
+        self.server_cls = ENGINES[engine]
+        self.server = server
+        self.spool_bytes = spool_bytes
+        self.history_options = history_options
+        self.idle = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.fill()
+
+    def fill(self):
+        """
+        Start servers until the pool holds size idle servers
+        """
+        while len(self.idle) < self.size:
+            server, _, _, _ = self._start_server()
+            with self.lock:
+                self.idle.append(server)
+
+    def acquire(self, routes=None, history=None, clock=None):
+        """
+        Return a running server for the routes, CallHistory and clock, in
+        the format returned by HttpTestServer.start
+        """
+        server = None
+        with self.lock:
+            if self.idle:
+                server = self.idle.pop()
+
+        if server is not None:
+            try:
+                server.reset(routes, history, clock)
+            except TestServerControlError:
+                self.release(server)
+            else:
+                with self.lock:
+                    self.hits += 1
+                return server, server.util_routes, server.host, server.port
+
+        with self.lock:
+            self.misses += 1
+        return self._start_server(routes, history, clock)
+
+    def _start_server(self, routes=None, history=None, clock=None):
+        """
+        Start a new server, daemonic so idle servers don't block exit
+        """
+        server = self.server_cls(routes=routes,
+                                 server=self.server,
+                                 history=history,
+                                 spool_bytes=self.spool_bytes,
+                                 clock=clock,
+                                 **self.history_options)
+        server.daemon = True
+        return server.start()
+
+    def release(self, server):
+        """
+        Return a server to the pool, it is stopped if the pool is full or
+        it can not be reset
+        """
+        with self.lock:
+            keep = len(self.idle) < self.size and server.is_alive()
+
+        if keep:
+            try:
+                server.reset()
+            except TestServerControlError:
+                keep = False
+
+        if keep:
+            with self.lock:
+                self.idle.append(server)
+        else:
+            server.terminate()
+
+    def stats(self):
+        """
+        Return the pool size and counters
+        """
+        return {'size': self.size,
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def close(self):
+        """
+        Stop all idle servers
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server in idle:
+            server.terminate()
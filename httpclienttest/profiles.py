@@ -0,0 +1,208 @@
+import bisect
+import math
+import random
+
+import bottle
+
+from clock import RealClock
+from wsgi import FAULT, CLOCK, ARRIVAL
+
+FAULT_MODES = ('error', 'reset', 'truncate', 'stall')
+
+
+class Normal(object):
+
+    """
+    Normally distributed delay in seconds, negative samples are 0
+    """
+
+    def __init__(self, mean, stddev):
+        self.mean = mean
+        self.stddev = stddev
+
+    def sample(self, rand):
+        return max(rand.normalvariate(self.mean, self.stddev), 0)
+
+
+class LogNormal(object):
+
+    """
+    Log-normally distributed delay in seconds with the given median, sigma
+    is the standard deviation of the log of the delay
+    """
+
+    def __init__(self, median, sigma):
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self, rand):
+        return rand.lognormvariate(math.log(self.median), self.sigma)
+
+
+class Percentiles(object):
+
+    """
+    Delay in seconds following a percentile table of the format
+    {percentile: delay}, e.g. {50: 0.01, 99: 0.2, 100: 1}. Delays between
+    the given percentiles are interpolated
+    """
+
+    def __init__(self, table):
+        points = sorted(table.items())
+        if points[0][0] > 0:
+            points.insert(0, (0, points[0][1]))
+        if points[-1][0] < 100:
+            points.append((100, points[-1][1]))
+        self.percentiles = [p for p, _ in points]
+        self.delays = [d for _, d in points]
+
+    def sample(self, rand):
+        percentile = rand.uniform(0, 100)
+        index = max(bisect.bisect_left(self.percentiles, percentile), 1)
+        low, high = self.percentiles[index - 1], self.percentiles[index]
+        low_delay, high_delay = self.delays[index - 1], self.delays[index]
+        if high == low:
+            return high_delay
+        return low_delay + (high_delay - low_delay) * \
+            (percentile - low) / float(high - low)
+
+
+class Fault(object):
+
+    """
+    Fault injected into a share of the calls to a route, given by rate
+
+    Modes are:
+        error - respond with status, 503 by default
+        reset - abort the connection with a TCP reset
+        truncate - close the connection after fraction of the body
+        stall - hold the connection for duration seconds then close it
+
+    reset and truncate need the default 'threaded' server
+    """
+
+    def __init__(self, mode, rate=1.0, status=503, fraction=0.5,
+                 duration=60):
+        if mode not in FAULT_MODES:
+            raise ValueError('unknown fault mode %s' % mode)
+        self.mode = mode
+        self.rate = rate
+        self.status = status
+        self.fraction = fraction
+        self.duration = duration
+
+
+class RouteProfile(object):
+
+    """
+    Latency and faults of a route
+
+    first_byte delays the response headers, total the end of the response
+    body which is spread over the time in between. Delays are seconds or a
+    distribution such as Normal, LogNormal or Percentiles. faults is a list
+    of Fault, seed makes the samples repeatable
+
+    Delays sleep the thread or greenlet serving the request, other requests
+    are served meanwhile. They are measured from the arrival of the request
+    on the clock of the server
+    """
+
+    # Pieces a paced body is split into
+    pieces = 16
+
+    def __init__(self, first_byte=None, total=None, faults=(), seed=None):
+        self.first_byte = first_byte
+        self.total = total
+        self.faults = list(faults)
+        self.random = random.Random(seed)
+
+    def sample(self, delay):
+        """
+        Return a delay in seconds sampled from a delay setting
+        """
+        if delay is None:
+            return 0
+        if hasattr(delay, 'sample'):
+            return delay.sample(self.random)
+        return delay
+
+    def pick_fault(self):
+        """
+        Return the fault to inject into a call or None
+        """
+        if not self.faults:
+            return None
+        draw = self.random.random()
+        for fault in self.faults:
+            if draw < fault.rate:
+                return fault
+            draw -= fault.rate
+        return None
+
+    def wrap(self, callback=None):
+        """
+        Return a route callback applying the profile to callback
+        """
+        return ProfiledCallback(callback, self)
+
+
+class ProfiledCallback(object):
+
+    """
+    Route callback delaying the response and injecting faults following a
+    RouteProfile, callback is called or returned as for any route
+    """
+
+    def __init__(self, callback, profile):
+        self.callback = callback
+        self.profile = profile
+
+    def __call__(self, *a, **kwargs):
+        environ = bottle.request.environ
+        clock = environ.get(CLOCK) or RealClock()
+        start = environ.get(ARRIVAL) or clock.time()
+        profile = self.profile
+        fault = profile.pick_fault()
+        first_byte = profile.sample(profile.first_byte)
+        total = profile.sample(profile.total)
+
+        clock.sleep_until(start + first_byte)
+
+        if fault is not None:
+            if fault.mode == 'error':
+                return bottle.HTTPResponse(status=fault.status,
+                                           body='injected fault')
+            if fault.mode == 'stall':
+                clock.sleep_until(start + first_byte + fault.duration)
+                environ[FAULT] = ('close', None)
+                return ''
+            environ[FAULT] = (fault.mode, fault.fraction)
+            if fault.mode == 'reset':
+                return ''
+
+        body = self.callback
+        if hasattr(body, '__call__'):
+            body = body(*a, **kwargs)
+        if total > first_byte:
+            return self._pace(body, start + first_byte, start + total, clock)
+        return body
+
+    def _pace(self, body, begin, end, clock):
+        """
+        Return the body spread out so its last byte is sent at end
+        """
+        if isinstance(body, bottle.BaseResponse) or body is None:
+            return body
+        if isinstance(body, unicode):
+            body = body.encode(bottle.response.charset)
+        if isinstance(body, str):
+            bottle.response.content_length = len(body)
+            size = max(len(body) // self.profile.pieces, 1)
+            body = [body[i:i + size] for i in range(0, len(body), size)]
+        return self._stream(list(body), begin, end, clock)
+
+    def _stream(self, chunks, begin, end, clock):
+        for index, chunk in enumerate(chunks):
+            clock.sleep_until(begin + (end - begin) * (index + 1) /
+                              len(chunks))
+            yield chunk
@@ -0,0 +1,104 @@
+import json
+
+import bottle
+
+from clock import RealClock
+from wsgi import CLOCK
+
+
+class StreamingResponse(object):
+
+    """
+    Route callback streaming its response, the test server sends it with
+    chunked transfer encoding to HTTP/1.1 clients
+
+    body is a string, an iterable of strings or a callable returning either
+    which is called with the route arguments. chunk_size splits the body
+    into chunks of at most that many bytes, rate caps the bandwidth at that
+    many bytes per second
+
+    Use as the callback of a route::
+
+        ht.add_route('/download', callback=StreamingResponse(data,
+                                                             chunk_size=1024,
+                                                             rate=65536))
+    """
+
+    def __init__(self, body, chunk_size=None, rate=None):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.rate = rate
+
+    def __call__(self, *a, **kwargs):
+        body = self.body
+        if hasattr(body, '__call__'):
+            body = body(*a, **kwargs)
+        if isinstance(body, basestring):
+            body = [body]
+        return self._stream(body, bottle.request.environ.get(CLOCK) or
+                            RealClock())
+
+    def _chunks(self, body):
+        """
+        Split the body into chunks of at most chunk_size
+        """
+        for part in body:
+            if not self.chunk_size:
+                yield part
+                continue
+            for start in range(0, len(part), self.chunk_size):
+                yield part[start:start + self.chunk_size]
+
+    def _stream(self, body, clock):
+        """
+        Yield the chunks of the body, sleeping after each one long enough to
+        keep to the rate
+        """
+        start = clock.time()
+        sent = 0
+        for chunk in self._chunks(body):
+            yield chunk
+            sent += len(chunk)
+            if self.rate:
+                clock.sleep_until(start + sent / float(self.rate))
+
+
+class StaticResponse(object):
+
+    """
+    Route callback answering with a fixed status, headers and body, such as
+    the example responses of a route spec. A body which is not a string is
+    sent as JSON
+
+    Use as the callback of a route::
+
+        ht.add_route('/users', 'POST', callback=StaticResponse(
+            {'id': 1}, status=201, headers={'Location': '/users/1'}))
+    """
+
+    def __init__(self, body='', status=200, headers=None):
+        headers = dict((str(name), unicode(value).encode('latin-1'))
+                       for name, value in (headers or {}).items())
+        if body is None:
+            body = ''
+        elif not isinstance(body, basestring):
+            body = json.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+        self.body = body
+        self.status = status
+        self.headers = headers
+
+    def __call__(self, *a, **kwargs):
+        return bottle.HTTPResponse(self.body, self.status, self.headers)
+
+    def __eq__(self, other):
+        return isinstance(other, StaticResponse) and \
+            (self.body, self.status, self.headers) == \
+            (other.body, other.status, other.headers)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'StaticResponse(%r, status=%r, headers=%r)' % (
+            self.body, self.status, self.headers)
@@ -0,0 +1,262 @@
+import re
+
+import bottle
+
+# A rule segment the tree matches, a whole segment wildcard with no filter
+# or the int or float filter
+SEGMENT = re.compile(r'^<([a-zA-Z_][a-zA-Z_0-9]*)(?::(int|float))?>$')
+
+
+class AppConfigRoute(bottle.Route):
+
+    """
+    Bottle route reading its app's configuration directly
+
+    A Bottle route keeps its own overlay of the app configuration and
+    making one walks those of every route already added, so adding routes
+    one at a time takes time growing with the square of their number
+    """
+
+    def __init__(self, app, rule, method, callback):
+        self.app = app
+        self.rule = rule
+        self.method = method
+        self.callback = callback
+        self.name = None
+        self.plugins = []
+        self.skiplist = []
+        self.config = app.config
+
+
+class _Node(object):
+
+    "Path segment of the routing tree"
+
+    __slots__ = ('static', 'params', 'targets')
+
+    def __init__(self):
+        self.static = {}
+        # (name, filter mode, match, in_filter, node) in the order added
+        self.params = []
+        self.targets = {}
+
+
+class RadixRouter(bottle.Router):
+
+    """
+    Bottle router matching rules segment by segment in a tree
+
+    Rules whose segments are static text or whole segment wildcards,
+    /users/<name>/posts/<id:int>, are added to a tree keyed by segment so a
+    lookup visits one node per segment of the path however many routes
+    there are. At each segment static text is tried before wildcards, which
+    are tried in the order added. Other rules, partial segment wildcards,
+    the path and re filters and the old :name syntax, are left to a Bottle
+    router which is consulted after the tree for each method
+
+    Method handling follows Bottle, the request method then ANY with GET
+    answering HEAD, and a 405 listing the allowed methods when only other
+    methods match
+    """
+
+    def __init__(self, strict=False):
+        bottle.Router.__init__(self, strict)
+        self.root = _Node()
+        self.fallback = bottle.Router(strict)
+        self.fallback.filters = self.filters
+
+    def _segments(self, rule):
+        """
+        Return the (text, mode) segments of a rule the tree can hold, mode
+        is None for static text, otherwise None if it needs the fallback
+        """
+        segments = []
+        for segment in rule.split('/'):
+            param = SEGMENT.match(segment)
+            if param:
+                segments.append((param.group(1),
+                                 param.group(2) or self.default_filter))
+            elif '<' in segment or ':' in segment or '\\' in segment:
+                return None
+            else:
+                segments.append((segment, None))
+        return segments
+
+    def _builder(self, rule):
+        builder = []
+        for key, mode, conf in self._itertokens(rule):
+            if mode:
+                if mode == 'default':
+                    mode = self.default_filter
+                builder.append((key, self.filters[mode](conf)[2] or str))
+            elif key:
+                builder.append((None, key))
+        return builder
+
+    def add(self, rule, method, target, name=None):
+        """
+        Add a new rule or replace the target for an existing rule
+        """
+        segments = self._segments(rule)
+        if segments is None:
+            self.fallback.add(rule, method, target, name)
+            self.builder[rule] = self.fallback.builder[rule]
+            if name:
+                self.builder[name] = self.builder[rule]
+            return
+
+        node = self.root
+        for text, mode in segments:
+            if mode is None:
+                child = node.static.get(text)
+                if child is None:
+                    child = node.static[text] = _Node()
+                node = child
+                continue
+            for param in node.params:
+                if param[:2] == (text, mode):
+                    node = param[4]
+                    break
+            else:
+                mask, in_filter, _ = self.filters[mode](None)
+                child = _Node()
+                node.params.append((text, mode,
+                                    re.compile('(?:%s)\\Z' % mask).match,
+                                    in_filter, child))
+                node = child
+        node.targets[method] = target
+
+        self.builder[rule] = self._builder(rule)
+        if name:
+            self.builder[name] = self.builder[rule]
+
+    def remove(self, rule, method):
+        """
+        Remove the target of a rule for method, Bottle's router has no
+        removal API so the fallback's lookup tables are edited directly
+        """
+        segments = self._segments(rule)
+        if segments is None:
+            self._remove_fallback(rule, method)
+            return
+
+        node, path = self.root, []
+        for text, mode in segments:
+            if mode is None:
+                child = node.static.get(text)
+            else:
+                child = None
+                for param in node.params:
+                    if param[:2] == (text, mode):
+                        child = param[4]
+            if child is None:
+                return
+            path.append((node, text, mode, child))
+            node = child
+        node.targets.pop(method, None)
+
+        # Prune the branch left without routes
+        for parent, text, mode, child in reversed(path):
+            if child.targets or child.static or child.params:
+                break
+            if mode is None:
+                parent.static.pop(text)
+            else:
+                parent.params[:] = [p for p in parent.params
+                                    if p[4] is not child]
+
+    def _remove_fallback(self, rule, method):
+        router = self.fallback
+        builder = router.builder.get(rule)
+        if builder is None:
+            return
+        if all(key is None for key, _ in builder):
+            router.static.get(method, {}).pop(router.build(rule), None)
+            return
+
+        dyna_routes = [r for r in router.dyna_routes.get(method, [])
+                       if r[0] != rule]
+        for key in [k for k in router._groups.keys() if k[1] == method]:
+            router._groups.pop(key)
+        for index, whole_rule in enumerate(dyna_routes):
+            router._groups[whole_rule[1], method] = index
+        router.dyna_routes[method] = dyna_routes
+        if dyna_routes:
+            router._compile(method)
+        else:
+            router.dyna_routes.pop(method)
+            router.dyna_regexes.pop(method, None)
+
+    def _walk(self, node, segments, index, captured, found):
+        """
+        Add the (targets, captured) of each node matching the path from
+        segments[index] on to found, in order of preference
+        """
+        if index == len(segments):
+            if node.targets:
+                found.append((node.targets, captured))
+            return
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            self._walk(child, segments, index + 1, captured, found)
+        for name, _, match, in_filter, child in node.params:
+            if match(segment):
+                self._walk(child, segments, index + 1,
+                           captured + ((name, in_filter, segment),), found)
+
+    def _fallback_match(self, method, path):
+        router = self.fallback
+        if method in router.static and path in router.static[method]:
+            return router.static[method][path][0], {}
+        for combined, rules in router.dyna_regexes.get(method, ()):
+            match = combined(path)
+            if match:
+                target, getargs = rules[match.lastindex - 1]
+                return target, getargs(path) if getargs else {}
+
+    def match(self, environ):
+        """
+        Return a (target, url_args) tuple or raise HTTPError(400/404/405)
+        """
+        verb = environ['REQUEST_METHOD'].upper()
+        path = environ['PATH_INFO'] or '/'
+
+        if verb == 'HEAD':
+            methods = ('PROXY', 'HEAD', 'GET', 'ANY')
+        else:
+            methods = ('PROXY', verb, 'ANY')
+
+        found = []
+        self._walk(self.root, path.split('/'), 0, (), found)
+        for method in methods:
+            for targets, captured in found:
+                if method in targets:
+                    url_args = {}
+                    for name, in_filter, value in captured:
+                        if in_filter:
+                            try:
+                                value = in_filter(value)
+                            except ValueError:
+                                raise bottle.HTTPError(
+                                    400, 'Path has wrong format.')
+                        url_args[name] = value
+                    return targets[method], url_args
+            matched = self._fallback_match(method, path)
+            if matched:
+                return matched
+
+        allowed = set()
+        for targets, _ in found:
+            allowed.update(targets)
+        for method in self.fallback.static:
+            if path in self.fallback.static[method]:
+                allowed.add(method)
+        for method, regexes in self.fallback.dyna_regexes.items():
+            if any(combined(path) for combined, _ in regexes):
+                allowed.add(method)
+        allowed.difference_update(methods)
+        if allowed:
+            raise bottle.HTTPError(405, 'Method not allowed.',
+                                   Allow=','.join(sorted(allowed)))
+        raise bottle.HTTPError(404, 'Not found: ' + repr(path))
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import re
+import stat
+import tempfile
+from urlparse import urlparse
+
+from history import JSON_TYPES
+from httpserver import paused_gc
+from responses import StaticResponse
+
+# Bumped when the route maps built from a spec change, older cache entries
+# are then ignored
+CACHE_VERSION = 2
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.expanduser(os.path.join('~', '.cache')),
+                         'httpclienttest')
+
+YAML_EXTENSIONS = ('.yaml', '.yml')
+OPENAPI_METHODS = ('get', 'put', 'post', 'delete', 'options', 'head',
+                   'patch', 'trace')
+TEMPLATE = re.compile(r'\{([^}/]+)\}')
+
+
+class SpecError(Exception):
+
+    "Route spec could not be loaded"
+
+
+def load_spec(path, cache_dir=None):
+    """
+    Return the route map of a route spec file, see spec_routes
+
+    JSON specs are read by extension, .yaml and .yml specs need PyYAML.
+    The responses of the route map built are cached as JSON in cache_dir,
+    by default ~/.cache/httpclienttest, under the SHA-256 of the file so
+    the next load of an unchanged spec skips parsing it. cache_dir=False
+    turns the cache off, as does a cache_dir other users can write to
+    """
+    with open(path, 'rb') as spec_file:
+        data = spec_file.read()
+
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    cache_path = None
+    if cache_dir and _private_dir(cache_dir):
+        cache_path = os.path.join(cache_dir, '%s.%d.json' % (
+            hashlib.sha256(data).hexdigest(), CACHE_VERSION))
+        route_map = _read_cache(cache_path)
+        if route_map is not None:
+            return route_map
+
+    route_map = spec_routes(_parse(data, path))
+    if cache_path:
+        _write_cache(cache_path, route_map)
+    return route_map
+
+
+def _parse(data, path):
+    if os.path.splitext(path)[1].lower() in YAML_EXTENSIONS:
+        try:
+            import yaml
+        except ImportError:
+            raise SpecError('PyYAML is needed to load %s' % path)
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        try:
+            return yaml.load(data, Loader=loader)
+        except yaml.YAMLError as e:
+            raise SpecError('%s is not valid YAML: %s' % (path, e))
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise SpecError('%s is not valid JSON: %s' % (path, e))
+
+
+def _private_dir(directory):
+    """
+    Return whether directory, created if missing, belongs to the user and
+    is closed to everyone else, so no one else can plant cache entries
+    """
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        pass
+    try:
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and \
+        not info.st_mode & 0o077
+
+
+def _read_cache(cache_path):
+    """
+    Return the cached route map or None if there is no usable entry
+
+    An entry maps routes to methods to [status, headers, body] and only
+    ever rebuilds StaticResponses
+    """
+    try:
+        with open(cache_path, 'rb') as cached:
+            data = cached.read()
+    except IOError:
+        return None
+    try:
+        with paused_gc():
+            route_map = {}
+            for path, methods in json.loads(data).items():
+                route_map[_native(path)] = dict(
+                    (str(method), StaticResponse(body, status, headers))
+                    for method, (status, headers, body) in methods.items())
+            return route_map
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _write_cache(cache_path, route_map):
+    """
+    Write a cache entry, renamed into place so concurrent test sessions
+    never read one half written. Failures only cost the next load a parse
+    """
+    entry = {}
+    for path, methods in route_map.items():
+        entry[path] = dict(
+            (method, [response.status,
+                      dict((name, value.decode('latin-1'))
+                           for name, value in response.headers.items()),
+                      response.body])
+            for method, response in methods.items())
+    try:
+        data = json.dumps(entry)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path),
+                                         suffix='.tmp')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def spec_routes(spec):
+    """
+    Return the route map of a parsed route spec, each route answers with a
+    StaticResponse
+
+    An OpenAPI 3 or Swagger 2 spec gives a route per operation, answering
+    with the example of its lowest 2xx response, or of the default
+    response, as 200. Path templates become wildcards, /users/{id} is
+    /users/<id>, under the path of the first server or the basePath
+
+    Otherwise the spec is a mapping of routes to methods to responses::
+
+        {"routes": {"/users/<name>": {"GET": {"status": 200,
+                                              "headers": {"X-Id": "1"},
+                                              "body": {"name": "ann"}},
+                                      "DELETE": {"status": 204}}}}
+
+    where a body which is not a string is sent as JSON
+    """
+    if not isinstance(spec, dict):
+        raise SpecError('route spec is not a mapping')
+    if 'openapi' in spec or 'swagger' in spec:
+        return _openapi_routes(spec)
+    if not isinstance(spec.get('routes'), dict):
+        raise SpecError('route spec has no routes or paths')
+
+    route_map = {}
+    for path, methods in spec['routes'].items():
+        for method, response in (methods or {}).items():
+            response = response or {}
+            route_map.setdefault(_native(path), {})[str(method).upper()] = \
+                StaticResponse(response.get('body'),
+                               int(response.get('status', 200)),
+                               response.get('headers'))
+    return route_map
+
+
+def _native(path):
+    """
+    Return a path as the UTF-8 str Bottle matches request paths as
+    """
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+
+def _resolve(spec, node):
+    """
+    Return node with a local $ref followed
+    """
+    seen = 0
+    while isinstance(node, dict) and '$ref' in node:
+        ref = node['$ref']
+        if not ref.startswith('#/') or seen > 32:
+            return {}
+        node = spec
+        for part in ref[2:].split('/'):
+            part = part.replace('~1', '/').replace('~0', '~')
+            if not isinstance(node, dict) or part not in node:
+                return {}
+            node = node[part]
+        seen += 1
+    return node
+
+
+def _base_path(spec):
+    if 'swagger' in spec:
+        return (spec.get('basePath') or '').rstrip('/')
+    servers = spec.get('servers') or [{}]
+    url = servers[0].get('url') or ''
+    for name, variable in (servers[0].get('variables') or {}).items():
+        url = url.replace('{%s}' % name, variable.get('default', ''))
+    return urlparse(url).path.rstrip('/')
+
+
+def _wildcard(match):
+    return '<%s>' % re.sub(r'\W', '_', match.group(1))
+
+
+def _pick_response(responses):
+    """
+    Return the status and the key of the response an operation is
+    answered with, YAML specs may key responses by int
+    """
+    statuses = []
+    for code in responses:
+        text = str(code)
+        if text.isdigit():
+            statuses.append((int(text), code))
+        elif len(text) == 3 and text[0].isdigit() and \
+                text[1:].upper() == 'XX':
+            statuses.append((int(text[0]) * 100, code))
+    for status, code in sorted(statuses):
+        if 200 <= status < 300:
+            return status, code
+    if 'default' in responses:
+        return 200, 'default'
+    if statuses:
+        return min(statuses)
+    return 200, None
+
+
+def _example(spec, response):
+    """
+    Return the media type and example body of an OpenAPI response, a media
+    type of None if it has no example
+    """
+    if 'content' in response:
+        content = response['content'] or {}
+        media_types = sorted(content, key=lambda t: (
+            t.split(';')[0] not in JSON_TYPES, t))
+        for media_type in media_types:
+            media = _resolve(spec, content[media_type])
+            if 'example' in media:
+                return media_type, media['example']
+            for example in (media.get('examples') or {}).values():
+                example = _resolve(spec, example)
+                if 'value' in example:
+                    return media_type, example['value']
+            schema = _resolve(spec, media.get('schema'))
+            if isinstance(schema, dict) and 'example' in schema:
+                return media_type, schema['example']
+        return None, None
+
+    # Swagger 2
+    examples = response.get('examples') or {}
+    for media_type in sorted(examples, key=lambda t: (
+            t.split(';')[0] not in JSON_TYPES, t)):
+        return media_type, examples[media_type]
+    schema = _resolve(spec, response.get('schema'))
+    if isinstance(schema, dict) and 'example' in schema:
+        return 'application/json', schema['example']
+    return None, None
+
+
+def _operation_response(spec, operation):
+    status, code = _pick_response(operation.get('responses') or {})
+    if code is None:
+        return StaticResponse(status=status)
+    response = _resolve(spec, operation['responses'][code]) or {}
+
+    headers = {}
+    for name, header in (response.get('headers') or {}).items():
+        header = _resolve(spec, header)
+        schema = _resolve(spec, header.get('schema')) or {}
+        if 'example' in header:
+            headers[name] = header['example']
+        elif isinstance(schema, dict) and 'example' in schema:
+            headers[name] = schema['example']
+
+    media_type, body = _example(spec, response)
+    if media_type is None:
+        return StaticResponse(status=status, headers=headers)
+    headers['Content-Type'] = media_type
+    if media_type.split(';')[0] in JSON_TYPES or \
+            not isinstance(body, basestring):
+        body = json.dumps(body)
+    return StaticResponse(body, status, headers)
+
+
+def _openapi_routes(spec):
+    base = _base_path(spec)
+    route_map = {}
+    for template, item in (spec.get('paths') or {}).items():
+        item = _resolve(spec, item)
+        path = _native(base + TEMPLATE.sub(_wildcard, template))
+        for method in OPENAPI_METHODS:
+            if method not in item:
+                continue
+            operation = _resolve(spec, item[method]) or {}
+            route_map.setdefault(path, {})[method.upper()] = \
+                _operation_response(spec, operation)
+    return route_map
@@ -0,0 +1,209 @@
+class Histogram(object):
+
+    """
+    HDR style histogram of non negative integer values
+
+    Values below 2 ** sub_bits are counted exactly, larger values in
+    buckets 2 ** sub_bits to a power of two wide so the relative error stays
+    below 2 ** -(sub_bits - 1). Buckets are kept sparse
+    """
+
+    def __init__(self, sub_bits=7):
+        self.sub_bits = sub_bits
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = max(value.bit_length() - self.sub_bits, 0)
+        return (shift << self.sub_bits) + (value >> shift)
+
+    def _highest(self, index):
+        """
+        Return the highest value counted in a bucket
+        """
+        shift = index >> self.sub_bits
+        low = (index - (shift << self.sub_bits)) << shift
+        return low + (1 << shift) - 1
+
+    def record(self, value):
+        value = int(value)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """
+        Return the value at or below which percentile percent of the values
+        fall, as the highest value of its bucket capped at the maximum
+        """
+        if not self.total:
+            return None
+        rank = max(percentile * self.total / 100.0, 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest(index), self.max)
+        return self.max
+
+    def mean(self):
+        if not self.total:
+            return None
+        return self.sum / float(self.total)
+
+    def as_dict(self):
+        return {'sub_bits': self.sub_bits,
+                'counts': self.counts,
+                'total': self.total,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['sub_bits'])
+        histogram.counts = dict((int(index), count)
+                                for index, count in data['counts'].items())
+        for name in ('total', 'sum', 'min', 'max'):
+            setattr(histogram, name, data[name])
+        return histogram
+
+
+class RouteTiming(object):
+
+    """
+    Timing of the requests to a route and method on the server clock
+
+    callback and total are histograms of the time spent in the route
+    callback and handling the whole request in microseconds, total includes
+    sending a streamed response
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.first_arrival = None
+        self.last_arrival = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.callback = Histogram()
+        self.total = Histogram()
+
+    def add(self, arrival, callback, total, bytes_in, bytes_out):
+        """
+        Record a request, times are in seconds
+        """
+        self.count += 1
+        if self.first_arrival is None or arrival < self.first_arrival:
+            self.first_arrival = arrival
+        if self.last_arrival is None or arrival > self.last_arrival:
+            self.last_arrival = arrival
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.callback.record(callback * 1e6)
+        self.total.record(total * 1e6)
+
+    def latency(self, percentile, timing='total'):
+        """
+        Return the percentile of the callback or total time in seconds
+        """
+        value = getattr(self, timing).percentile(percentile)
+        if value is None:
+            return None
+        return value / 1e6
+
+    def rate(self):
+        """
+        Return the requests per second between the first and last arrival
+        """
+        if self.count < 2 or self.last_arrival == self.first_arrival:
+            return None
+        return (self.count - 1) / float(self.last_arrival -
+                                        self.first_arrival)
+
+    def as_dict(self):
+        return {'count': self.count,
+                'first_arrival': self.first_arrival,
+                'last_arrival': self.last_arrival,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'callback': self.callback.as_dict(),
+                'total': self.total.as_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        timing = cls()
+        for name in ('count', 'first_arrival', 'last_arrival', 'bytes_in',
+                     'bytes_out'):
+            setattr(timing, name, data[name])
+        timing.callback = Histogram.from_dict(data['callback'])
+        timing.total = Histogram.from_dict(data['total'])
+        return timing
+
+
+class RouteStats(object):
+
+    """
+    Request timing of a server per route and method
+
+    Not thread safe, callers hold the server lock
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    def add(self, rule, method, *a):
+        timing = self.timings.get((rule, method))
+        if timing is None:
+            timing = self.timings[rule, method] = RouteTiming()
+        timing.add(*a)
+
+    def clear(self, rule=None, method=None):
+        """
+        Clear timing for a route and method, or all timing if not given
+        """
+        if rule is None:
+            self.timings = {}
+        else:
+            self.timings.pop((rule, method), None)
+
+    def as_dict(self):
+        """
+        Return timing in the format {route: {method: timing}}
+        """
+        result = {}
+        for (rule, method), timing in self.timings.items():
+            result.setdefault(rule, {})[method] = timing.as_dict()
+        return result
+
+
+class TimedResponse(object):
+
+    """
+    WSGI response iterable counting the bytes sent, done is called with
+    the count once the server closes it
+    """
+
+    def __init__(self, result, done):
+        self.result = result
+        self.done = done
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.result:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.done(self.sent)
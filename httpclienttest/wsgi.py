@@ -0,0 +1,342 @@
+import socket
+import struct
+import threading
+import time
+
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, ServerHandler, WSGIServer, \
+    WSGIRequestHandler
+
+import bottle
+
+# Environ keys set for route callbacks, a connection fault to inject as
+# (mode, fraction), the clock of the server, the request arrival time and
+# the (seconds, body bytes) of a recorded route callback
+FAULT = 'httpclienttest.fault'
+CLOCK = 'httpclienttest.clock'
+ARRIVAL = 'httpclienttest.arrival'
+TIMING = 'httpclienttest.timing'
+
+
+class RequestInput(object):
+
+    """
+    Request body stream limited to the Content-Length of the request
+
+    Whatever the application leaves unread is drained so the next request on
+    a persistent connection starts at the right place
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        while self.remaining > 0:
+            if not self.read(65536):
+                break
+
+
+class KeepAliveServerHandler(ServerHandler):
+
+    """
+    Server handler responding with HTTP/1.1, responses of unknown length,
+    e.g. from generator callbacks, are sent with chunked transfer encoding
+    to HTTP/1.1 clients. Otherwise the connection is closed when the
+    response length is unknown or the client asked for it
+    """
+    http_version = '1.1'
+    chunked = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            if self.request_handler.request_version == 'HTTP/1.1' and \
+                    self.environ['REQUEST_METHOD'] != 'HEAD':
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+    def write(self, data):
+        if self.status and not self.headers_sent:
+            self.send_headers()
+        if self.chunked:
+            # An empty chunk would end the response
+            if not data:
+                return
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        ServerHandler.write(self, data)
+
+    def finish_response(self):
+        """
+        Send the response or inject the fault a callback asked for, 'reset'
+        aborts the connection, 'truncate' sends part of the body and 'close'
+        closes it without a response
+        """
+        fault = self.environ.get(FAULT)
+        if fault is None:
+            return ServerHandler.finish_response(self)
+
+        mode, fraction = fault
+        self.request_handler.close_connection = 1
+        try:
+            if mode == 'truncate':
+                body = ''.join(self.result)
+                self.headers['Content-Length'] = str(len(body))
+                self.write(body[:int(len(body) * fraction)])
+            elif mode == 'reset':
+                self.request_handler.reset_connection = True
+        finally:
+            self.close()
+
+    def finish_content(self):
+        if self.chunked:
+            self._write('0\r\n\r\n')
+            self._flush()
+        else:
+            ServerHandler.finish_content(self)
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    """
+    Request handler which does not log requests or resolve client names
+    """
+
+    def address_string(self):
+        return self.client_address[0]
+
+    def log_request(self, *a, **kwargs):
+        pass
+
+
+class KeepAliveHandler(QuietHandler):
+
+    """
+    Request handler serving requests on a connection until the client or
+    the response closes it
+
+    Responses are buffered and flushed by the handler, with Nagle disabled,
+    so small responses on a persistent connection don't wait on delayed ACKs
+    """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    reset_connection = False
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+
+        if not self.parse_request():
+            return
+
+        environ = self.get_environ()
+        if environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+            # Can't tell where a chunked body the app didn't read ends
+            stream = self.rfile
+            self.close_connection = 1
+        else:
+            stream = RequestInput(self.rfile,
+                                  int(environ.get('CONTENT_LENGTH') or 0))
+
+        handler = KeepAliveServerHandler(stream, self.wfile,
+                                         self.get_stderr(), environ)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if self.reset_connection:
+            self.reset()
+            return
+
+        if stream is not self.rfile:
+            stream.drain()
+        self.wfile.flush()
+
+    def reset(self):
+        """
+        Abort the connection with a TCP reset
+        """
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        # The file objects of the handler hold the socket open, close the
+        # underlying socket for the reset to be sent now
+        getattr(self.connection, '_sock', self.connection).close()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+
+    """
+    WSGI server handling each connection on its own thread
+
+    Open connections are tracked so they can be closed on shut down rather
+    than left served by the old handler threads
+    """
+    daemon_threads = True
+    # Listen backlog large enough for bursts of concurrent connections
+    request_queue_size = 1024
+
+    def __init__(self, *a, **kwargs):
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        WSGIServer.__init__(self, *a, **kwargs)
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        WSGIServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """
+        Close all open client connections
+        """
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class TestServerAdapter(bottle.ServerAdapter):
+
+    """
+    Threaded server adapter keeping a handle on the server so it can be shut
+    down from another thread
+
+    ready is called with the bound port once the socket is listening,
+    sleep pauses the thread serving a request without blocking others
+    """
+    quiet = True
+    sleep = staticmethod(time.sleep)
+    server_class = ThreadingWSGIServer
+    handler_class = KeepAliveHandler
+
+    def __init__(self, *a, **kwargs):
+        self.ready = kwargs.pop('ready', None)
+        bottle.ServerAdapter.__init__(self, *a, **kwargs)
+        self.srv = None
+        self.listening = False
+
+    def run(self, app):
+        self.listening = False
+        self.srv = make_server(self.host, self.port, app,
+                               server_class=self.server_class,
+                               handler_class=self.handler_class)
+        self.port = self.srv.server_port
+        self.listening = True
+        if self.ready:
+            self.ready(self.port)
+        self.srv.serve_forever(poll_interval=0.05)
+
+    def shutdown(self):
+        """
+        Stop serving, close the listening socket and client connections
+        """
+        if self.srv:
+            self.srv.shutdown()
+            self.srv.server_close()
+            if hasattr(self.srv, 'close_connections'):
+                self.srv.close_connections()
+
+
+class WSGIRefServerAdapter(TestServerAdapter):
+
+    """
+    Single threaded wsgiref server handling one request at a time, each on
+    its own connection
+    """
+    server_class = WSGIServer
+    handler_class = QuietHandler
+
+
+class GeventServerAdapter(TestServerAdapter):
+
+    """
+    gevent server handling each connection on a greenlet, for large numbers
+    of concurrent connections. Requires gevent to be installed, callbacks
+    which block should use gevent.sleep or a monkey patched time.sleep
+    """
+
+    def __init__(self, *a, **kwargs):
+        TestServerAdapter.__init__(self, *a, **kwargs)
+        self.hub = None
+
+    @staticmethod
+    def sleep(seconds):
+        import gevent
+        gevent.sleep(seconds)
+
+    def run(self, app):
+        import gevent
+        from gevent import pywsgi
+
+        self.listening = False
+        self.hub = gevent.get_hub()
+        self.srv = pywsgi.WSGIServer((self.host, self.port), app,
+                                     backlog=1024, log=None)
+        self.srv.start()
+        self.port = self.srv.server_port
+        self.listening = True
+        if self.ready:
+            self.ready(self.port)
+        self.srv.serve_forever()
+
+    def shutdown(self):
+        """
+        Stop the server from the thread running its event loop
+        """
+        if self.srv:
+            self.hub.loop.run_callback_threadsafe(self.srv.stop)
+
+
+SERVERS = {'threaded': TestServerAdapter,
+           'wsgiref': WSGIRefServerAdapter,
+           'gevent': GeventServerAdapter}
@@ -1,3 +1,159 @@
+import hashlib
 import unittest
+import bottle
 import requests
-from httpclienttest import HttpTests
\ No newline at end of file
+from httpclienttest import HttpTests
+
+
+def echo_size():
+    return str(len(bottle.request.body.read()))
+
+
+class TestBodySpooling(unittest.TestCase):
+
+    """
+    Test request bodies spooled to disk and body assertions
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, spool_bytes=1024)
+        self.req, _ = self.ht.add_route('/upload', 'POST', echo_size)
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_spooled_body(self):
+        """
+        Test that a large body reaches the callback and only its digest is
+        kept
+        """
+        body = 'x' * 100000
+        resp = requests.post(self.req, data=body)
+        self.assertEqual(resp.text, '100000')
+
+        res = self.ht.get_last_route('/upload', 'POST')
+        self.assertIsNone(res['body'])
+        self.assertEqual(res['body_encoding'], 'spooled')
+        self.ht.assertLastRouteCallBodySize('/upload', 100000)
+        self.ht.assertLastRouteCallBodyDigest(
+            '/upload', hashlib.sha256(body).hexdigest())
+
+    def test_chunked_body(self):
+        """
+        Test that chunked uploads are spooled
+        """
+        parts = ['y' * 4096] * 10
+        resp = requests.post(self.req, data=iter(parts))
+        self.assertEqual(resp.text, '40960')
+
+        self.ht.assertLastRouteCallBodySize('/upload', 40960)
+        self.ht.assertLastRouteCallBodyDigest(
+            '/upload', hashlib.sha256(''.join(parts)).hexdigest())
+
+    def test_small_body(self):
+        """
+        Test that bodies under the threshold are kept
+        """
+        requests.post(self.req, data='small')
+
+        res = self.ht.get_last_route('/upload', 'POST')
+        self.assertEqual(res['body'], 'small')
+        self.ht.assertLastRouteCallBodyDigest(
+            '/upload', hashlib.sha256('small').hexdigest())
+        self.assertRaises(AssertionError,
+                          self.ht.assertLastRouteCallBodySize, '/upload', 6)
+
+
+class TestBatchAsserts(unittest.TestCase):
+
+    """
+    Test assertions checked together in one request
+    """
+
+    engine = 'process'
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, engine=self.engine)
+        self.req, _ = self.ht.add_route('/test/<param>')
+        self.ht.add_route('/other', 'POST')
+        requests.get(self.req.replace('<param>', '1') + '?a=b')
+        requests.get(self.req.replace('<param>', '2') + '?a=c')
+        requests.post(self.ht.base + '/other', data='body')
+
+        self.requests = []
+        post = self.ht.session.post
+        get = self.ht.session.get
+        self.ht.session.post = lambda *a, **kw: (self.requests.append(a[0])
+                                                 or post(*a, **kw))
+        self.ht.session.get = lambda *a, **kw: (self.requests.append(a[0])
+                                                or get(*a, **kw))
+
+    def tearDown(self):
+        self.ht.close()
+
+    def sent(self):
+        """
+        Return the number of utility requests made by the assertions
+        """
+        if self.engine == 'thread':
+            return 0
+        return 1
+
+    def test_one_request(self):
+        """
+        Test that passing assertions are resolved in one request
+        """
+        with self.ht.batch_asserts():
+            self.ht.assertRouteCalled('/test/<param>')
+            self.ht.assertCountRouteCalled('/test/<param>', 2)
+            self.ht.assertCountRouteCalledWith('/test/<param>', 1,
+                                               params={'a': 'c'})
+            self.ht.assertLastRouteCallArguments('/test/<param>',
+                                                 {'param': '2'})
+            self.ht.assertLastRouteCallQueryString('/test/<param>',
+                                                   {'a': 'c'})
+            self.ht.assertLastRouteCallBodySize('/other', 4)
+            self.ht.assertRouteLatencyBelow('/other', 5, method='POST')
+            with self.ht.batch_asserts():
+                self.ht.assertRouteCalled('/other', 'POST')
+            self.assertEqual(self.requests, [])
+        self.assertEqual(len(self.requests), self.sent())
+
+    def test_same_message(self):
+        """
+        Test that the first failing assertion raises its usual message
+        """
+        def check():
+            self.ht.assertRouteCalled('/test/<param>')
+            self.ht.assertCountRouteCalled('/test/<param>', 5)
+            self.ht.assertRouteCalled('/missing', err_msg='custom')
+
+        try:
+            check()
+        except AssertionError as e:
+            expected = str(e)
+
+        try:
+            with self.ht.batch_asserts():
+                check()
+        except AssertionError as e:
+            self.assertEqual(str(e), expected)
+        else:
+            self.fail('batch did not fail')
+
+        self.assertRaisesRegexp(AssertionError, 'custom',
+                                self.batch_missing)
+
+    def batch_missing(self):
+        with self.ht.batch_asserts():
+            self.ht.assertRouteCalled('/test/<param>')
+            self.ht.assertRouteCalled('/missing', err_msg='custom')
+
+
+class TestThreadedBatchAsserts(TestBatchAsserts):
+
+    """
+    Test batched assertions on the threaded engine
+    """
+
+    engine = 'thread'
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import unittest
+import bottle
+import requests
+from httpclienttest import HttpTests, Cassette, CassetteWriter, CassetteError
+from httpclienttest.cassettes import request_key, TRAILER
+
+
+class TestCassetteFile(unittest.TestCase):
+
+    """
+    Test writing and reading cassette files
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.cassette')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, close=True):
+        writer = CassetteWriter(self.path)
+        for index in range(3):
+            key = request_key('GET', '/item', 'id=%d' % index)
+            writer.add(key, 'GET', '/item', 'id=%d' % index, 200,
+                       [('Content-Type', 'text/plain'),
+                        ('Content-Length', '6')], 'item %d' % index)
+        key = request_key('POST', '/item')
+        writer.add(key, 'POST', '/item', '', 201, [], 'first')
+        writer.add(key, 'POST', '/item', '', 409, [], 'second')
+        if close:
+            writer.close()
+        return writer
+
+    def test_lookup(self):
+        """
+        Test that responses are found by request and repeats are replayed
+        in order
+        """
+        self.record()
+        cassette = Cassette(self.path)
+        self.assertEqual(len(cassette), 5)
+        self.assertEqual(cassette.lookup(request_key('GET', '/item', 'id=1')),
+                         (200, [('Content-Type', 'text/plain')], 'item 1'))
+        self.assertIsNone(cassette.lookup(request_key('GET', '/item')))
+
+        key = request_key('POST', '/item')
+        statuses = [cassette.lookup(key)[0] for _ in range(3)]
+        self.assertEqual(statuses, [201, 409, 409])
+        cassette.rewind()
+        self.assertEqual(cassette.lookup(key)[0], 201)
+        cassette.close()
+
+    def test_no_index(self):
+        """
+        Test that a cassette whose recording was cut short is scanned
+        """
+        self.record(close=False).file.close()
+        cassette = Cassette(self.path)
+        self.assertEqual(len(cassette), 5)
+        cassette.close()
+
+    def test_append(self):
+        """
+        Test that recording into a cassette adds to it
+        """
+        self.record()
+        self.record()
+        cassette = Cassette(self.path)
+        self.assertEqual(len(cassette), 10)
+        size = os.path.getsize(self.path)
+        self.assertEqual(TRAILER.unpack(open(self.path).read()[-16:])[0],
+                         cassette.end)
+        self.assertLess(cassette.end, size)
+        cassette.close()
+
+    def test_not_cassette(self):
+        with open(self.path, 'w') as out:
+            out.write('not a cassette')
+        self.assertRaises(CassetteError, Cassette, self.path)
+
+    def test_normalised_key(self):
+        """
+        Test that query parameter order and JSON formatting are ignored
+        """
+        self.assertEqual(request_key('get', '/a', 'x=1&y=2'),
+                         request_key('GET', '/a', 'y=2&x=1'))
+        self.assertEqual(
+            request_key('POST', '/a', '', '{"a": 1, "b": 2}',
+                        'application/json'),
+            request_key('POST', '/a', '', '{"b":2,"a":1}',
+                        'application/json; charset=utf-8'))
+        self.assertNotEqual(request_key('POST', '/a', '', 'x'),
+                            request_key('POST', '/a', '', 'y'))
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    """
+    Test recording traffic to an upstream server and replaying it
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.cassette')
+        self.upstream = HttpTests(shared=False, engine='thread')
+        self.upstream.add_route('/users/<name>',
+                                callback=lambda name: 'user %s' % name)
+        self.upstream.add_route('/users', 'POST', callback=lambda: {
+            'created': bottle.request.json['name']})
+
+    def tearDown(self):
+        self.upstream.close()
+        shutil.rmtree(self.dir)
+
+    def test_record_replay(self):
+        """
+        Test that recorded exchanges are replayed without the upstream
+        """
+        recorder = HttpTests(shared=False, cassette=self.path,
+                             upstream=self.upstream.base)
+        recorder.add_route('/local', callback='local')
+        base = recorder.base
+        self.assertEqual(requests.get(base + '/users/ann?a=1&b=2').content,
+                         'user ann')
+        self.assertEqual(requests.post(base + '/users',
+                                       json={'name': 'bob'}).json(),
+                         {'created': 'bob'})
+        self.assertEqual(requests.get(base + '/local').content, 'local')
+        self.assertEqual(requests.get(base + '/missing').status_code, 404)
+        recorder.close()
+        self.upstream.assertCountRouteCalled('/users/<name>', 1)
+
+        self.upstream.close()
+        replay = HttpTests(shared=False, engine='thread',
+                           cassette=self.path)
+        try:
+            replay.add_route('/local', callback=lambda: bottle.abort(404))
+            base = replay.base
+            response = requests.get(base + '/users/ann?b=2&a=1')
+            self.assertEqual(response.content, 'user ann')
+            self.assertTrue(response.headers['Content-Type'].startswith(
+                'text/html'))
+            response = requests.post(base + '/users',
+                                     data='{"name":"bob"}',
+                                     headers={'Content-Type':
+                                              'application/json'})
+            self.assertEqual(response.json(), {'created': 'bob'})
+            self.assertEqual(requests.get(base + '/missing').status_code,
+                             404)
+            self.assertEqual(requests.get(base + '/users/cat').status_code,
+                             404)
+            self.assertEqual(requests.get(base + '/local').status_code, 404)
+            self.assertEqual(replay.count_calls(), 1)
+        finally:
+            replay.close()
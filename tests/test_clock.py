@@ -0,0 +1,140 @@
+import pickle
+import threading
+import time
+import unittest
+import requests
+from requests.exceptions import ReadTimeout
+from httpclienttest import HttpTests, RouteProfile, Fault, VirtualClock
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    """
+    Test the virtual clock
+    """
+
+    def test_sleep_released(self):
+        """
+        Test that sleepers wake once time passes their deadline
+        """
+        clock = VirtualClock(start=0)
+        woken = []
+        sleeper = threading.Thread(target=lambda: woken.append(
+            clock.sleep_until(10) or clock.time()))
+        sleeper.daemon = True
+        sleeper.start()
+
+        clock.advance(5)
+        sleeper.join(0.1)
+        self.assertTrue(sleeper.is_alive(), 'woken before the deadline')
+        clock.advance(5)
+        sleeper.join(1)
+        self.assertEqual(woken, [10])
+
+    def test_no_going_back(self):
+        """
+        Test that time never moves back
+        """
+        clock = VirtualClock(start=100)
+        clock.advance_to(50)
+        self.assertEqual(clock.time(), 100)
+
+    def test_pickle(self):
+        """
+        Test that the clock can be sent to a server process
+        """
+        clock = pickle.loads(pickle.dumps(VirtualClock(start=3), 2))
+        clock.advance(1)
+        self.assertEqual(clock.time(), 4)
+
+
+class TestServerVirtualTime(unittest.TestCase):
+
+    """
+    Test injected delays on a virtual clock
+    """
+
+    engine = 'process'
+
+    def setUp(self):
+        self.clock = VirtualClock(start=1000)
+        self.ht = HttpTests(shared=False, engine=self.engine,
+                            clock=self.clock)
+        self.req, _ = self.ht.add_route('/slow', callback='done',
+                                        profile=RouteProfile(first_byte=30))
+
+    def tearDown(self):
+        self.ht.advance_clock(3600)
+        self.ht.close()
+
+    def wait_for_call(self):
+        deadline = time.time() + 2
+        while not self.ht.count_calls('/slow') and time.time() < deadline:
+            time.sleep(0.005)
+
+    def test_delay_released(self):
+        """
+        Test that a 30 second delay ends when the clock is advanced
+        """
+        responses = []
+        client = threading.Thread(
+            target=lambda: responses.append(requests.get(self.req)))
+        client.daemon = True
+        start = time.time()
+        client.start()
+        self.wait_for_call()
+
+        self.ht.advance_clock(29)
+        client.join(0.1)
+        self.assertTrue(client.is_alive(), 'released before the deadline')
+        self.assertEqual(self.ht.advance_clock(1), 1030)
+        client.join(2)
+
+        self.assertEqual(responses[0].content, 'done')
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.ht.query_calls('/slow')[0]['time'], 1000)
+        self.assertEqual(self.clock.time(), 1030)
+
+    def test_client_timeout(self):
+        """
+        Test that a client times out on a delayed response without waiting
+        """
+        start = time.time()
+        self.assertRaises(ReadTimeout, requests.get, self.req, timeout=0.05)
+        self.assertLess(time.time() - start, 1)
+
+    def test_stall(self):
+        """
+        Test that stalls follow the clock
+        """
+        self.ht.add_route('/stall', profile=RouteProfile(
+            faults=[Fault('stall', duration=60)]))
+        self.assertRaises(ReadTimeout, requests.get, self.ht.base + '/stall',
+                          timeout=0.05)
+        self.assertEqual(self.ht.count_calls('/stall'), 1)
+
+
+class TestThreadedVirtualTime(TestServerVirtualTime):
+
+    """
+    Test injected delays on a virtual clock shared with a threaded server
+    """
+
+    engine = 'thread'
+
+    def test_shared_clock(self):
+        """
+        Test that the clock is advanced once
+        """
+        self.ht.advance_clock(5)
+        self.assertEqual(self.clock.time(), 1005)
+
+
+class TestNoVirtualClock(unittest.TestCase):
+
+    """
+    Test advancing without a virtual clock
+    """
+
+    def test_advance_rejected(self):
+        self.assertRaises(ValueError, HttpTests(shared=False).advance_clock, 1)
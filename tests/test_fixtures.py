@@ -0,0 +1,82 @@
+import unittest
+import requests
+from httpclienttest import HttpTests, RouteFixture
+
+ROUTES = RouteFixture({'/shared': {'GET': 'shared'},
+                       '/shared/<param>': {'POST': None}})
+setUpModule, tearDownModule = ROUTES.install, ROUTES.remove
+
+
+@ROUTES
+class TestModuleRoutes(unittest.TestCase):
+
+    """
+    Test routes installed once for the module
+    """
+
+    def test_a_call(self):
+        """
+        Test that the routes are installed and assertions are provided
+        """
+        resp = requests.get(self.ht.base + '/shared')
+        self.assertEqual(resp.content, 'shared')
+        requests.post(self.ht.base + '/shared/1')
+        self.assertCountRouteCalled('/shared', 1)
+        self.assertEqual(ROUTES.installs, 2)
+
+    def test_b_history_reset(self):
+        """
+        Test that the history of the routes is cleared between tests
+        """
+        self.assertCountRouteCalled('/shared', 0)
+        self.assertCountRouteCalled('/shared/<param>', 0, 'POST')
+
+
+class TestClassRoutes(unittest.TestCase):
+
+    """
+    Test routes installed once for a class
+    """
+
+    def test_installed_once(self):
+        """
+        Test that the routes are added and removed once for the class and
+        history is cleared with one update per test
+        """
+        ht = HttpTests(shared=False)
+        updates = []
+        update_routes = ht.proc.update_routes
+        ht.proc.update_routes = lambda *a: (updates.append(a) or
+                                            update_routes(*a))
+        seen = []
+
+        @RouteFixture({'/a': {'GET': None}, '/b': {'PUT': 'b'}})
+        class Decorated(unittest.TestCase):
+            @classmethod
+            def setUpClass(cls):
+                seen.append('setUpClass')
+
+            def setUp(self):
+                seen.append(self.ht.count_calls('/a'))
+
+            def test_one(self):
+                requests.get(self.ht.base + '/a')
+                self.assertRouteCalled('/a')
+
+            def test_two(self):
+                requests.get(self.ht.base + '/a')
+                self.assertEqual(requests.put(self.ht.base + '/b').content,
+                                 'b')
+
+        Decorated.ht = ht
+        try:
+            result = unittest.TestResult()
+            unittest.defaultTestLoader.loadTestsFromTestCase(
+                Decorated).run(result)
+            self.assertEqual(result.errors + result.failures, [])
+            self.assertEqual(seen, ['setUpClass', 0, 0])
+            # The install, a history clear per test and the removal
+            self.assertEqual(len(updates), 4)
+            self.assertEqual(ht.route_map, {})
+        finally:
+            ht.close()
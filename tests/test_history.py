@@ -0,0 +1,518 @@
+import sys
+import threading
+import unittest
+import requests
+from httpclienttest import HttpTests, CallHistory
+from httpclienttest.history import CallRecord, CapturedRequest
+from httpclienttest.httpserver import LIST
+
+
+def record(rule='/test', method='GET', size=10, headers=None, params=None,
+           time=None):
+    data = {'headers': headers or {}, 'query_params': params or {}}
+    return CallRecord(rule, method, data, size, time)
+
+
+class TestCallHistory(unittest.TestCase):
+
+    """
+    Test call history retention
+    """
+
+    def test_unbounded(self):
+        """
+        Test that all calls are kept by default
+        """
+        history = CallHistory()
+        for i in range(100):
+            history.add(record())
+
+        self.assertEqual(len(history.as_dict()['/test']['GET']), 100)
+        self.assertEqual(history.count('/test', 'GET'), 100)
+
+    def test_max_calls(self):
+        """
+        Test that only the latest calls are kept, counts stay exact
+        """
+        history = CallHistory(max_calls=3)
+        records = [record() for i in range(10)]
+        for rec in records:
+            history.add(rec)
+
+        self.assertEqual(list(history.calls['/test', 'GET']), records[-3:])
+        self.assertEqual(history.count('/test', 'GET'), 10)
+        self.assertIs(history.last('/test', 'GET'), records[-1])
+        self.assertEqual(history.bytes, 30, 'evicted bytes not released')
+
+    def test_retention(self):
+        """
+        Test per route and method retention overrides
+        """
+        history = CallHistory(max_calls=5,
+                              retention={'/one': 1,
+                                         '/post': {'POST': 0}})
+        for i in range(3):
+            history.add(record('/one'))
+            history.add(record('/post', 'POST'))
+            history.add(record('/post', 'GET'))
+
+        self.assertEqual(len(history.calls['/one', 'GET']), 1)
+        self.assertEqual(len(history.calls['/post', 'POST']), 0)
+        self.assertEqual(len(history.calls['/post', 'GET']), 3)
+        self.assertEqual(history.count('/post', 'POST'), 3)
+
+    def test_max_bytes(self):
+        """
+        Test that the oldest calls over all routes are evicted first
+        """
+        history = CallHistory(max_bytes=25)
+        first, second, third = record('/a'), record('/b'), record('/a')
+        for rec in (first, second, third):
+            history.add(rec)
+
+        self.assertTrue(first.dropped, 'oldest record should be evicted')
+        self.assertEqual(list(history.calls['/a', 'GET']), [third])
+        self.assertEqual(list(history.calls['/b', 'GET']), [second])
+        self.assertEqual(history.bytes, 20)
+        self.assertEqual(history.count('/a', 'GET'), 2)
+
+    def test_clear_route(self):
+        """
+        Test that clearing a route releases its bytes and count
+        """
+        history = CallHistory(max_bytes=100)
+        history.add(record('/a'))
+        history.add(record('/b'))
+        history.clear('/a', 'GET')
+
+        self.assertEqual(history.bytes, 10)
+        self.assertEqual(history.count('/a', 'GET'), 0)
+        self.assertNotIn('/a', history.as_dict())
+
+
+class TestCallHistoryQuery(unittest.TestCase):
+
+    """
+    Test call history queries
+    """
+
+    def setUp(self):
+        self.history = CallHistory(max_calls=4, counted=['page'])
+        for i in range(6):
+            self.history.add(record(headers={'Accept': 'json'},
+                                    params={'page': str(i % 2)},
+                                    time=i))
+        self.history.add(record('/other', 'POST', time=6))
+
+    def test_header_filter(self):
+        """
+        Test that header names match regardless of case
+        """
+        records = self.history.query('/test', 'GET', headers={'accept': 'json'})
+        self.assertEqual([r.time for r in records], [2, 3, 4, 5])
+        self.assertEqual(self.history.query('/test', 'GET',
+                                            headers={'Accept': 'xml'}), [])
+
+    def test_param_filter(self):
+        """
+        Test that records are filtered by query string value
+        """
+        records = self.history.query('/test', params={'page': '1'},
+                                     headers={'Accept': 'json'})
+        self.assertEqual([r.time for r in records], [3, 5])
+
+    def test_time_window(self):
+        """
+        Test that records are filtered by arrival time
+        """
+        records = self.history.query(since=4, until=5)
+        self.assertEqual([r.time for r in records], [4, 5])
+        self.assertEqual([r.time for r in self.history.query(since=5)],
+                         [5, 6])
+
+    def test_time_window_out_of_order(self):
+        """
+        Test that records stored after calls which arrived later are found
+        """
+        history = CallHistory()
+        history.add(record(time=11))
+        history.add(record(time=10))
+        self.assertEqual([r.time for r in history.query(since=10.5)], [11])
+        self.assertEqual([r.time for r in history.query('/test', 'GET',
+                                                        until=10.5)], [10])
+        self.assertEqual(history.query_count('/test', 'GET', since=10.5), 1)
+        self.assertEqual(history.query_count('/test', 'GET', since=9), 2)
+
+    def test_exact_counts(self):
+        """
+        Test that counts of a route or a single counted filter include
+        evicted calls, other filters count retained calls
+        """
+        self.assertEqual(self.history.query_count('/test', 'GET'), 6)
+        self.assertEqual(self.history.query_count(method='GET',
+                                                  params={'page': '0'}), 3)
+        self.assertEqual(self.history.query_count(), 7)
+        self.assertEqual(self.history.query_count('/test', 'GET', since=5), 1)
+        self.assertEqual(self.history.query_count(headers={'Accept': 'json'}),
+                         4)
+
+    def test_index_counts_bounded(self):
+        """
+        Test that values of names not counted are forgotten once evicted
+        """
+        history = CallHistory(max_calls=1, counted=['page'])
+        for i in range(100):
+            history.add(record(headers={'X-Request-Id': str(i)},
+                               params={'page': '1'}))
+        self.assertEqual(history.query_count(
+            headers={'X-Request-Id': '99'}), 1)
+        self.assertEqual(history.query_count(
+            headers={'X-Request-Id': '5'}), 0)
+        self.assertEqual(history.index_counts, {
+            ('/test', 'GET'): {('param', 'page', '1'): 100}})
+        self.assertEqual(len(history.indexes['/test', 'GET']), 2)
+
+    def test_index_pruned(self):
+        """
+        Test that evicted records are removed from the indexes
+        """
+        self.history.query_count(params={'page': '0'})
+        index = self.history.indexes['/test', 'GET']
+        self.assertEqual(len(index['param', 'page', '0']), 2)
+        self.assertEqual(len(index['header', 'accept', 'json']), 4)
+
+    def test_deferred_index(self):
+        """
+        Test that records are indexed on query, evicted records are counted
+        """
+        history = CallHistory(max_calls=1, counted=['page'])
+        history.add(record(params={'page': '1'}))
+        history.add(record(params={'page': '1'}))
+        history.add(record(params={'page': '2'}))
+
+        self.assertFalse(history.indexes.get(('/test', 'GET')))
+        self.assertEqual(history.query_count(params={'page': '1'}), 2)
+        self.assertEqual(len(history.query(params={'page': '2'})), 1)
+
+    def test_unindexed(self):
+        """
+        Test that queries scan history when indexing is disabled
+        """
+        history = CallHistory(indexed=False)
+        history.add(record(params={'page': '1'}))
+        history.add(record(params={'page': '2'}))
+
+        self.assertEqual(history.indexes, {})
+        self.assertEqual(history.query_count(params={'page': '2'}), 1)
+
+
+class TestServerQuery(unittest.TestCase):
+
+    """
+    Test call history queries on a running server
+    """
+
+    def setUp(self):
+        self.ht = HttpTests()
+        self.req, _ = self.ht.add_route('/test')
+        requests.get(self.req + '?page=1', headers={'X-Test': 'a'})
+        requests.get(self.req + '?page=2', headers={'X-Test': 'b'})
+
+    def tearDown(self):
+        self.ht.clear_routes()
+
+    def test_query_calls(self):
+        """
+        Test that matching calls are returned
+        """
+        calls = self.ht.query_calls('/test', 'GET', headers={'X-Test': 'b'})
+        self.assertEqual(len(calls), 1, 'expected one call')
+        self.assertDictEqual(calls[0]['query_params'], {'page': '2'})
+
+    def test_count_calls(self):
+        """
+        Test that only the number of matching calls is returned
+        """
+        self.assertEqual(self.ht.count_calls('/test', params={'page': '1'}), 1)
+        self.assertEqual(self.ht.count_calls(since=0), 2)
+        self.ht.assertCountRouteCalledWith('/test', 1,
+                                           headers={'X-Test': 'a'},
+                                           params={'page': '1'})
+
+    def test_api_query_route(self):
+        """
+        Test that a mocked API may have routes named like utility routes
+        """
+        self.ht.add_routes({'/query': {'GET': 'api'},
+                            '/stats': {'GET': 'api'}})
+        self.assertEqual(requests.get(self.ht.base + '/query').content, 'api')
+        self.ht.assertCountRouteCalled('/query', 1)
+        self.ht.assertCountRouteCalled('/test', 2)
+
+    def test_threaded_query(self):
+        """
+        Test queries on the threaded engine
+        """
+        ht = HttpTests(shared=False, engine='thread')
+        try:
+            req, _ = ht.add_route('/test')
+            requests.get(req + '?page=1')
+            requests.get(req + '?page=2')
+
+            calls = ht.query_calls('/test', params={'page': '2'})
+            self.assertEqual(len(calls), 1, 'expected one call')
+            self.assertEqual(ht.count_calls('/test', 'GET'), 2)
+        finally:
+            ht.close()
+
+
+class TestServerRetention(unittest.TestCase):
+
+    """
+    Test retention on a running server
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, max_calls=2)
+        self.req, _ = self.ht.add_route('/test')
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_count_after_eviction(self):
+        """
+        Test that call counts are exact when history is evicted
+        """
+        for i in range(5):
+            requests.get(self.req + '?call=%d' % i)
+
+        self.ht.assertCountRouteCalled('/test', 5)
+        calls = getattr(self.ht, LIST)()['/test']['GET']
+        self.assertEqual([c['query_string'] for c in calls],
+                         ['call=3', 'call=4'])
+
+    def test_count_after_restart(self):
+        """
+        Test that call counts survive a server restart
+        """
+        for i in range(3):
+            requests.get(self.req)
+        self.ht.add_route('/test2', callback=lambda: 'restart')
+
+        self.ht.assertCountRouteCalled('/test', 3)
+
+    def test_counted_option(self):
+        """
+        Test that indexing options are passed to the server
+        """
+        ht = HttpTests(shared=False, max_calls=1, counted=['page'])
+        try:
+            req, _ = ht.add_route('/test')
+            for i in range(3):
+                requests.get(req + '?page=1&id=%d' % i)
+            self.assertEqual(ht.count_calls('/test', params={'page': '1'}), 3)
+            self.assertEqual(ht.count_calls('/test', params={'id': '0'}), 0)
+        finally:
+            ht.close()
+        ht = HttpTests(shared=False, engine='thread', indexed=False)
+        try:
+            self.assertFalse(ht.proc.history.indexed)
+        finally:
+            ht.close()
+
+
+class TestCallHistorySequence(unittest.TestCase):
+
+    """
+    Test call history sequence numbers
+    """
+
+    def test_since_seq(self):
+        """
+        Test that records after a sequence number are returned in order
+        """
+        history = CallHistory(max_calls=3)
+        for i in range(5):
+            history.add(record('/one' if i % 2 else '/two'))
+
+        self.assertEqual([r.seq for r in history.since_seq(2)], [3, 4, 5])
+        self.assertEqual(history.since_seq(5), [])
+
+    def test_seq_after_clear(self):
+        """
+        Test that numbering carries on after history is cleared
+        """
+        history = CallHistory()
+        history.add(record())
+        history.add(record())
+        history.clear()
+        history.add(record())
+
+        self.assertEqual([r.seq for r in history.since_seq(0)], [3])
+
+    def test_load_keeps_seq(self):
+        """
+        Test that loaded records keep their sequence numbers
+        """
+        history = CallHistory()
+        for i in range(3):
+            history.add(record('/one' if i % 2 else '/two'))
+
+        loaded = CallHistory()
+        loaded.load(history.as_dict())
+        self.assertEqual(loaded.seq, 3)
+        self.assertEqual([r.rule for r in loaded.since_seq(1)],
+                         ['/one', '/two'])
+
+
+class TestServerIncrementalHistory(unittest.TestCase):
+
+    """
+    Test call history fetched incrementally from a running server
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False)
+        self.req, _ = self.ht.add_route('/test')
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_new_calls(self):
+        """
+        Test that only calls after the sequence number are fetched
+        """
+        for i in range(3):
+            requests.get(self.req + '?call=%d' % i)
+
+        calls = self.ht.get_new_calls(after=2)
+        self.assertEqual(len(calls), 1, 'expected one call')
+        rule, method, _, call = calls[0]
+        self.assertEqual((rule, method, call['seq']), ('/test', 'GET', 3))
+        self.assertEqual(call['query_string'], 'call=2')
+
+    def test_call_list_synced(self):
+        """
+        Test that the call list is extended with new calls
+        """
+        requests.get(self.req)
+        first = getattr(self.ht, LIST)()['/test']['GET']
+        requests.get(self.req)
+        calls = getattr(self.ht, LIST)()['/test']['GET']
+
+        self.assertEqual([c['seq'] for c in calls], [1, 2])
+        self.assertIs(calls[0], first[0], 'known calls fetched again')
+
+    def test_clear_synced(self):
+        """
+        Test that clearing history clears the local copy
+        """
+        requests.get(self.req)
+        getattr(self.ht, LIST)()
+        self.ht.clear_route_history('/test', 'GET')
+        requests.get(self.req)
+
+        calls = getattr(self.ht, LIST)()['/test']['GET']
+        self.assertEqual([c['seq'] for c in calls], [2])
+
+    def test_seq_after_restart(self):
+        """
+        Test that history and numbering carry over a server restart
+        """
+        requests.get(self.req)
+        self.ht.add_route('/test2', callback=lambda: 'restart')
+        requests.get(self.ht.base + '/test')
+
+        calls = getattr(self.ht, LIST)()['/test']['GET']
+        self.assertEqual([c['seq'] for c in calls], [1, 2])
+
+
+class TestCapturedRequest(unittest.TestCase):
+
+    """
+    Test requests captured raw and decoded on access
+    """
+
+    def capture(self, body='', content_type=None, query_string='a=1'):
+        environ = {'REQUEST_METHOD': 'POST',
+                   'PATH_INFO': '/test',
+                   'QUERY_STRING': query_string,
+                   'HTTP_HOST': 'localhost:8080',
+                   'HTTP_X_TEST': 'yes',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.url_scheme': 'http'}
+        if content_type:
+            environ['CONTENT_TYPE'] = content_type
+        return CallRecord('/test', 'POST', None, time=1.0,
+                          request=CapturedRequest(environ, {}, body))
+
+    def test_decoded_on_access(self):
+        """
+        Test that the record is decoded into the utility API format once
+        """
+        rec = self.capture('{"key": 1}', 'application/json')
+        CallHistory().add(rec)
+        self.assertIsNotNone(rec.request, 'decoded when recorded')
+
+        data = rec.as_dict()
+        self.assertIsNone(rec.request)
+        self.assertEqual(data['body'], {'key': 1})
+        self.assertEqual(data['headers']['X-Test'], 'yes')
+        self.assertEqual(data['query_params'], {'a': '1'})
+        self.assertEqual((data['method'], data['seq'], data['time']),
+                         ('POST', 1, 1.0))
+        self.assertIs(rec.as_dict(), data)
+
+    def test_index_keys_raw(self):
+        """
+        Test that index keys are read without decoding the record
+        """
+        rec = self.capture('payload')
+        self.assertIn(('header', 'x-test', 'yes'), rec.index_keys())
+        self.assertIn(('param', 'a', '1'), rec.index_keys())
+        self.assertIsNotNone(rec.request)
+
+    def test_text_body(self):
+        """
+        Test that non JSON bodies are kept as text
+        """
+        data = self.capture('a=1&b=2',
+                            'application/x-www-form-urlencoded').as_dict()
+        self.assertEqual((data['body'], data['body_encoding']),
+                         ('a=1&b=2', None))
+
+    def test_binary_body(self):
+        """
+        Test that binary bodies are base64 encoded
+        """
+        data = self.capture('\xff\x00\x01').as_dict()
+        self.assertEqual((data['body'], data['body_encoding']),
+                         ('/wAB', 'base64'))
+
+    def test_concurrent_decode(self):
+        """
+        Test that records decoded by several threads at once are decoded
+        """
+        records = [self.capture('payload') for i in range(5000)]
+        errors = []
+
+        def decode():
+            try:
+                for rec in records:
+                    rec.index_keys()
+                    rec.as_dict()['headers']
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=decode) for i in range(4)]
+        # Switch threads as often as possible to interleave the decodes
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
@@ -0,0 +1,75 @@
+import unittest
+import requests
+from httpclienttest import HttpTests, HttpTestServerPool
+
+
+class HttpTestPool(unittest.TestCase):
+
+    """
+    Test the warm server pool
+    """
+
+    def setUp(self):
+        self.pool = HttpTestServerPool(size=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_acquire_hit(self):
+        """
+        Test that an idle server is handed out with the route map
+        """
+        idle = self.pool.idle[0]
+        server, _, _, _ = self.pool.acquire(routes={'/test': {'GET': 'val'}})
+        try:
+            self.assertIs(server, idle, 'idle server should be used')
+            resp = requests.get(server.base + '/test')
+            self.assertEqual(resp.content, 'val', 'route was not added')
+            self.assertEqual(self.pool.stats()['hits'], 1)
+        finally:
+            server.terminate()
+
+    def test_acquire_miss(self):
+        """
+        Test that a new server is started when routes can't be sent
+        """
+        routes = {'/test': {'GET': lambda: 'lambda'}}
+        server, _, _, _ = self.pool.acquire(routes=routes)
+        try:
+            resp = requests.get(server.base + '/test')
+            self.assertEqual(resp.content, 'lambda', 'route was not added')
+            self.assertEqual(self.pool.stats()['misses'], 1)
+            self.assertEqual(len(self.pool.idle), 1,
+                             'idle server should be kept')
+        finally:
+            server.terminate()
+
+    def test_release(self):
+        """
+        Test that released servers are reset and reused
+        """
+        server, _, _, _ = self.pool.acquire(routes={'/test': {'GET': None}})
+        requests.get(server.base + '/test')
+        self.pool.release(server)
+
+        reused, utils, _, _ = self.pool.acquire()
+        self.assertIs(reused, server, 'released server should be reused')
+        self.assertEqual(requests.get(server.base + '/test').status_code, 404,
+                         'routes should be reset')
+        self.assertEqual(utils['get_call_list']['call_func'](), {},
+                         'history should be reset')
+        self.pool.release(reused)
+
+    def test_http_tests_pool(self):
+        """
+        Test that HttpTests takes its server from the pool
+        """
+        ht = HttpTests(shared=False, pool=self.pool)
+        try:
+            req, _ = ht.add_route('/test')
+            requests.get(req)
+            ht.assertRouteCalled('/test')
+            self.assertEqual(self.pool.stats()['hits'], 1)
+        finally:
+            ht.close()
+        self.assertEqual(len(self.pool.idle), 1, 'server should be returned')
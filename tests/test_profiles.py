@@ -0,0 +1,155 @@
+import random
+import threading
+import time
+import unittest
+import requests
+from requests.exceptions import ConnectionError, ReadTimeout, \
+    RequestException
+from httpclienttest import HttpTests, RouteProfile, Fault, Normal, \
+    LogNormal, Percentiles
+
+
+def payload(*a, **k):
+    return 'x' * 1000
+
+
+class TestDistributions(unittest.TestCase):
+
+    """
+    Test delay distributions
+    """
+
+    def setUp(self):
+        self.rand = random.Random(1)
+
+    def test_percentiles(self):
+        """
+        Test that samples follow the percentile table
+        """
+        table = Percentiles({50: 0.01, 90: 0.1, 100: 1})
+        samples = sorted(table.sample(self.rand) for i in range(1000))
+
+        self.assertLessEqual(samples[0], 0.01)
+        self.assertLessEqual(samples[499], 0.02)
+        self.assertGreater(samples[950], 0.1)
+        self.assertLessEqual(samples[-1], 1)
+
+    def test_non_negative(self):
+        """
+        Test that normal samples are not negative
+        """
+        normal = Normal(0, 1)
+        self.assertTrue(all(normal.sample(self.rand) >= 0
+                            for i in range(100)))
+
+    def test_lognormal_median(self):
+        """
+        Test that lognormal samples center on the median
+        """
+        samples = sorted(LogNormal(0.05, 0.5).sample(self.rand)
+                         for i in range(1001))
+        self.assertAlmostEqual(samples[500], 0.05, delta=0.01)
+
+    def test_fault_rate(self):
+        """
+        Test that faults are picked at their rate
+        """
+        profile = RouteProfile(faults=[Fault('error', 0.2),
+                                       Fault('reset', 0.1)], seed=1)
+        picks = [profile.pick_fault() for i in range(1000)]
+        errors = len([f for f in picks if f and f.mode == 'error'])
+        resets = len([f for f in picks if f and f.mode == 'reset'])
+
+        self.assertAlmostEqual(errors, 200, delta=40)
+        self.assertAlmostEqual(resets, 100, delta=30)
+        self.assertRaises(ValueError, Fault, 'missing')
+
+
+class TestServerProfiles(unittest.TestCase):
+
+    """
+    Test latency and faults injected by the server
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False)
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_first_byte(self):
+        """
+        Test that delayed requests don't hold up each other
+        """
+        req, _ = self.ht.add_route('/slow', callback=payload,
+                                   profile=RouteProfile(first_byte=0.3))
+        threads = [threading.Thread(target=requests.get, args=(req,))
+                   for i in range(10)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1, 'delays should overlap')
+        self.ht.assertCountRouteCalled('/slow', 10)
+
+    def test_total(self):
+        """
+        Test that the body is spread until the total time
+        """
+        profile = RouteProfile(first_byte=0.1, total=0.3)
+        req, _ = self.ht.add_route('/slow', callback=payload, profile=profile)
+
+        start = time.time()
+        resp = requests.get(req, stream=True)
+        first_byte = time.time() - start
+        body = resp.content
+        total = time.time() - start
+
+        self.assertEqual(resp.headers['Content-Length'], '1000')
+        self.assertEqual(body, payload())
+        self.assertLess(first_byte, 0.25)
+        self.assertGreaterEqual(total, 0.29)
+
+    def test_error(self):
+        """
+        Test that error faults respond with their status
+        """
+        profile = RouteProfile(faults=[Fault('error', status=502)])
+        req, _ = self.ht.add_route('/fail', profile=profile)
+        self.assertEqual(requests.get(req).status_code, 502)
+
+    def test_reset(self):
+        """
+        Test that reset faults abort the connection
+        """
+        req, _ = self.ht.add_route('/fail', callback=payload,
+                                   profile=RouteProfile(
+                                       faults=[Fault('reset')]))
+        self.assertRaises(ConnectionError, requests.get, req)
+        self.ht.assertCountRouteCalled('/fail', 1)
+
+    def test_truncate(self):
+        """
+        Test that truncate faults cut the body short
+        """
+        req, _ = self.ht.add_route('/fail', callback=payload,
+                                   profile=RouteProfile(
+                                       faults=[Fault('truncate')]))
+        try:
+            resp = requests.get(req)
+        except RequestException:
+            return
+        self.assertEqual(resp.headers['Content-Length'], '1000')
+        self.assertEqual(len(resp.content), 500, 'body not truncated')
+
+    def test_stall(self):
+        """
+        Test that stall faults hold the connection without responding
+        """
+        req, _ = self.ht.add_route('/fail', profile=RouteProfile(
+            faults=[Fault('stall', duration=0.5)]))
+        self.assertRaises(ReadTimeout, requests.get, req, timeout=0.1)
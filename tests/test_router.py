@@ -0,0 +1,181 @@
+import unittest
+import bottle
+import requests
+from httpclienttest import HttpTests
+from httpclienttest.httpserver import HttpTestServer, \
+    ThreadedHttpTestServer, UTIL_PREFIX
+from httpclienttest.router import RadixRouter
+
+
+def environ(path, method='GET'):
+    return {'REQUEST_METHOD': method, 'PATH_INFO': path}
+
+
+class TestRadixRouter(unittest.TestCase):
+
+    """
+    Test matching requests in the routing tree
+    """
+
+    def setUp(self):
+        self.router = RadixRouter()
+        for rule, method in (('/', 'GET'),
+                             ('/users', 'GET'),
+                             ('/users/<name>', 'GET'),
+                             ('/users/<name>', 'DELETE'),
+                             ('/users/me', 'GET'),
+                             ('/users/<name>/posts/<id:int>', 'GET'),
+                             ('/users/<name>/posts/<name2>', 'GET'),
+                             ('/any/<name>', 'ANY'),
+                             ('/files/<rest:path>', 'GET'),
+                             ('/v<version:int>/status', 'GET')):
+            self.router.add(rule, method, (rule, method))
+
+    def match(self, path, method='GET'):
+        return self.router.match(environ(path, method))
+
+    def assertStatus(self, status, path, method='GET'):
+        try:
+            self.match(path, method)
+        except bottle.HTTPError as e:
+            self.assertEqual(e.status_code, status)
+            return e
+        self.fail('%s %s should fail with %d' % (method, path, status))
+
+    def test_static_and_wildcards(self):
+        """
+        Test that static segments are preferred and wildcards are captured
+        and filtered
+        """
+        self.assertEqual(self.match('/'), (('/', 'GET'), {}))
+        self.assertEqual(self.match('/users/me')[0][0], '/users/me')
+        self.assertEqual(self.match('/users/ann'),
+                         (('/users/<name>', 'GET'), {'name': 'ann'}))
+        self.assertEqual(self.match('/users/ann/posts/7'),
+                         (('/users/<name>/posts/<id:int>', 'GET'),
+                          {'name': 'ann', 'id': 7}))
+        self.assertEqual(self.match('/users/ann/posts/new')[1],
+                         {'name': 'ann', 'name2': 'new'})
+        self.assertStatus(404, '/users/')
+        self.assertStatus(404, '/users/ann/posts')
+
+    def test_fallback_rules(self):
+        """
+        Test that rules the tree can not hold are matched by Bottle
+        """
+        self.assertEqual(self.match('/files/a/b.txt')[1], {'rest': 'a/b.txt'})
+        self.assertEqual(self.match('/v2/status')[1], {'version': 2})
+        self.assertStatus(405, '/files/a', 'POST')
+
+    def test_methods(self):
+        """
+        Test that HEAD falls back to GET, ANY matches every method and
+        other methods are listed when only they match
+        """
+        self.assertEqual(self.match('/users', 'HEAD')[0], ('/users', 'GET'))
+        self.assertEqual(self.match('/any/x', 'PATCH')[0],
+                         ('/any/<name>', 'ANY'))
+        error = self.assertStatus(405, '/users/ann', 'PUT')
+        self.assertEqual(error.headers['Allow'], 'DELETE,GET')
+        self.assertStatus(405, '/users', 'POST')
+
+    def test_remove(self):
+        """
+        Test that removed rules no longer match and their branch is pruned
+        """
+        self.router.remove('/users/<name>/posts/<id:int>', 'GET')
+        self.assertEqual(self.match('/users/ann/posts/7')[0][0],
+                         '/users/<name>/posts/<name2>')
+        self.router.remove('/users/<name>/posts/<name2>', 'GET')
+        self.assertStatus(404, '/users/ann/posts/7')
+        users = self.router.root.static[''].static['users']
+        self.assertEqual(users.params[0][4].static, {})
+
+        self.router.remove('/files/<rest:path>', 'GET')
+        self.assertStatus(404, '/files/a')
+        self.router.remove('/missing/<x>', 'GET')
+
+    def test_build(self):
+        self.assertEqual(self.router.build('/users/<name>/posts/<id:int>',
+                                           name='ann', id=7),
+                         '/users/ann/posts/7')
+
+
+class TestLargeRouteMap(unittest.TestCase):
+
+    """
+    Test serving a large route map
+    """
+
+    def test_large_route_map(self):
+        """
+        Test that thousands of templated routes are served and a utility
+        path taken by a route is moved deterministically
+        """
+        routes = dict(('/api/res%d/<id>' % i, {'GET': 'res%d' % i})
+                      for i in range(5000))
+        taken = UTIL_PREFIX + '/getcalls'
+        routes[taken] = {'GET': 'taken'}
+        server, utils, _, _ = ThreadedHttpTestServer(routes=routes).start()
+        try:
+            resp = requests.get(server.base + '/api/res4999/1')
+            self.assertEqual(resp.content, 'res4999')
+            self.assertEqual(requests.get(server.base + taken).content,
+                             'taken')
+            self.assertEqual(utils['get_call_list']['path'],
+                             '/0' + taken[1:])
+            self.assertEqual(len(server._get_call_list()), 2)
+        finally:
+            server.terminate()
+
+
+class TestUtilityPaths(unittest.TestCase):
+
+    """
+    Test routes taking the path of a utility route
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False)
+        self.req, _ = self.ht.add_route('/test')
+        requests.get(self.req)
+        self.taken = UTIL_PREFIX + '/query'
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_placed_before_start(self):
+        """
+        Test that both processes agree on a moved utility path
+        """
+        server, utils, _, _ = HttpTestServer(
+            routes={self.taken: {'GET': 'taken'}}).start()
+        try:
+            self.assertEqual(utils['query_calls']['path'],
+                             '/0' + self.taken[1:])
+            self.assertEqual(requests.get(server.base + self.taken).content,
+                             'taken')
+            self.assertEqual(server._query_calls(count=True), 1)
+        finally:
+            server.terminate()
+
+    def test_add_route(self):
+        """
+        Test that adding a route on a utility path restarts the server with
+        the utility route moved
+        """
+        proc = self.ht.proc
+        self.ht.add_route(self.taken, 'GET', 'user')
+        self.assertIsNot(self.ht.proc, proc)
+        self.assertEqual(requests.get(self.ht.base + self.taken).content,
+                         'user')
+        self.assertEqual(self.ht.count_calls('/test', 'GET'), 1)
+        self.ht.assertCountRouteCalled(self.taken, 1)
+
+    def test_reset_route_map(self):
+        self.ht.reset_route_map({self.taken: {'GET': 'user'},
+                                 '/test': {'GET': None}})
+        requests.get(self.ht.base + '/test')
+        self.ht.assertCountRouteCalled('/test', 1)
+        self.assertEqual(requests.get(self.ht.base + self.taken).content,
+                         'user')
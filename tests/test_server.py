@@ -1,15 +1,26 @@
+import gc
+import time
+import threading
 import unittest
+import weakref
 import requests
 from pprint import pprint
 from httpclienttest import HttpTests, Singleton, add_route, \
-    add_routes, delete_route, start_http
-from httpclienttest.httpserver import LIST, CLEAR, GETROUTE, LAST
+    add_routes, delete_route, start_http, StreamingResponse
+from httpclienttest.httpserver import LIST, CLEAR, GETROUTE, LAST, \
+    QUERY, CLEARROUTE, UTIL_PREFIX, HttpTestServer, ThreadedHttpTestServer
+from requests.exceptions import ConnectionError
 
 
 def dummy(*a, **k):
     return 'dummy'
 
 
+def slow(*a, **k):
+    time.sleep(0.2)
+    return 'slow'
+
+
 class HttpTestAddRoute(unittest.TestCase):
 
     """
@@ -202,3 +213,531 @@ class HttpTestDecoratorsDelete(unittest.TestCase):
         resp = requests.get(self.req)
         msg = 'route %s has not been removed' % self.test_route
         self.assertEqual(resp.status_code, 404, msg)
+
+
+class HttpTestRouteTransactions(unittest.TestCase):
+
+    """
+    Test route changes grouped into one server update
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False)
+        self.ht.add_route('/keep')
+        self.ht.add_route('/old')
+        self.updates = []
+        update_routes = self.ht.proc.update_routes
+        self.ht.proc.update_routes = lambda *a: (self.updates.append(a) or
+                                                 update_routes(*a))
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_one_update(self):
+        """
+        Test that adds, deletes and history clears are applied at once
+        """
+        requests.get(self.ht.base + '/keep')
+        with self.ht.route_transaction():
+            self.ht.add_route('/new', 'POST', dummy)
+            with self.ht.route_transaction():
+                self.ht.delete_route('/old', 'GET')
+            self.ht.clear_route_history('/keep', 'GET')
+            self.assertEqual(requests.post(self.ht.base + '/new').status_code,
+                             404, 'applied before the end of the transaction')
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual(requests.post(self.ht.base + '/new').content,
+                         'dummy')
+        self.assertEqual(requests.get(self.ht.base + '/old').status_code, 404)
+        self.assertEqual(self.ht.count_calls('/keep'), 0)
+
+    def test_rollback(self):
+        """
+        Test that nothing is applied if the block raises
+        """
+        def fail():
+            with self.ht.route_transaction():
+                self.ht.add_route('/new')
+                self.ht.delete_route('/old', 'GET')
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.updates, [])
+        self.assertEqual(sorted(self.ht.route_map), ['/keep', '/old'])
+        self.assertEqual(requests.get(self.ht.base + '/old').status_code, 200)
+
+    def test_reset_modified_map(self):
+        """
+        Test that a route map modified by the caller and reset again is
+        served as modified
+        """
+        routes = {'/a': {'GET': 'a'}}
+        self.ht.reset_route_map(routes)
+        routes['/b'] = {'GET': 'b'}
+        self.ht.reset_route_map(routes)
+        self.assertEqual(requests.get(self.ht.base + '/b').content, 'b')
+        self.assertIsNot(self.ht.route_map, routes)
+
+    def test_rollback_replaced(self):
+        """
+        Test that a rolled back transaction restores replaced routes
+        """
+        def fail():
+            with self.ht.route_transaction():
+                self.ht.add_route('/keep', 'GET', 'changed')
+                self.ht.add_route('/keep', 'GET', 'again')
+                self.ht.reset_route_map({'/other': {'GET': None}})
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.ht.route_map, {'/keep': {'GET': None},
+                                             '/old': {'GET': None}})
+        self.ht.add_route('/keep', 'GET', 'changed')
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual(self.updates[0][:2],
+                         ({'/keep': {'GET': 'changed'}}, []))
+
+    def test_stacked_decorators(self):
+        """
+        Test that stacked route decorators update the server once on setup
+        and once on teardown
+        """
+        seen = []
+
+        class Decorated(unittest.TestCase):
+            @add_route('/a')
+            @delete_route('/old')
+            @add_routes({'/b': {'GET': 'b'}, '/c': {'POST': None}})
+            @add_route('/d')
+            def runTest(case):
+                seen.append(sorted(case.ht.route_map))
+                requests.get(case.ht.base + '/a')
+
+        case = Decorated()
+        case.ht = self.ht
+        case.runTest()
+
+        self.assertEqual(seen, [['/a', '/b', '/c', '/d', '/keep']])
+        self.assertEqual(len(self.updates), 2)
+        self.assertEqual(sorted(self.ht.route_map), ['/keep', '/old'])
+        self.assertEqual(self.ht.count_calls('/a'), 0)
+
+
+class HttpTestHotReload(unittest.TestCase):
+
+    """
+    Test that routes are modified without restarting the server
+    """
+
+    def setUp(self):
+        self.ht = HttpTests()
+        self.req, _ = self.ht.add_route('/test')
+        self.last_func = getattr(self.ht, LAST)
+
+    def tearDown(self):
+        self.ht.clear_routes()
+
+    def test_add_route_keeps_process(self):
+        """
+        Test that adding and deleting routes does not restart the server
+        """
+        proc = self.ht.proc
+        req, _ = self.ht.add_route('/test2')
+        self.ht.delete_route('/test', 'GET')
+
+        self.assertIs(self.ht.proc, proc, 'server should not be restarted')
+        self.assertEqual(requests.get(req).status_code, 200,
+                         'Route was not added')
+        self.assertEqual(requests.get(self.req).status_code, 404,
+                         'Route was not removed')
+
+    def test_history_kept(self):
+        """
+        Test that call history survives a route change
+        """
+        requests.get(self.req)
+        self.ht.add_route('/test2')
+
+        self.ht.assertCountRouteCalled('/test', 1)
+
+    def test_route_replaced(self):
+        """
+        Test that re-adding a route replaces its callback
+        """
+        self.ht.add_route('/test', callback='Return')
+        resp = requests.get(self.req)
+        self.assertEqual(resp.content, 'Return', 'Route was not replaced')
+
+    def test_unpicklable_callback(self):
+        """
+        Test that callbacks which can't be sent restart the server
+        """
+        requests.get(self.req)
+        self.ht.add_route('/test2', callback=lambda: 'lambda')
+
+        resp = requests.get(self.ht.base + '/test2')
+        self.assertEqual(resp.content, 'lambda', 'Route was not added')
+        self.ht.assertCountRouteCalled('/test', 1)
+
+
+class HttpTestThreadedServer(unittest.TestCase):
+
+    """
+    Test the server run on a thread of the test process
+    """
+
+    def setUp(self):
+        server = ThreadedHttpTestServer(routes={'/test': {'GET': None}})
+        self.server, self.utils, host, port = server.start()
+        self.base = 'http://%s:%s' % (host, port)
+
+    def tearDown(self):
+        self.server.terminate()
+
+    def test_calls_shared(self):
+        """
+        Test that call history is read without an HTTP request
+        """
+        requests.get(self.base + '/test?key=val')
+
+        calls = self.utils[LIST]['call_func']()
+        self.assertEqual(len(calls['/test']['GET']), 1, 'call not recorded')
+
+        last_call = self.utils[GETROUTE]['call_func']('/test', 'GET')
+        self.assertIs(last_call, self.server.history.last_call.as_dict(),
+                      'last call should not be copied')
+        self.assertDictEqual(last_call['query_params'], {'key': 'val'})
+
+    def test_relative_paths(self):
+        """
+        Test that routes given without a leading slash are found, as with
+        the process engine
+        """
+        requests.get(self.base + '/test')
+        self.assertIsNotNone(self.utils[GETROUTE]['call_func']('test', 'GET'))
+        self.assertEqual(self.utils[QUERY]['call_func']('test', count=True),
+                         1)
+        self.utils[CLEARROUTE]['call_func']('test', 'GET')
+        self.assertIsNone(self.utils[GETROUTE]['call_func']('/test', 'GET'))
+        self.assertFalse(hasattr(self.server, '_control'),
+                         'no control pipe is needed')
+
+    def test_update_routes(self):
+        """
+        Test that routes are modified directly
+        """
+        self.server.update_routes({'/test2': {'PUT': 'Return'}},
+                                  [('/test', 'GET')])
+
+        resp = requests.put(self.base + '/test2')
+        self.assertEqual(resp.content, 'Return', 'Route was not added')
+        resp = requests.get(self.base + '/test')
+        self.assertEqual(resp.status_code, 404, 'Route was not removed')
+
+    def test_keep_alive(self):
+        """
+        Test that requests from a session share a connection
+        """
+        session = requests.Session()
+        session.post(self.base + '/missing', data='unread body')
+        for i in range(3):
+            resp = session.get(self.base + '/test')
+            self.assertEqual(resp.status_code, 200, 'request failed')
+
+        self.assertEqual(len(self.server.adapter.srv.connections), 1,
+                         'connection should be reused')
+
+    def test_terminate(self):
+        """
+        Test that the server thread stops
+        """
+        self.server.terminate()
+        self.assertFalse(self.server.is_alive(), 'thread should be stopped')
+        self.server.start()
+
+
+class HttpTestServerStart(unittest.TestCase):
+
+    """
+    Test server start up and port allocation
+    """
+
+    def test_ephemeral_ports(self):
+        """
+        Test that servers are given distinct ports when none is specified
+        """
+        server1, _, _, port1 = HttpTestServer().start()
+        server2, _, _, port2 = HttpTestServer().start()
+        try:
+            self.assertNotEqual(port1, 0, 'port should be reported')
+            self.assertNotEqual(port1, port2, 'ports should differ')
+            resp = requests.get(server2.base + UTIL_PREFIX + '/getcalls')
+            self.assertEqual(resp.status_code, 200, 'server not listening')
+        finally:
+            server1.terminate()
+            server2.terminate()
+
+    def test_port_in_use(self):
+        """
+        Test that a failure to bind is reported without waiting
+        """
+        server, _, _, port = HttpTestServer().start()
+        try:
+            self.assertRaises(ConnectionError,
+                              HttpTestServer(port=port).start)
+            self.assertRaises(ConnectionError,
+                              ThreadedHttpTestServer(port=port).start)
+        finally:
+            server.terminate()
+
+
+class HttpTestInstances(unittest.TestCase):
+
+    """
+    Test independent HttpTests instances
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, engine='thread')
+        self.req, _ = self.ht.add_route('/test')
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_shared_instance(self):
+        """
+        Test that the shared instance is returned by default
+        """
+        self.assertIs(HttpTests(), HttpTests(), 'instance should be shared')
+        self.assertIsNot(self.ht, HttpTests(), 'instance should not be shared')
+
+    def test_separate_servers(self):
+        """
+        Test that instances run separate servers with their own history
+        """
+        shared = HttpTests()
+        self.assertNotEqual(self.ht.port, shared.port, 'ports should differ')
+
+        requests.get(self.req)
+        self.ht.assertCountRouteCalled('/test', 1)
+        self.assertNotIn('/test', getattr(shared, LIST)(),
+                         'history should not be shared')
+
+    @add_route('/test2')
+    def test_decorator_instance(self):
+        """
+        Test that decorators use an instance set up by the test case
+        """
+        resp = requests.get(self.req.replace('/test', '/test2'))
+        self.assertEqual(resp.status_code, 200, 'route was not added')
+        self.assertRouteCalled('/test2')
+
+    def test_closed_instance_freed(self):
+        """
+        Test that a closed instance is not kept alive until exit
+        """
+        ht = HttpTests(shared=False)
+        ht.add_route('/test')
+        proc = ht.proc
+        ref = weakref.ref(ht)
+        ht.close()
+        del ht
+        gc.collect()
+        self.assertIsNone(ref(), 'closed instance was kept')
+        self.assertTrue(proc._control.closed, 'control pipe left open')
+
+
+class HttpTestServerEngines(unittest.TestCase):
+
+    """
+    Test the selectable WSGI servers
+    """
+
+    def start(self, server, callback=slow):
+        try:
+            routes = {'/slow': {'GET': callback}}
+            started = ThreadedHttpTestServer(routes=routes,
+                                             server=server).start()
+        except ConnectionError as e:
+            self.skipTest('%s server unavailable: %s' % (server, e))
+        self.addCleanup(started[0].terminate)
+        return started
+
+    def fetch_concurrently(self, base, count):
+        threads = [threading.Thread(target=requests.get, args=(base + '/slow',))
+                   for i in range(count)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def assert_concurrent(self, server, callback=slow):
+        server, utils, _, _ = self.start(server, callback)
+        elapsed = self.fetch_concurrently(server.base, 20)
+
+        self.assertLess(elapsed, 2, 'requests should be handled concurrently')
+        calls = utils[LIST]['call_func']()
+        self.assertEqual(len(calls['/slow']['GET']), 20,
+                         'all calls should be recorded')
+
+    def test_threaded(self):
+        """
+        Test that the threaded server handles requests concurrently
+        """
+        self.assert_concurrent('threaded')
+
+    def test_gevent(self):
+        """
+        Test that the gevent server handles requests concurrently
+        """
+        try:
+            import gevent
+        except ImportError:
+            self.skipTest('gevent not installed')
+
+        def gevent_slow(*a, **k):
+            gevent.sleep(0.2)
+            return 'slow'
+
+        self.assert_concurrent('gevent', gevent_slow)
+
+    def test_wsgiref(self):
+        """
+        Test that the single threaded server serves requests
+        """
+        server, _, _, _ = self.start('wsgiref')
+        resp = requests.get(server.base + '/slow')
+        self.assertEqual(resp.content, 'slow', 'unexpected response')
+
+    def test_unknown_server(self):
+        """
+        Test that an unknown server is rejected
+        """
+        self.assertRaises(ValueError, HttpTestServer, server='missing')
+
+
+def count_up(*a, **k):
+    for i in range(5):
+        yield str(i)
+
+
+class HttpTestStreaming(unittest.TestCase):
+
+    """
+    Test streaming responses
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False)
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_generator_chunked(self):
+        """
+        Test that generator callbacks are sent chunked on a kept connection
+        """
+        req, _ = self.ht.add_route('/stream', callback=count_up)
+        session = requests.Session()
+        resp = session.get(req)
+
+        self.assertEqual(resp.headers.get('Transfer-Encoding'), 'chunked')
+        self.assertNotIn('close', resp.headers.get('Connection', ''))
+        self.assertEqual(resp.content, '01234', 'unexpected response')
+        resp = session.get(req)
+        self.assertEqual(resp.content, '01234', 'connection not reusable')
+
+    def test_chunk_size(self):
+        """
+        Test that the body is split into chunks of at most chunk_size
+        """
+        stream = StreamingResponse(['abcdefg', 'hi'], chunk_size=3)
+        self.assertEqual(list(stream()), ['abc', 'def', 'g', 'hi'])
+
+        req, _ = self.ht.add_route('/stream', callback=stream)
+        resp = requests.get(req, stream=True)
+        chunks = list(resp.raw.read_chunked())
+        self.assertEqual(chunks, ['abc', 'def', 'g', 'hi'])
+
+    def test_rate(self):
+        """
+        Test that the bandwidth is capped at the rate
+        """
+        stream = StreamingResponse('x' * 2000, chunk_size=500, rate=10000)
+        req, _ = self.ht.add_route('/stream', callback=stream)
+
+        start = time.time()
+        resp = requests.get(req)
+        self.assertEqual(len(resp.content), 2000)
+        self.assertGreaterEqual(time.time() - start, 0.19,
+                                'response faster than the rate')
+
+
+class HttpTestWaitForCalls(unittest.TestCase):
+
+    """
+    Test waiting for calls made by background clients
+    """
+
+    engine = 'process'
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, engine=self.engine)
+        self.req, _ = self.ht.add_route('/test')
+
+    def tearDown(self):
+        self.ht.close()
+
+    def call_later(self, delay, count=1):
+        def calls():
+            time.sleep(delay)
+            for _ in range(count):
+                requests.get(self.req)
+        client = threading.Thread(target=calls)
+        client.daemon = True
+        client.start()
+        return client
+
+    def test_woken_on_call(self):
+        """
+        Test that the wait ends as soon as the last call is recorded
+        """
+        self.call_later(0.1, 3)
+        start = time.time()
+        self.assertEqual(self.ht.wait_for_calls('/test', count=3), 3)
+        woken = time.time()
+        self.assertLess(woken - start, 2)
+        arrival = self.ht.get_last_route('/test', 'GET')['time']
+        self.assertLess(woken - arrival, 0.05, 'wake up was late')
+
+    def test_timeout(self):
+        """
+        Test that the number of calls so far is returned on timeout
+        """
+        requests.get(self.req)
+        start = time.time()
+        self.assertEqual(self.ht.wait_for_calls('/test', count=2,
+                                                timeout=0.1), 1)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(self.ht.wait_for_calls('/test', 'POST', 0), 0)
+
+    def test_assertion(self):
+        """
+        Test the assertion on calls made within a timeout
+        """
+        self.call_later(0.05)
+        self.ht.assertRouteCalledWithin('/test', 2)
+        self.assertRaisesRegexp(AssertionError, 'called 2 times within',
+                                self.ht.assertRouteCalledWithin, '/test',
+                                0.05, 2)
+
+
+class HttpTestThreadedWaitForCalls(HttpTestWaitForCalls):
+
+    """
+    Test waiting for calls on the threaded engine
+    """
+
+    engine = 'thread'
@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from httpclienttest import HttpTests, StaticResponse, SpecError, \
+    load_spec, spec_routes
+
+OPENAPI = {
+    'openapi': '3.0.0',
+    'servers': [{'url': 'https://api.example.com/{version}',
+                 'variables': {'version': {'default': 'v2'}}}],
+    'paths': {
+        '/users/{user-id}': {
+            'get': {'responses': {
+                '404': {'description': 'missing'},
+                '200': {'$ref': '#/components/responses/User'}}},
+            'delete': {'responses': {'204': {'description': 'gone'}}}},
+        '/users': {
+            'parameters': [],
+            'post': {'responses': {
+                'default': {'content': {'text/plain': {
+                    'examples': {'ok': {'value': 'created'}}}}}}}}},
+    'components': {
+        'responses': {'User': {
+            'headers': {'X-Rate': {'schema': {'example': 10}}},
+            'content': {
+                'application/xml': {'example': '<user/>'},
+                'application/json': {'schema': {
+                    '$ref': '#/components/schemas/User'}}}}},
+        'schemas': {'User': {'type': 'object',
+                             'example': {'name': 'ann'}}}}}
+
+
+class TestSpecRoutes(unittest.TestCase):
+
+    """
+    Test building route maps from parsed specs
+    """
+
+    def test_openapi(self):
+        """
+        Test that operations answer with their example under the server
+        path
+        """
+        routes = spec_routes(OPENAPI)
+        self.assertEqual(sorted(routes), ['/v2/users', '/v2/users/<user_id>'])
+        self.assertEqual(sorted(routes['/v2/users/<user_id>']),
+                         ['DELETE', 'GET'])
+        self.assertEqual(routes['/v2/users/<user_id>']['GET'],
+                         StaticResponse('{"name": "ann"}', 200,
+                                        {'Content-Type': 'application/json',
+                                         'X-Rate': '10'}))
+        self.assertEqual(routes['/v2/users/<user_id>']['DELETE'],
+                         StaticResponse(status=204))
+        self.assertEqual(routes['/v2/users']['POST'],
+                         StaticResponse('created', 200,
+                                        {'Content-Type': 'text/plain'}))
+
+    def test_swagger(self):
+        routes = spec_routes({
+            'swagger': '2.0',
+            'basePath': '/api/',
+            'paths': {'/items/{id}': {'get': {'responses': {
+                201: {'examples': {'application/json': [1, 2]}}}}}}})
+        self.assertEqual(routes, {'/api/items/<id>': {
+            'GET': StaticResponse('[1, 2]', 201,
+                                  {'Content-Type': 'application/json'})}})
+
+    def test_routes(self):
+        """
+        Test the plain route spec format
+        """
+        routes = spec_routes({'routes': {
+            '/a/<x>': {'get': {'body': {'a': 1}, 'headers': {'X-A': 'b'}},
+                       'DELETE': {'status': 204}},
+            '/b': {'PUT': None}}})
+        self.assertEqual(routes, {
+            '/a/<x>': {'GET': StaticResponse({'a': 1}, 200, {'X-A': 'b'}),
+                       'DELETE': StaticResponse(status=204)},
+            '/b': {'PUT': StaticResponse()}})
+        self.assertRaises(SpecError, spec_routes, {'paths': {}})
+        self.assertRaises(SpecError, spec_routes, [])
+
+
+class TestLoadSpec(unittest.TestCase):
+
+    """
+    Test loading spec files
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, 'cache')
+        self.path = os.path.join(self.dir, 'api.json')
+        with open(self.path, 'w') as out:
+            json.dump(OPENAPI, out)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_cache(self):
+        """
+        Test that a spec is parsed once and then read from the cache until
+        it changes
+        """
+        routes = load_spec(self.path, self.cache)
+        self.assertEqual(routes, spec_routes(OPENAPI))
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+        self.assertEqual(load_spec(self.path, self.cache), routes)
+
+        # A cached entry is used without parsing the spec
+        entry = os.path.join(self.cache, os.listdir(self.cache)[0])
+        with open(entry, 'wb') as out:
+            json.dump({'/cached': {'GET': [201, {'X-A': u'\xe9'}, u'hi']}},
+                      out)
+        self.assertEqual(load_spec(self.path, self.cache), {'/cached': {
+            'GET': StaticResponse('hi', 201, {'X-A': u'\xe9'})}})
+        self.assertEqual(load_spec(self.path, False), routes)
+
+        # Entries which are not responses are ignored
+        with open(entry, 'wb') as out:
+            json.dump({'/cached': {'GET': {'py/object': 'os.system'}}}, out)
+        self.assertEqual(load_spec(self.path, self.cache), routes)
+
+        with open(self.path, 'w') as out:
+            json.dump({'routes': {'/new': {'GET': None}}}, out)
+        self.assertEqual(load_spec(self.path, self.cache),
+                         {'/new': {'GET': StaticResponse()}})
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+    def test_shared_cache_dir(self):
+        """
+        Test that a cache directory others can write to is not used
+        """
+        os.mkdir(self.cache)
+        os.chmod(self.cache, 0o777)
+        self.assertEqual(load_spec(self.path, self.cache),
+                         spec_routes(OPENAPI))
+        self.assertEqual(os.listdir(self.cache), [])
+
+        os.rmdir(self.cache)
+        load_spec(self.path, self.cache)
+        self.assertEqual(os.stat(self.cache).st_mode & 0o777, 0o700)
+
+    def test_invalid(self):
+        with open(self.path, 'w') as out:
+            out.write('{"routes":')
+        self.assertRaises(SpecError, load_spec, self.path, False)
+
+    def test_yaml(self):
+        """
+        Test that YAML specs are read with PyYAML when it is installed
+        """
+        path = os.path.join(self.dir, 'api.yaml')
+        with open(path, 'w') as out:
+            out.write('routes:\n  /yaml:\n    GET:\n      body: yes\n')
+        try:
+            import yaml
+        except ImportError:
+            self.assertRaises(SpecError, load_spec, path, False)
+            return
+        self.assertEqual(load_spec(path, False),
+                         {'/yaml': {'GET': StaticResponse(True)}})
+
+    def test_serve(self):
+        """
+        Test that the loaded routes are served by both engines
+        """
+        for engine in ('process', 'thread'):
+            ht = HttpTests(shared=False, engine=engine)
+            try:
+                ht.add_routes(load_spec(self.path, self.cache))
+                resp = requests.get(ht.base + '/v2/users/7')
+                self.assertEqual(resp.json(), {'name': 'ann'})
+                self.assertEqual(resp.headers['X-Rate'], '10')
+                resp = requests.delete(ht.base + '/v2/users/7')
+                self.assertEqual(resp.status_code, 204)
+                ht.assertRouteCalled('/v2/users/<user_id>', 'DELETE')
+            finally:
+                ht.close()
@@ -0,0 +1,152 @@
+import json
+import random
+import unittest
+import requests
+from httpclienttest import HttpTests, StreamingResponse, VirtualClock
+from httpclienttest.httpserver import UTIL_PREFIX
+from httpclienttest.stats import Histogram, RouteTiming
+
+
+class TestHistogram(unittest.TestCase):
+
+    """
+    Test the log-linear histogram
+    """
+
+    def test_small_values_exact(self):
+        """
+        Test that values below the sub bucket count are exact
+        """
+        histogram = Histogram()
+        for value in range(100):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(50), 49)
+        self.assertEqual(histogram.percentile(100), 99)
+        self.assertEqual(histogram.percentile(0), 0)
+
+    def test_relative_error(self):
+        """
+        Test that percentiles of large values stay within the error bound
+        """
+        rand = random.Random(7)
+        values = sorted(int(rand.lognormvariate(10, 2)) for _ in range(5000))
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+        for percentile in (50, 90, 99, 99.9):
+            exact = values[int(len(values) * percentile / 100.0) - 1]
+            found = histogram.percentile(percentile)
+            self.assertGreaterEqual(found, exact)
+            self.assertLessEqual(found, exact * (1 + 2 ** -6) + 1)
+        self.assertEqual(histogram.percentile(100), values[-1])
+        self.assertLess(len(histogram.counts), 1500)
+
+    def test_round_trip(self):
+        """
+        Test that timing survives conversion to JSON
+        """
+        timing = RouteTiming()
+        timing.add(10, 0.001, 0.002, 5, 7)
+        timing.add(12, 0.003, 0.25, 0, 9)
+        copy = RouteTiming.from_dict(json.loads(json.dumps(timing.as_dict())))
+        self.assertEqual(copy.count, 2)
+        self.assertEqual(copy.bytes_out, 16)
+        self.assertEqual(copy.rate(), 0.5)
+        self.assertEqual(copy.latency(100), timing.latency(100))
+        self.assertAlmostEqual(copy.latency(50, 'callback'), 0.001,
+                               delta=0.001 * 2 ** -6)
+
+
+class TestServerStats(unittest.TestCase):
+
+    """
+    Test request timing recorded by the server
+    """
+
+    engine = 'process'
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, engine=self.engine)
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_counts_and_bytes(self):
+        """
+        Test that requests and their body sizes are counted per method
+        """
+        url, _ = self.ht.add_route('/echo', 'POST', callback='x' * 10)
+        self.ht.add_route('/echo', 'GET')
+        for _ in range(3):
+            requests.post(url, data='y' * 20)
+        requests.get(url)
+
+        stats = self.ht.route_stats('/echo', 'POST')
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.bytes_in, 60)
+        self.assertEqual(stats.bytes_out, 30)
+        self.assertEqual(self.ht.route_stats('/echo').count, 1)
+        self.assertIsNone(self.ht.route_stats(UTIL_PREFIX + '/getcalls'))
+        self.ht.assertRouteLatencyBelow('/echo', 1, method='POST')
+        self.ht.assertRouteRateAbove('/echo', 0.001, method='POST')
+
+    def test_streamed_bytes(self):
+        """
+        Test that streamed responses are counted once sent
+        """
+        url, _ = self.ht.add_route('/stream', callback=StreamingResponse(
+            ['a' * 100] * 5))
+        self.assertEqual(len(requests.get(url).content), 500)
+        self.assertEqual(self.ht.route_stats('/stream').bytes_out, 500)
+
+    def test_cleared(self):
+        """
+        Test that timing is cleared with the call history of the route
+        """
+        url, _ = self.ht.add_route('/test')
+        requests.get(url)
+        self.ht.clear_route_history('/test', 'GET')
+        self.assertIsNone(self.ht.route_stats('/test'))
+
+    def test_assertions_fail(self):
+        """
+        Test that the assertions fail on routes without enough timing
+        """
+        url, _ = self.ht.add_route('/test')
+        self.assertRaises(AssertionError, self.ht.assertRouteLatencyBelow,
+                          '/test', 1)
+        requests.get(url)
+        self.assertRaises(AssertionError, self.ht.assertRouteLatencyBelow,
+                          '/test', 0)
+        self.assertRaises(AssertionError, self.ht.assertRouteRateAbove,
+                          '/test', 1)
+
+
+class TestThreadedServerStats(TestServerStats):
+
+    """
+    Test request timing recorded by a threaded server
+    """
+
+    engine = 'thread'
+
+    def test_virtual_timing(self):
+        """
+        Test that timing follows the server clock
+        """
+        clock = VirtualClock(start=0)
+        ht = HttpTests(shared=False, engine='thread', clock=clock)
+        try:
+            url, _ = ht.add_route('/slow', callback=lambda: clock.advance(2))
+            for _ in range(5):
+                requests.get(url)
+            stats = ht.route_stats('/slow')
+            self.assertEqual(stats.latency(99, 'callback'), 2)
+            self.assertEqual(stats.latency(50), 2)
+            self.assertEqual(stats.rate(), 0.5)
+            ht.assertRouteLatencyBelow('/slow', 2.1)
+            self.assertRaises(AssertionError, ht.assertRouteLatencyBelow,
+                              '/slow', 2)
+            ht.assertRouteRateAbove('/slow', 0.4)
+        finally:
+            ht.close()
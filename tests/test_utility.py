@@ -1,6 +1,8 @@
 import unittest
+import urlparse
 import requests
-from httpclienttest.httpserver import LIST, CLEAR, GETROUTE, LAST
+from httpclienttest.httpserver import LIST, CLEAR, GETROUTE, LAST, \
+    PICKLE_TYPE, UTIL_PREFIX, new_session
 from httpclienttest import HttpTests, add_route, delete_route, start_http
 
 
@@ -69,7 +71,7 @@ class TestUtilityFunctions(unittest.TestCase):
         self.assertEqual(res['query_string'], 'key=val',
                          'query_string incorrect')
         self.assertEqual(res['method'], 'POST', 'method incorrect')
-        #self.assertEqual(res['body'], 'postdata')
+        self.assertEqual(res['body'], 'postdata', 'body incorrect')
         self.assertDictEqual(res['query_params'], {'key': 'val'},
                              'query_params does not contain expected dict')
         self.assertDictEqual(res['args'], {'param': '12345'},
@@ -152,3 +154,60 @@ class TestUtilityFunctions(unittest.TestCase):
             param_dict = {'p1': '1234', 'p2': '5678'}
 
             self.assertLastRouteCallParams(test, param_dict)
+
+
+class TestUtilityTransport(unittest.TestCase):
+
+    """
+    Test the encodings of utility API responses
+    """
+
+    def setUp(self):
+        self.ht = HttpTests(shared=False, transport='pickle')
+        self.req, _ = self.ht.add_route('/test/<param>')
+        requests.get(self.req.replace('<param>', '1') + '?a=b')
+
+    def tearDown(self):
+        self.ht.close()
+
+    def test_json_default(self):
+        """
+        Test that JSON is asked for unless pickle is chosen
+        """
+        ht = HttpTests(shared=False, engine='thread')
+        self.assertEqual(ht.session.headers['Accept'], 'application/json')
+        ht.close()
+        self.assertEqual(new_session().headers['Accept'], 'application/json')
+
+    def test_pickle_keeps_types(self):
+        """
+        Test that pickled calls keep their Python types
+        """
+        res = getattr(self.ht, GETROUTE)('/test/<param>', 'GET')
+        self.assertIsInstance(res['urlparts'], urlparse.SplitResult)
+        self.assertEqual(res['urlparts'].path, '/test/1')
+        self.assertEqual(res['query_params'], {'a': 'b'})
+
+    def test_json_fallback(self):
+        """
+        Test that clients not asking for pickles are sent JSON
+        """
+        resp = requests.get(self.ht.base + UTIL_PREFIX + '/getlast')
+        self.assertEqual(resp.headers['Content-Type'], 'application/json')
+        self.assertEqual(resp.json()['urlparts'][2], '/test/1')
+
+        resp = requests.get(self.ht.base + UTIL_PREFIX + '/getlast',
+                            headers={'Accept': PICKLE_TYPE})
+        self.assertEqual(resp.headers['Content-Type'], PICKLE_TYPE)
+
+    def test_json_transport(self):
+        """
+        Test that the same calls are returned over JSON
+        """
+        pickled = getattr(self.ht, LAST)()
+        self.ht.session.headers.update(new_session('json').headers)
+        decoded = getattr(self.ht, LAST)()
+        self.assertEqual(decoded.pop('urlparts'),
+                         list(pickled.pop('urlparts')))
+        self.assertEqual(decoded, pickled)
+        self.assertRaises(ValueError, new_session, 'xml')